@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import sys
+import time
+from argparse import ArgumentParser
+from lxml import etree
+import ncc_archive
+import ncc_output
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Look at running config snapshots recorded by ncc.py --archive:')
+
+    parser.add_argument('--archive', type=str, required=True,
+                        help="The archive directory given to ncc.py --archive")
+    parser.add_argument('--device', type=str,
+                        help="The device, as HOST:PORT, whose snapshots to look at")
+    parser.add_argument('--format', type=str, choices=ncc_output.FORMATS,
+                        help="Write a snapshot shown in this format (default pretty-printed XML)")
+
+    #
+    # Snapshots are given by their ID or by their index in the list, -1
+    # being the latest.
+    #
+    g = parser.add_mutually_exclusive_group(required=True)
+    g.add_argument('--devices', action='store_true',
+                   help="List the devices with snapshots")
+    g.add_argument('--list', action='store_true',
+                   help="List the snapshots of --device, with how many of their chunks changed from the one before")
+    g.add_argument('--show', type=str,
+                   help="Write out a snapshot of --device, given by ID or index (-1 is the latest)")
+    g.add_argument('--diff', type=str, nargs=2, metavar=('OLD', 'NEW'),
+                   help="Show a unified diff between two snapshots of --device, given by ID or index")
+
+    args = parser.parse_args()
+    archive = ncc_archive.Archive(args.archive)
+
+    if args.devices:
+        for d in archive.devices():
+            print(d)
+        sys.exit(0)
+    if not args.device:
+        print("--device is required")
+        sys.exit(1)
+
+    try:
+        if args.list:
+            previous = {}
+            for snapshot in archive.snapshots(args.device):
+                m = archive.manifest(args.device, snapshot)
+                chunks = dict((c['tag'], c['sha256']) for c in m['chunks'])
+                changed = sum(1 for (tag, h) in chunks.items() if previous.get(tag) != h)
+                changed += sum(1 for tag in previous if tag not in chunks)
+                print('%s  %s  %d chunks, %d changed, %d bytes' % (
+                    m['id'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(m['taken'])),
+                    len(chunks), changed, sum(c['size'] for c in m['chunks'])))
+                previous = chunks
+        elif args.show:
+            data = archive.load(archive.manifest(args.device, args.show))
+            if args.format:
+                ncc_output.write(data, sys.stdout, args.format)
+            else:
+                sys.stdout.write('%s\n' % etree.tostring(data, pretty_print=True).decode('utf-8'))
+        else:
+            for line in archive.diff(archive.manifest(args.device, args.diff[0]),
+                                     archive.manifest(args.device, args.diff[1])):
+                sys.stdout.write(line)
+    except KeyError as e:
+        print(e.args[0])
+        sys.exit(1)
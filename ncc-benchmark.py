@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""Benchmark the scripts against a simulated device.
+
+Each benchmark runs one of the entry points (ncc.py getting running
+config, getting oper data and doing edits, ncc-get-all-schema.py
+downloading schemas, ncc-simple-poller.py polling) as a subprocess
+against an in-process ncc_simulator device, over a sweep of reply
+sizes, template counts, schema counts and concurrency levels. For each
+case it records the wall time, the CPU time and peak RSS of the
+subprocess and the device's latency percentiles for each kind of RPC,
+and writes the lot out as JSON, which can be compared with the results
+of an earlier run to flag regressions.
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from lxml import etree
+from ncc_simulator import Device, Simulator, canned_schemas, OC_IF_NS
+import paramiko
+
+NCC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = ['get-config', 'get-oper', 'do-edits', 'do-edits-batched', 'schemas', 'poller']
+
+#
+# The metrics compared between runs; for all of them, bigger is worse.
+#
+METRICS = ['wall', 'cpu', 'max_rss_kb']
+
+
+def percentile(values, p):
+    """The nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def median(values):
+    return percentile(values, 50)
+
+
+def interface_name(i):
+    return 'GigabitEthernet0/0/%d/%d' % (i // 48, i % 48)
+
+
+def running_config(size):
+    """An openconfig interfaces config with size entries.
+    """
+    root = etree.Element('config')
+    interfaces = etree.SubElement(root, '{%s}interfaces' % OC_IF_NS, nsmap={None: OC_IF_NS})
+    for i in range(size):
+        interface = etree.SubElement(interfaces, '{%s}interface' % OC_IF_NS)
+        etree.SubElement(interface, '{%s}name' % OC_IF_NS).text = interface_name(i)
+        config = etree.SubElement(interface, '{%s}config' % OC_IF_NS)
+        etree.SubElement(config, '{%s}name' % OC_IF_NS).text = interface_name(i)
+        etree.SubElement(config, '{%s}description' % OC_IF_NS).text = 'interface %d' % i
+        etree.SubElement(config, '{%s}mtu' % OC_IF_NS).text = '9000'
+    return root
+
+
+EDIT_TEMPLATE = '''<config>
+  <interfaces xmlns="%s">
+    <interface>
+      <name>%s</name>
+      <config>
+        <name>%s</name>
+        <description>{{DESCRIPTION}} %d</description>
+      </config>
+    </interface>
+  </interfaces>
+</config>
+'''
+
+
+def write_snippets(snippets_dir, count):
+    """Write count edit templates, each setting the description of an
+    interface, returning their names.
+    """
+    for d in ('editconfigs', 'filters'):
+        os.makedirs(os.path.join(snippets_dir, d))
+    names = []
+    for i in range(count):
+        name = 'bench-%04d' % i
+        with open(os.path.join(snippets_dir, 'editconfigs', name + '.tmpl'), 'w') as f:
+            f.write(EDIT_TEMPLATE % (OC_IF_NS, interface_name(i), interface_name(i), i))
+        names.append(name)
+    return names
+
+
+def devices(port, concurrency):
+    """Credentials for concurrency distinct sessions to the simulator,
+    which accepts any username.
+    """
+    return [{'host': '127.0.0.1', 'port': port, 'username': 'bench%d' % i, 'password': 'bench'}
+            for i in range(concurrency)]
+
+
+def ncc_args(workdir, port, concurrency):
+    """Arguments to point ncc.py at one session to the simulator or, for
+    more concurrency, at as many sessions as a hosts file can list.
+    """
+    args = [os.path.join(NCC_DIR, 'ncc.py'), '--no-capability-store']
+    if concurrency == 1:
+        return args + ['--host', '127.0.0.1', '--port', str(port)]
+    hosts_file = os.path.join(workdir, 'hosts.json')
+    with open(hosts_file, 'w') as f:
+        json.dump(devices(port, concurrency), f)
+    return args + ['--hosts-file', hosts_file, '--workers', str(concurrency)]
+
+
+def cases(args):
+    """Yield (benchmark, params) for every case to run.
+    """
+    for benchmark in args.benchmarks:
+        for concurrency in args.concurrency:
+            if benchmark == 'get-config':
+                for size in args.config_sizes:
+                    yield benchmark, {'config_size': size, 'concurrency': concurrency}
+            elif benchmark == 'get-oper':
+                for size in args.reply_sizes:
+                    yield benchmark, {'interfaces': size, 'concurrency': concurrency}
+            elif benchmark in ('do-edits', 'do-edits-batched'):
+                for count in args.template_counts:
+                    yield benchmark, {'templates': count, 'concurrency': concurrency}
+            elif benchmark == 'schemas':
+                for count in args.schema_counts:
+                    yield benchmark, {'schemas': count, 'concurrency': concurrency}
+            elif benchmark == 'poller':
+                for size in args.reply_sizes:
+                    yield benchmark, {'interfaces': size, 'concurrency': concurrency}
+
+
+def device_for(benchmark, params, args):
+    kwargs = {'latency': args.latency, 'jitter': args.jitter, 'seed': 0}
+    if benchmark == 'get-config':
+        kwargs['config'] = running_config(params['config_size'])
+    if 'interfaces' in params:
+        kwargs['interfaces'] = params['interfaces']
+    if benchmark == 'schemas':
+        kwargs['schemas'] = canned_schemas(max(0, params['schemas'] - len(canned_schemas())))
+    return Device(**kwargs)
+
+
+def command(benchmark, params, port, workdir, args):
+    """The command line to run a case in workdir, which is empty.
+    """
+    python = args.python
+    concurrency = params['concurrency']
+    if benchmark == 'get-config':
+        return [python] + ncc_args(workdir, port, concurrency) + ['-g']
+    if benchmark == 'get-oper':
+        return [python] + ncc_args(workdir, port, concurrency) + [
+            '--get-oper', '-f', '<interfaces xmlns="%s"/>' % OC_IF_NS]
+    if benchmark in ('do-edits', 'do-edits-batched'):
+        snippets = os.path.join(workdir, 'snippets')
+        names = write_snippets(snippets, params['templates'])
+        cmd = [python] + ncc_args(workdir, port, concurrency) + [
+            '--snippets', snippets, '--params', json.dumps({'DESCRIPTION': 'benchmark'})]
+        if benchmark == 'do-edits-batched':
+            cmd.append('--batch-edits')
+        return cmd + ['--do-edits'] + names
+    if benchmark == 'schemas':
+        output_dir = os.path.join(workdir, 'schemas')
+        os.makedirs(output_dir)
+        return [python, os.path.join(NCC_DIR, 'ncc-get-all-schema.py'),
+                '--host', '127.0.0.1', '--port', str(port),
+                '--output-dir', output_dir, '--sessions', str(concurrency)]
+    if benchmark == 'poller':
+        jobs_file = os.path.join(workdir, 'jobs.json')
+        jobs = []
+        for d in devices(port, concurrency):
+            d.update({'subtree': '<interfaces xmlns="%s"/>' % OC_IF_NS,
+                      'cadence': 1, 'rates': ['in-octets']})
+            jobs.append(d)
+        with open(jobs_file, 'w') as f:
+            json.dump(jobs, f)
+        return [python, os.path.join(NCC_DIR, 'ncc-simple-poller.py'),
+                '--jobs-file', jobs_file, '--duration', str(args.poller_duration)]
+    raise ValueError('unknown benchmark %s' % benchmark)
+
+
+def run_once(cmd, workdir):
+    """Run a command, returning (exit status, wall time, CPU time, peak
+    RSS in KB, tail of stderr).
+    """
+    env = dict(os.environ, NCC_CACHE=os.path.join(workdir, 'cache'))
+    with open(os.devnull, 'w') as devnull:
+        with open(os.path.join(workdir, 'stderr'), 'w+') as err:
+            start = time.time()
+            p = subprocess.Popen(cmd, stdout=devnull, stderr=err, cwd=workdir, env=env)
+
+            #
+            # wait4 gives us the resource usage of just this child.
+            #
+            _, status, usage = os.wait4(p.pid, 0)
+            wall = time.time() - start
+            p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            err.seek(0)
+            tail = err.read()[-2000:]
+    return p.returncode, wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss, tail
+
+
+def run_case(benchmark, params, args, host_key):
+    device = device_for(benchmark, params, args)
+    sim = Simulator(device, port=0, host_key=host_key).start()
+    result = {
+        'benchmark': benchmark,
+        'params': params,
+        'wall': [],
+        'cpu': [],
+        'max_rss_kb': [],
+        'failures': 0,
+    }
+    try:
+        for n in range(args.repeat):
+            workdir = tempfile.mkdtemp(prefix='ncc-bench-')
+            try:
+                cmd = command(benchmark, params, sim.port, workdir, args)
+                status, wall, cpu, rss, err = run_once(cmd, workdir)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            #
+            # A run that fails may well have stopped early, so only
+            # successful runs count towards the metrics.
+            #
+            if status != 0:
+                result['failures'] += 1
+                sys.stderr.write('%s %s failed with status %d:\n%s\n' % (
+                    benchmark, json.dumps(params, sort_keys=True), status, err))
+                continue
+            result['wall'].append(wall)
+            result['cpu'].append(cpu)
+            result['max_rss_kb'].append(rss)
+    finally:
+        sim.stop()
+
+    result['rpcs'] = {}
+    for op, timings in sorted(device.timings.items()):
+        result['rpcs'][op] = {
+            'count': len(timings),
+            'p50': percentile(timings, 50),
+            'p90': percentile(timings, 90),
+            'p99': percentile(timings, 99),
+            'max': max(timings),
+        }
+    return result
+
+
+def case_key(r):
+    return '%s %s' % (r['benchmark'], json.dumps(r['params'], sort_keys=True))
+
+
+def summarize(r):
+    params = ' '.join('%s=%s' % kv for kv in sorted(r['params'].items()))
+    if not r['wall']:
+        return '%-18s %-40s FAILED %d' % (r['benchmark'], params, r['failures'])
+    return '%-18s %-40s wall %8.3fs  cpu %8.3fs  rss %8dKB%s' % (
+        r['benchmark'], params,
+        median(r['wall']), median(r['cpu']), max(r['max_rss_kb']),
+        '  FAILED %d' % r['failures'] if r['failures'] else '')
+
+
+def compare(baseline, results, threshold, out=sys.stdout):
+    """Compare the median of each metric with the baseline's for the same
+    case, returning the number of regressions beyond the threshold
+    fraction. A case with more failed runs than in the baseline counts
+    as a regression too.
+    """
+    old = dict((case_key(r), r) for r in baseline['results'])
+    regressions = 0
+    for r in results:
+        b = old.get(case_key(r))
+        if b is None:
+            continue
+        if r['failures'] > b.get('failures', 0):
+            regressions += 1
+            out.write('%-60s %-10s %12d -> %12d          REGRESSION\n' % (
+                case_key(r), 'failures', b.get('failures', 0), r['failures']))
+        for m in METRICS:
+            before = median(b[m])
+            after = median(r[m])
+            if not before or after is None:
+                continue
+            change = (after - before) / float(before)
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            out.write('%-60s %-10s %12.3f -> %12.3f %+7.1f%%%s\n' % (
+                case_key(r), m, before, after, change * 100, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Benchmark the scripts against a simulated device:')
+    parser.add_argument('--benchmarks', type=str, nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help="Benchmarks to run (default all)")
+    parser.add_argument('--reply-sizes', type=int, nargs='+', default=[24, 1000],
+                        help="Numbers of interfaces of oper data, for get-oper and poller (default 24 1000)")
+    parser.add_argument('--config-sizes', type=int, nargs='+', default=[10, 1000],
+                        help="Numbers of interfaces in the running config, for get-config (default 10 1000)")
+    parser.add_argument('--template-counts', type=int, nargs='+', default=[1, 50],
+                        help="Numbers of templates to edit with, for do-edits (default 1 50)")
+    parser.add_argument('--schema-counts', type=int, nargs='+', default=[50, 500],
+                        help="Numbers of schemas to download, for schemas (default 50 500)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8],
+                        help="Numbers of sessions to run at once: devices in a hosts file for ncc.py, --sessions for schema downloads and jobs for the poller (default 1 8)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Times to run each case (default 3)")
+    parser.add_argument('--poller-duration', type=int, default=5,
+                        help="Seconds to run the poller for (default 5)")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Milliseconds the simulated device waits before each reply (default 0)")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="Up to this many milliseconds more (default 0)")
+    parser.add_argument('--python', type=str, default=sys.executable,
+                        help="Python interpreter to run the scripts with (default this one)")
+    parser.add_argument('--output', type=str,
+                        help="File to write the results to as JSON (default benchmark-<time>.json)")
+    parser.add_argument('--compare', type=str,
+                        help="Results of an earlier run to compare with, exiting with status 1 if anything regressed")
+    parser.add_argument('--threshold', type=float, default=10,
+                        help="Percentage increase in the median wall time, CPU time or peak RSS of a case counted as a regression (default 10)")
+    args = parser.parse_args()
+
+    #
+    # Scripts dropping sessions are none of our business here.
+    #
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    logging.getLogger('paramiko').propagate = False
+
+    host_key = paramiko.RSAKey.generate(2048)
+    results = []
+    for (benchmark, params) in cases(args):
+        r = run_case(benchmark, params, args, host_key)
+        print(summarize(r))
+        sys.stdout.flush()
+        results.append(r)
+
+    output = args.output or 'benchmark-%s.json' % time.strftime('%Y%m%d%H%M%S')
+    with open(output, 'w') as f:
+        json.dump({
+            'time': time.time(),
+            'python': args.python,
+            'platform': platform.platform(),
+            'args': vars(args),
+            'results': results,
+        }, f, indent=1, sort_keys=True)
+    print('Results written to %s' % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold / 100.0):
+            sys.exit(1)
@@ -1,16 +1,26 @@
 #!/usr/bin/env python
 import sys
+import os
 import string
 import time
 import logging
 import re
-from os import listdir
-from os.path import isfile, join, basename
+import json
+import hashlib
+import threading
+from os import listdir, rename, unlink
+from os.path import isfile, join, basename, getsize, lexists
 from argparse import ArgumentParser
 from ncclient import manager
 from ncclient.operations.rpc import RPCError
-from BeautifulSoup import BeautifulSoup
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+from lxml import etree
 import pyang
+from pyang import yang_parser
+from ncc_schema_cache import SchemaCache, entry_key
 
 
 #
@@ -20,41 +30,344 @@ schemas_filter = '''<netconf-state xmlns="urn:ietf:params:xml:ns:yang:ietf-netco
  <schemas/>
 </netconf-state>'''
 
+NSMAP = {'ncm': 'urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring'}
+
 #
-# return an etree of the data retrieved
+# return an etree of the data retrieved, as already parsed by ncclient
 #
 def get(m, filter=None):
     if filter and len(filter) > 0:
-        c = m.get(filter=('subtree', filter)).data_xml
+        c = m.get(filter=('subtree', filter)).data_ele
     else:
-        c = m.get().data_xml
+        c = m.get().data_ele
     return c
 
 
-def get_schema(m, schema_list, output_dir, start_after=None):
-    failed_download = []
-    getting_yet = True
+#
+# Name of the file in the output directory recording what has already
+# been downloaded, so that reruns only fetch new or changed schemas.
+#
+MANIFEST = '.schema-manifest.json'
+
+
+class Manifest(object):
+    """Record of the identifier, version and checksum of each schema
+    successfully downloaded into an output directory. It is saved
+    atomically, at most every few seconds while downloading and once at
+    the end, so a crash only loses the last few seconds of progress.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.filename = join(output_dir, MANIFEST)
+        self.lock = threading.Lock()
+        self.last_saved = time.time()
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+                f.close()
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def is_current(self, identifier, version):
+        """Is the schema already on disk, at the advertised version and
+        unchanged since we wrote it?
+        """
+        e = self.entries.get(identifier)
+        if e is None or e['version'] != version:
+            return False
+        try:
+            with open(join(self.output_dir, e['file']), 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest() == e['sha256']
+        except IOError:
+            return False
+
+    def record(self, identifier, version, fname, checksum):
+        with self.lock:
+            self.entries[identifier] = {
+                'version': version,
+                'file': fname,
+                'sha256': checksum,
+            }
+            if time.time() - self.last_saved > 5:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+            f.close()
+        rename(tmp, self.filename)
+        self.last_saved = time.time()
+
+
+class Progress(object):
+    """Thread-safe download counters with a throttled progress line on
+    stderr.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.fetched = 0
+        self.cached = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last_report = 0
+        self.lock = threading.Lock()
+
+    def update(self, fetched=0, cached=0, skipped=0, failed=0, nbytes=0):
+        with self.lock:
+            self.fetched += fetched
+            self.cached += cached
+            self.skipped += skipped
+            self.failed += failed
+            self.bytes += nbytes
+            if time.time() - self.last_report >= 1:
+                self.report()
+
+    def report(self, final=False):
+        elapsed = max(time.time() - self.start, 0.001)
+        sys.stderr.write('\r%d/%d done (%d fetched, %d cached, %d skipped, %d failed) in %.1fs, %.1f schemas/s, %.1f KB/s%s' % (
+            self.fetched + self.cached + self.skipped + self.failed, self.total,
+            self.fetched, self.cached, self.skipped, self.failed,
+            elapsed, self.fetched / elapsed, self.bytes / elapsed / 1024,
+            '\n' if final else ''))
+        sys.stderr.flush()
+        self.last_report = time.time()
+
+
+def download_schema(m, s, output_dir, cache=None, key=None):
+    """Download one schema into the output directory, returning the file
+    name, its sha256 checksum, its size and whether it came from the
+    shared schema cache rather than the device.
+    """
+    fname = s + '.yang'
+    dest = join(output_dir, fname)
+    obj = cache.lookup(key) if cache else None
+    cached = obj is not None
+    if not cached:
+        #
+        # ncclient has already pulled the schema text out of the reply,
+        # so there's no need to parse it again
+        #
+        c = m.get_schema(s)
+        data = (c.data + '\n').encode('utf-8')
+        if cache:
+            obj = cache.store(key, data)
+    if obj is not None:
+        cache.link(obj, dest)
+        return fname, basename(obj).split('.')[0], getsize(obj), cached
+
+    write_schema(dest, data)
+    return fname, hashlib.sha256(data).hexdigest(), len(data), False
+
+
+def write_schema(dest, data):
+    """Write a schema's text to dest, replacing any file already there.
+    """
+    #
+    # Never write through an existing file, it may be a link into a
+    # schema cache.
+    #
+    if lexists(dest):
+        unlink(dest)
+    with open(dest, 'wb') as yang:
+        yang.write(data)
+        yang.close()
+
+
+def get_schema(mgrs, schema_list, output_dir, start_after=None, versions=None,
+               manifest=None, cache=None, namespaces=None):
+    """Download the schemas in schema_list in parallel, one worker thread
+    per manager in mgrs. Schemas the manifest says are already on disk at
+    the advertised version are skipped, and those in the shared schema
+    cache are linked rather than downloaded. Returns the schemas that
+    failed to download.
+    """
+    versions = versions or {}
+    namespaces = namespaces or {}
     if start_after:
-        getting_yet = False
+        schema_list = schema_list[schema_list.index(start_after) + 1:] \
+                      if start_after in schema_list else []
+
+    q = Queue()
     for s in schema_list:
-        if getting_yet==False:
-            if s==start_after:
-                getting_yet = True
-            else:
+        q.put(s)
+    failed_download = []
+    progress = Progress(len(schema_list))
+
+    def worker(m):
+        while True:
+            try:
+                s = q.get_nowait()
+            except Empty:
+                return
+            version = versions.get(s, '')
+            if manifest and manifest.is_current(s, version):
+                progress.update(skipped=1)
                 continue
+            try:
+                key = entry_key(s, version, namespaces.get(s)) if cache else None
+                fname, checksum, size, cached = download_schema(m, s, output_dir, cache, key)
+                if manifest:
+                    manifest.record(s, version, fname, checksum)
+                if cached:
+                    progress.update(cached=1)
+                else:
+                    progress.update(fetched=1, nbytes=size)
+            except RPCError as e:
+                # print >>sys.stderr, 'Failed to get schema {} || RPCError: severity={}, tag={}, message={}'.format(
+                #     s, e.severity, e.tag, e.message)
+                failed_download.append(s)
+                progress.update(failed=1)
+            except Exception as e:
+                sys.stderr.write('\nFailed to get schema {}: {}: {}\n'.format(
+                    s, e.__class__.__name__, e))
+                failed_download.append(s)
+                progress.update(failed=1)
+                #
+                # If the session has died, drop it and leave the rest of
+                # the queue to the other sessions.
+                #
+                if not m.connected:
+                    return
+
+    threads = [threading.Thread(target=worker, args=(m,)) for m in mgrs]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    #
+    # Anything still queued had no live session left to download it.
+    #
+    while True:
         try:
-            c = m.get_schema(s)
-            with open(output_dir+'/'+s+'.yang', 'w') as yang:
-                print >>yang, BeautifulSoup(
-                    c.xml,
-                    convertEntities=BeautifulSoup.HTML_ENTITIES).find('data').getText()
-                yang.close()
-        except RPCError as e:
-            # print >>sys.stderr, 'Failed to get schema {} || RPCError: severity={}, tag={}, message={}'.format(
-            #     s, e.severity, e.tag, e.message)
-            failed_download.append(s)
+            s = q.get_nowait()
+        except Empty:
+            break
+        failed_download.append(s)
+        progress.update(failed=1)
+    if manifest:
+        manifest.save()
+    progress.report(final=True)
     return failed_download
 
+
+def parse_module(ctx, parser, output_dir, fname):
+    """Parse one schema file, without resolving or validating anything,
+    returning its node in the import/include graph and its name, or
+    (None, None) if it couldn't be parsed.
+    """
+    with open(join(output_dir, fname), 'r') as fd:
+        text = fd.read()
+        fd.close()
+    module = parser.parse(ctx, fname, text)
+    if module is None:
+        return None, None
+    revision = module.search_one('revision')
+    node = {
+        'file': fname,
+        'keyword': module.keyword,
+        'revision': revision.arg if revision else None,
+        'imports': [],
+        'includes': [],
+    }
+    for s in module.substmts:
+        if (s.keyword=='import') or (s.keyword=='include'):
+            revision_date = s.search_one('revision-date')
+            node[s.keyword + 's'].append({
+                'module': str(s.arg),
+                'revision': revision_date.arg if revision_date else None,
+            })
+    return str(module.arg), node
+
+
+def dependency_graph(output_dir, yangfiles):
+    """Parse each schema file exactly once in a single pyang context and
+    return the import/include graph, keyed on module name, along with a
+    list of any files that failed to parse. Nothing is resolved or
+    validated here, so no module gets parsed again as a dependency of
+    another.
+    """
+    ctx = pyang.Context(pyang.FileRepository(output_dir))
+    parser = yang_parser.YangParser()
+    graph = {}
+    unparsed = []
+    for fname in yangfiles:
+        name, node = parse_module(ctx, parser, output_dir, fname)
+        if node is None:
+            unparsed.append(fname)
+            continue
+        graph[name] = node
+    return graph, unparsed
+
+
+def get_schema_closure(mgrs, roots, output_dir, versions=None, manifest=None,
+                       cache=None, namespaces=None):
+    """Download the schemas in roots and everything they import or
+    include, directly or indirectly, and nothing else. Each level of the
+    dependency graph is downloaded in parallel as get_schema does, then
+    the schemas just downloaded are parsed for the imports and includes
+    making up the next level. Returns the schemas in the closure, in the
+    order found, and those that failed to download.
+    """
+    ctx = pyang.Context(pyang.FileRepository(output_dir))
+    parser = yang_parser.YangParser()
+    closure = list(roots)
+    seen = set(roots)
+    failed_download = []
+    level = list(roots)
+    depth = 0
+    while level:
+        sys.stderr.write('Level %d: %d schemas\n' % (depth, len(level)))
+        failed = get_schema(mgrs, level, output_dir, versions=versions, manifest=manifest,
+                            cache=cache, namespaces=namespaces)
+        failed_download += failed
+        next_level = []
+        for s in level:
+            if s in failed:
+                continue
+            name, node = parse_module(ctx, parser, output_dir, s + '.yang')
+            if node is None:
+                continue
+            for dep in node['imports'] + node['includes']:
+                if dep['module'] not in seen:
+                    seen.add(dep['module'])
+                    closure.append(dep['module'])
+                    next_level.append(dep['module'])
+        level = next_level
+        depth += 1
+    return closure, failed_download
+
+
+def connect(args):
+    """Connect to the device described by the command line arguments.
+    """
+    #
+    # Could use this extra param instead of the last four arguments
+    # specified below:
+    #
+    # device_params={'name': 'iosxr'}
+    #
+    def iosxr_unknown_host_cb(host, fingerprint):
+        return True
+    return manager.connect(host=args.host,
+                           port=args.port,
+                           username=args.username,
+                           password=args.password,
+                           timeout=args.timeout,
+                           allow_agent=False,
+                           look_for_keys=False,
+                           hostkey_verify=False,
+                           unknown_host_cb=iosxr_unknown_host_cb)
+
 if __name__ == '__main__':
 
     parser = ArgumentParser(description='Provide device and output parameters:')
@@ -84,6 +397,18 @@ if __name__ == '__main__':
                    help="Don't get schemas until after this one")
     g.add_argument('--skip-download', action='store_true', default=False,
                    help="Skip downloading schema and just consider those downloaded already")
+    g.add_argument('--modules', type=str,
+                   help="Only download the advertised schemas whose names match this regular expression (e.g. '^openconfig-bgp$') and the schemas they import or include, directly or indirectly, fetching each level of dependencies in parallel; only these are then checked")
+    parser.add_argument('--graph-out', type=str,
+                        help="Write the import/include dependency graph of the downloaded schema to this file as JSON")
+    parser.add_argument('--sessions', type=int, default=4,
+                        help="Number of NETCONF sessions to download schemas over in parallel (default 4)")
+    parser.add_argument('--no-manifest', action='store_true', default=False,
+                        help="Download everything, ignoring and not updating the manifest of schemas already downloaded")
+    parser.add_argument('--cache-dir', type=str, default=os.environ.get('NCC_SCHEMA_CACHE'),
+                        help="Shared schema cache directory; schemas already in the cache are linked into the output directory rather than downloaded (default $NCC_SCHEMA_CACHE)")
+    parser.add_argument('--cache-symlinks', action='store_true', default=False,
+                        help="Populate the output directory from the schema cache with symlinks rather than hard links")
 
 
     args = parser.parse_args()
@@ -103,31 +428,22 @@ if __name__ == '__main__':
         # default the output to got to cwd
         args.output_dir = '.'
         
-    #
-    # Could use this extra param instead of the last four arguments
-    # specified below:
-    #
-    # device_params={'name': 'iosxr'}
-    #
-    def iosxr_unknown_host_cb(host, fingerprint):
-        return True
-    mgr =  manager.connect(host=args.host,
-                           port=args.port,
-                           username=args.username,
-                           password=args.password,
-                           timeout=args.timeout,
-                           allow_agent=False,
-                           look_for_keys=False,
-                           hostkey_verify=False,
-                           unknown_host_cb=iosxr_unknown_host_cb)
+    mgr = connect(args)
 
     #
     # retrieve the schemas datatree and extract all the schema
     # identifiers
     #
     schema_tree = get(mgr, schemas_filter)
-    soup = BeautifulSoup(schema_tree)
-    schema_list = [s.getText() for s in soup.findAll('identifier')]
+    schema_list = []
+    versions = {}
+    namespaces = {}
+    for s in schema_tree.xpath('//ncm:schema', namespaces=NSMAP):
+        identifier = s.findtext('ncm:identifier', namespaces=NSMAP)
+        if identifier not in versions:
+            schema_list.append(identifier)
+            versions[identifier] = s.findtext('ncm:version', default='', namespaces=NSMAP)
+            namespaces[identifier] = s.findtext('ncm:namespace', default='', namespaces=NSMAP)
     
     #
     # check the schema list against server capabilities
@@ -162,24 +478,40 @@ if __name__ == '__main__':
     # downloads (if any).
     #
     if not args.skip_download:
-        failed = get_schema(mgr, schema_list, args.output_dir, args.start_after)
+        mgrs = [mgr] + [connect(args) for i in range(args.sessions - 1)]
+        manifest = None if args.no_manifest else Manifest(args.output_dir)
+        cache = SchemaCache(args.cache_dir, symlink=args.cache_symlinks) if args.cache_dir else None
+        if args.modules:
+            roots = [s for s in schema_list if re.search(args.modules, s)]
+            if len(roots) == 0:
+                print('No advertised schemas match {}'.format(args.modules))
+            closure, failed = get_schema_closure(mgrs, roots, args.output_dir,
+                                                 versions=versions, manifest=manifest,
+                                                 cache=cache, namespaces=namespaces)
+            print('Downloaded {} schemas for {} matching {}'.format(
+                len(closure) - len(failed), len(roots), args.modules))
+        else:
+            failed = get_schema(mgrs, schema_list, args.output_dir, args.start_after,
+                                versions=versions, manifest=manifest,
+                                cache=cache, namespaces=namespaces)
+        if cache:
+            print(cache.summary())
         for f in failed:
             failed_download.add(str(f))
+        for m in mgrs[1:]:
+            if not m.connected:
+                continue
+            try:
+                m.close_session()
+            except ValueError:
+                pass
 
-    #
-    # Now let's check all the schema that we downloaded (from this run
-    # and any other) and parse them with pyang to extract any imports
-    # or includes and verify that they were on the advertised schema
-    # list and didn't fail download.
-    #
-    # TODO: cater for explicitly revisioned imports & includes
-    #
-    imports_and_includes = set()
-    repos = pyang.FileRepository(args.output_dir)
-    yangfiles = [f for f in listdir(args.output_dir) if isfile(join(args.output_dir, f))]
-    for fname in yangfiles:
-        ctx = pyang.Context(repos)
-        if args.process_MIBs_sw or args.display_MIBs_sw:
+    yangfiles = [f for f in listdir(args.output_dir)
+                 if isfile(join(args.output_dir, f)) and f.endswith('.yang')]
+    if args.modules:
+        yangfiles = [f for f in yangfiles if f[:-len('.yang')] in closure]
+    if args.process_MIBs_sw or args.display_MIBs_sw:
+        for fname in yangfiles:
             if "MIB" in fname:
                 mib_name = str(fname).rstrip('.yang')
                 mib_filter = '<'+mib_name+':'+mib_name+' xmlns:'+mib_name+'="urn:ietf:params:xml:ns:yang:smiv2:'+mib_name+'"/>'
@@ -187,20 +519,39 @@ if __name__ == '__main__':
                     mib = get(mgr, mib_filter)
                     if args.display_MIBs_sw:
                         print mib_name
-                        soup = BeautifulSoup(mib)
-                        print (soup.prettify())
+                        print (etree.tostring(mib, pretty_print=True))
                 except RPCError as e:
                     print mib_name
                     print e
-        fd = open(args.output_dir+'/'+fname, 'r')
-        text = fd.read()
-        ctx.add_module(fname, text)
-        this_module = basename(fname).split(".")[0]
-        for ((m,r), module) in ctx.modules.iteritems():
-            if m==this_module:
-                for s in module.substmts:
-                    if (s.keyword=='import') or (s.keyword=='include'):
-                        imports_and_includes.add(s.arg)
+
+    #
+    # Now let's check all the schema that we downloaded (from this run
+    # and any other) and parse them with pyang to extract any imports
+    # or includes and verify that they were on the advertised schema
+    # list and didn't fail download.
+    #
+    graph, unparsed = dependency_graph(args.output_dir, yangfiles)
+    if args.graph_out:
+        with open(args.graph_out, 'w') as f:
+            json.dump(graph, f, indent=1, sort_keys=True)
+            f.close()
+    if len(unparsed) > 0:
+        print 'The following schema files could not be parsed:'
+        for fname in sorted(unparsed):
+            print '    {}'.format(fname)
+
+    imports_and_includes = set()
+    wrong_revision = set()
+    for node in graph.values():
+        for dep in node['imports'] + node['includes']:
+            imports_and_includes.add(dep['module'])
+            if dep['revision'] and versions.get(dep['module']) not in (None, '', dep['revision']):
+                wrong_revision.add('{}@{} (advertised {})'.format(
+                    dep['module'], dep['revision'], versions[dep['module']]))
+    if len(wrong_revision) > 0:
+        print 'The following schema are imported or included at a revision other than the one advertised:'
+        for m in sorted(wrong_revision, key=str.lower):
+            print '    {}'.format(m)
 
     #
     # Verify that all imports and includes appeared in the advertised
@@ -217,14 +568,15 @@ if __name__ == '__main__':
             print '    {}'.format(m)
 
         #
-        # try to download the not-advertised schemas
+        # try to download the not-advertised schemas, unless already
+        # tried as part of the closure of --modules
         #
         for m in not_advertised:
+            if args.modules and m in closure:
+                continue
             try:
                 c = mgr.get_schema(m)
-                with open(args.output_dir+'/'+m+'.yang', 'w') as yang:
-                    print >>yang, c.data
-                    yang.close()
+                write_schema(join(args.output_dir, m + '.yang'), (c.data + '\n').encode('utf-8'))
             except RPCError as e:
                 failed_download.add(str(m))
             
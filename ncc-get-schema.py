@@ -1,17 +1,62 @@
 #!/usr/bin/env python
 import sys
+import os
 import logging
 from argparse import ArgumentParser
 from ncclient import manager
 from ncclient.operations.rpc import RPCError
 import logging
 from BeautifulSoup import BeautifulStoneSoup
+from ncc_schema_cache import SchemaCache, entry_key
 
-def get_schema(host, port, user, passwd, schema, version):
+NCMON_NS = 'urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring'
+
+#
+# Filter to get just the netconf-state entries for one schema, which is
+# all the schema cache needs to know to find it.
+#
+schema_entry_filter = '''<netconf-state xmlns="%s">
+ <schemas>
+  <schema>
+   <identifier>%s</identifier>
+  </schema>
+ </schemas>
+</netconf-state>'''
+
+
+def schema_cache_key(m, schema, version):
+    """Work out the schema cache key from the device's netconf-state
+    entry for the schema, or None if the device doesn't list it.
+    """
+    data = m.get(filter=('subtree', schema_entry_filter % (NCMON_NS, schema))).data_ele
+    if data is None:
+        return None
+    for entry in data.iter('{%s}schema' % NCMON_NS):
+        if entry.findtext('{%s}identifier' % NCMON_NS) != schema:
+            continue
+        v = entry.findtext('{%s}version' % NCMON_NS)
+        if version is None or v == version:
+            return entry_key(schema, v, entry.findtext('{%s}namespace' % NCMON_NS))
+    return None
+
+
+def get_schema(host, port, user, passwd, schema, version, cache_dir=None):
     with manager.connect(timeout=600, host=host, port=port, username=user, password=passwd, device_params={'name':"iosxr"}) as m:
         try:
-            c = m.get_schema(schema, version=version)
-            print(c.data)
+            cache = SchemaCache(cache_dir) if cache_dir else None
+            key = schema_cache_key(m, schema, version) if cache else None
+            obj = cache.lookup(key) if key else None
+            if obj:
+                with open(obj) as f:
+                    sys.stdout.write(f.read())
+                    f.close()
+            else:
+                c = m.get_schema(schema, version=version)
+                print(c.data)
+                if key:
+                    cache.store(key, (c.data + '\n').encode('utf-8'))
+            if cache:
+                print >>sys.stderr, cache.summary()
         except RPCError as e:
             print >>sys.stderr, 'Failed to get schema {} || RPCError: severity={}, tag={}, message={}'.format(
                 schema, e.severity, e.tag, e.message)
@@ -32,6 +77,8 @@ if __name__ == '__main__':
                         help="Get just this schema")
     parser.add_argument('--version', type=str, default=None,
                         help="Get just this schema")
+    parser.add_argument('--cache-dir', type=str, default=os.environ.get('NCC_SCHEMA_CACHE'),
+                        help="Shared schema cache directory to check before downloading (default $NCC_SCHEMA_CACHE)")
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="Do some verbose logging")
     args = parser.parse_args()
@@ -53,4 +100,5 @@ if __name__ == '__main__':
         args.username,
         args.password,
         args.schema,
-        args.version)
+        args.version,
+        cache_dir=args.cache_dir)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+import sys
+import os
+import json
+import time
+from argparse import ArgumentParser
+from jinja2 import meta
+from jinja2.exceptions import UndefinedError
+from lxml import etree
+import ncc_filters
+import ncc_templates
+
+NCC_DIR, _ = os.path.split(os.path.realpath(__file__))
+
+
+def render_filter(env, name, params):
+    """Render a named filter, leaving any variable not given in params
+    as a variable, so that the tightened filter can be saved as a named
+    filter taking the same parameters.
+    """
+    fname = '%s.tmpl' % name
+    source = env.loader.get_source(env, fname)[0]
+    kwargs = dict((v, '{{%s}}' % v) for v in meta.find_undeclared_variables(env.parse(source)))
+    kwargs.update(params)
+    return env.get_template(fname).render(**kwargs)
+
+
+def measure(args, filters):
+    """Get with each filter from the device, returning the bytes of each
+    reply and how long it took.
+    """
+    from ncclient import manager
+    m = manager.connect(host=args.host,
+                        port=args.port,
+                        timeout=args.timeout,
+                        username=args.username,
+                        password=args.password,
+                        allow_agent=False,
+                        look_for_keys=False,
+                        hostkey_verify=False,
+                        unknown_host_cb=lambda host, fingerprint: True)
+    results = []
+    try:
+        for f in filters:
+            start = time.time()
+            reply = m.get(filter=('subtree', f))
+            results.append((len(reply.xml), time.time() - start))
+    finally:
+        m.close_session()
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Check a subtree filter against the YANG modules and tighten it to select just the leaves wanted:')
+
+    parser.add_argument('--schema-dir', type=str, required=True,
+                        help="Directory of YANG modules, such as downloaded by ncc-get-all-schema.py, to check the filter against")
+    parser.add_argument('--leaves', type=str, nargs='+',
+                        help="The leaves actually wanted, much like the poller's --display-tags, each a name or the last few names of its path separated by slashes (e.g. full-interface-stats/packets-received); without this the filter is only checked")
+    parser.add_argument('--match', type=str, action='append', default=[],
+                        help="LEAF=VALUE to add a content match node for any leaf of that name (or path ending) on the way to the wanted leaves, say a list key; may be given more than once")
+    parser.add_argument('--snippets', type=str, default=os.environ.get('NCC_SNIPPETS', "%s/snippets" % NCC_DIR),
+                        help="Directory where 'snippets' can be found; default is location of script")
+    parser.add_argument('--params', type=str,
+                        help="JSON-encoded string of parameters dictionary for a named filter; any not given are left as parameters of the tightened filter")
+    parser.add_argument('--save', type=str,
+                        help="Save the tightened filter as a named filter of this name in the snippets directory")
+    parser.add_argument('--force', action='store_true',
+                        help="Let --save replace a named filter that already exists")
+
+    g = parser.add_mutually_exclusive_group(required=True)
+    g.add_argument('-f', '--filter', type=str,
+                   help="NETCONF subtree filter")
+    g.add_argument('--named-filter', type=str,
+                   help="Named NETCONF subtree filter")
+
+    #
+    # Optionally see what difference it really makes on a device.
+    #
+    parser.add_argument('--measure', action='store_true',
+                        help="Get with both the original and tightened filters from --host and report the real reply sizes and times")
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help="The IP address for the device to measure against (default localhost)")
+    parser.add_argument('-u', '--username', type=str, default=os.environ.get('NCC_USERNAME', 'cisco'),
+                        help="Username to use for SSH authentication (default 'cisco')")
+    parser.add_argument('-p', '--password', type=str, default=os.environ.get('NCC_PASSWORD', 'cisco'),
+                        help="Password to use for SSH authentication (default 'cisco')")
+    parser.add_argument('--port', type=int, default=830,
+                        help="Specify this if you want a non-default port (default 830)")
+    parser.add_argument('--timeout', type=int, default=60,
+                        help="NETCONF operation timeout in seconds (default 60)")
+
+    args = parser.parse_args()
+
+    matches = {}
+    for m in args.match:
+        leaf, sep, value = m.partition('=')
+        if not sep:
+            print("--match takes LEAF=VALUE")
+            sys.exit(1)
+        matches[leaf] = value
+    if (matches or args.save) and not args.leaves:
+        print("--match and --save need --leaves")
+        sys.exit(1)
+    if args.save:
+        save_as = os.path.join(args.snippets, 'filters', '%s.tmpl' % args.save)
+        if os.path.exists(save_as) and not args.force:
+            print("Named filter %s already exists; use --force to replace it" % args.save)
+            sys.exit(1)
+
+    if args.named_filter:
+        env = ncc_templates.environment('%s/filters' % args.snippets, None)
+        try:
+            text = render_filter(env, args.named_filter, json.loads(args.params) if args.params else {})
+        except UndefinedError as e:
+            print("Undefined variable %s.  Use --params to specify json dict" % e.message)
+            sys.exit(1)
+    else:
+        text = args.filter
+
+    try:
+        nodes = ncc_filters.parse(text)
+        schema = ncc_filters.Schema(args.schema_dir, [etree.QName(n).namespace for n in nodes])
+    except ncc_filters.FilterError as e:
+        print(e)
+        sys.exit(1)
+
+    problems = ncc_filters.validate(nodes, schema)
+    for p in problems:
+        sys.stderr.write('%s\n' % p)
+    if problems:
+        sys.exit(1)
+    before = ncc_filters.estimate(nodes, schema)
+    if not args.leaves:
+        sys.stderr.write('Filter is valid, estimated reply %d bytes\n' % before)
+        sys.exit(0)
+
+    tightened, unused = ncc_filters.tighten(nodes, schema, args.leaves, matches)
+    for u in unused:
+        sys.stderr.write('Nothing under the filter matches %s\n' % u)
+    if not tightened:
+        sys.stderr.write('None of the leaves wanted are under the filter\n')
+        sys.exit(1)
+    after = ncc_filters.estimate(tightened, schema)
+    result = ncc_filters.serialize(tightened)
+    sys.stdout.write(result)
+    sys.stderr.write('Estimated reply %d bytes, down from %d (%.0f%% smaller)\n' % (
+        after, before, 100.0 * (before - after) / before if before else 0.0))
+
+    if args.save:
+        #
+        # Write it aside and move it into place, so that anything using
+        # the named filter meanwhile never sees half of it.
+        #
+        tmp = '%s.%d.tmp' % (save_as, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(result)
+        os.rename(tmp, save_as)
+        sys.stderr.write('Saved as named filter %s\n' % args.save)
+
+    if args.measure:
+        if '{{' in text:
+            print("--measure needs --params for every variable of the filter")
+            sys.exit(1)
+        (b, tb), (a, ta) = measure(args, [text, result])
+        sys.stderr.write('Measured reply %d bytes in %.3fs, down from %d bytes in %.3fs (%.0f%% smaller)\n' % (
+            a, ta, b, tb, 100.0 * (b - a) / b if b else 0.0))
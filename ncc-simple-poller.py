@@ -1,30 +1,22 @@
 #!/usr/bin/env python
 import sys
+import json
+import threading
 from argparse import ArgumentParser
-from ncclient import manager
 from lxml import etree
-from BeautifulSoup import BeautifulSoup
 import logging
 import time
 import datetime
+from ncc_poller import Job, Poller, RateTracker, display_values, counter_values
+from ncc_sinks import Sample, make_sink, typed
 
 
-def get(m, filter=None, xpath=None):
-    if filter and len(filter) > 0:
-        return m.get(filter=('subtree', filter))
-    elif xpath and len(xpath)>0:
-        return m.get(filter=('xpath', xpath))
-    else:
-        print ("Need a filter for oper get!")
-        return None
-        
-        
 if __name__ == '__main__':
 
     parser = ArgumentParser(description='Select your siple poller parameters:')
 
     # Input parameters
-    parser.add_argument('--host', type=str, required=True,
+    parser.add_argument('--host', type=str,
                         help="The device IP or DN")
     parser.add_argument('-u', '--username', type=str, default='cisco',
                         help="Go on, guess!")
@@ -40,6 +32,22 @@ if __name__ == '__main__':
                         help="Cadence of gets")
     parser.add_argument('--display-tags', type=str, nargs='+',
                         help="A list of display XML tags; first value matching displayed")
+    parser.add_argument('--rates', type=str, nargs='+',
+                        help="A list of counter XML tags to display deltas and per-second rates for, for every list entry they appear in")
+    parser.add_argument('--sink', type=str, action='append',
+                        help="Send display tag values and rates to a batched sink instead of printing them; one of csv:FILE, columnar:FILE, influx:FILE, influx:udp://HOST:PORT or influx:tcp://HOST:PORT. May be given more than once.")
+    parser.add_argument('--measurement', type=str, default='ncc',
+                        help="Measurement name samples are recorded under in sinks (default 'ncc')")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="Write to sinks every this many samples (default 1000)")
+    parser.add_argument('--flush-interval', type=int, default=5,
+                        help="...or every this many seconds, whichever comes first (default 5)")
+    parser.add_argument('--jobs-file', type=str,
+                        help="JSON list of jobs to poll instead of --host, each a dict with host and subtree or xpath, and optionally port, username, password, cadence, timeout, display_tags, rates, measurement and name, defaulting to the command line values")
+    parser.add_argument('--workers', type=int, default=16,
+                        help="Maximum number of devices being connected to at once; gets are sent asynchronously, so any number can be in flight (default 16)")
+    parser.add_argument('--duration', type=int,
+                        help="Stop after this many seconds rather than running until interrupted")
 
     # Only one type of filter
     g = parser.add_mutually_exclusive_group()
@@ -62,53 +70,101 @@ if __name__ == '__main__':
             logger.addHandler(handler)
             logger.setLevel(logging.DEBUG)
 
+    def job(j):
+        device = {
+            'host': j['host'],
+            'port': int(j.get('port', args.port)),
+            'username': j.get('username', args.username),
+            'password': j.get('password', args.password),
+            'timeout': j.get('timeout', 60),
+        }
+        return Job(device,
+                   filter=j.get('subtree'),
+                   xpath=j.get('xpath'),
+                   cadence=j.get('cadence', args.cadence),
+                   display_tags=j.get('display_tags', args.display_tags),
+                   name=j.get('name'),
+                   rates=j.get('rates', args.rates),
+                   measurement=j.get('measurement', args.measurement))
+
+    if args.jobs_file:
+        with open(args.jobs_file) as f:
+            jobs = [job(j) for j in json.load(f)]
+            f.close()
+    elif args.host and (args.subtree or args.xpath):
+        jobs = [job({'host': args.host, 'subtree': args.subtree, 'xpath': args.xpath})]
+    else:
+        print("Need a --host and a filter, or a --jobs-file!")
+        sys.exit(1)
+
+    sinks = [make_sink(spec, batch_size=args.batch_size, flush_interval=args.flush_interval)
+             for spec in args.sink or []]
+    if sinks and not [j for j in jobs if j.display_tags or j.rates]:
+        print("Sinks need --display-tags or --rates to know what to record!")
+        sys.exit(1)
+
     #
-    # Could use this extra param instead of the last four arguments
-    # specified below:
-    #
-    # device_params={'name': 'iosxr'}
+    # With more than one job, label each sample with the job it's from.
     #
-    def unknown_host_cb(host, fingerprint):
-        return True
-    m =  manager.connect(host=args.host,
-                         port=args.port,
-                         username=args.username,
-                         password=args.password,
-                         allow_agent=False,
-                         look_for_keys=False,
-                         hostkey_verify=False,
-                         unknown_host_cb=unknown_host_cb)
-
-    # if args.get_oper:
-    #     if args.xpath:
-    #         while True:
-    #             get(m, xpath=args.xpath)
-    #             time.sleep(args.cadence)
-    #     elif args.subtree:
-    #         get(m, filter=args.subtree)
-    #     else:
-    #         print("Need to have a filter!")
-    #         sys.exit(1)
-    kw = {}
-    if args.xpath:
-        kw['xpath'] = args.xpath
-    elif args.subtree:
-        kw['filter'] = args.subtree
-    while True:
-        st = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
-        result = get(m, **kw)
-        if not args.display_tags:
-            print(st)
-            print etree.tostring(etree.fromstring(result.data_xml), pretty_print=True)
-        else:
-            values = []
-            for p in args.display_tags:
-                try:
-                    p_val = BeautifulSoup(
-                        result.xml,
-                        convertEntities=BeautifulSoup.HTML_ENTITIES).find(p).getText()
-                    values.append(p+"="+p_val)
-                except AttributeError as e:
-                    values.append(p+"=<not_found>")
-            print("{}: {}".format(st, ", ".join(values)))
-        time.sleep(args.cadence)
+    lock = threading.Lock()
+    tracker = RateTracker()
+    def on_sample(job, timestamp, result):
+        rates = []
+        if job.rates:
+            rates = tracker.update(job, timestamp, counter_values(result.data_ele, job.rates))
+        found = {}
+        if job.display_tags:
+            found = display_values(result.data_ele, job.display_tags)
+
+        #
+        # Sinks get typed fields rather than formatted text.
+        #
+        if sinks:
+            tags = {'job': job.name, 'host': job.device['host']}
+            samples = []
+            if found:
+                samples.append(Sample(timestamp, job.measurement, tags,
+                                      dict((p, typed(v)) for (p, v) in found.items())))
+            for (key, value, delta, rate) in rates:
+                samples.append(Sample(timestamp, job.measurement, dict(tags, key=key),
+                                      {'value': value, 'delta': delta, 'rate': rate}))
+            for sink in sinks:
+                for sample in samples:
+                    sink.add(sample)
+            return
+
+        st = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        if len(jobs) > 1:
+            st = '%s %s' % (st, job.name)
+        lines = []
+        for (key, value, delta, rate) in rates:
+            lines.append("{}: {} value={} delta={} rate={}".format(
+                st, key, value,
+                '-' if delta is None else delta,
+                '-' if rate is None else '%.2f/s' % rate))
+        if job.display_tags:
+            values = [p+"="+found.get(p, "<not_found>") for p in job.display_tags]
+            lines.append("{}: {}".format(st, ", ".join(values)))
+        if not lines:
+            lines.append('%s\n%s' % (st, etree.tostring(result.data_ele, pretty_print=True)))
+        text = '\n'.join(lines)
+        with lock:
+            print(text)
+            sys.stdout.flush()
+
+    def on_error(job, timestamp, e):
+        with lock:
+            print >>sys.stderr, '%s: %s failed: %s' % (
+                datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+                job.name, e)
+
+    poller = Poller(jobs, on_sample, on_error=on_error, workers=args.workers)
+    try:
+        poller.run(duration=args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.close()
+        for sink in sinks:
+            sink.close()
+        poller.report()
@@ -3,6 +3,7 @@ import sys
 import os
 from argparse import ArgumentParser
 from ncclient import manager
+from ncclient.operations.rpc import RPCError
 from jinja2 import Environment
 from jinja2.exceptions import UndefinedError
 from jinja2 import meta
@@ -12,7 +13,23 @@ from jinja2 import Template
 from lxml import etree
 import logging
 import json
+import itertools
+import ncc_archive
+import ncc_capstore
+import ncc_config
+import ncc_convert
+import ncc_hosts
+import ncc_output
+import ncc_stats
+import ncc_templates
 import re
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 #
 # Add things people want logged here. Just various netconf things for
@@ -30,12 +47,11 @@ LOGGING_TO_ENABLE = [
 #
 NC_WRITABLE_RUNNING = 'urn:ietf:params:netconf:capability:writable-running:1.0'
 NC_CANDIDATE = 'urn:ietf:params:netconf:capability:candidate:1.0'
-
-#
-# By default, don't support writeable-running or candidate configs
-#
-RUNNING = False
-CANDIDATE = False
+NC_CONFIRMED_COMMIT_1_1 = 'urn:ietf:params:netconf:capability:confirmed-commit:1.1'
+NC_CONFIRMED_COMMIT = [
+    'urn:ietf:params:netconf:capability:confirmed-commit:1.0',
+    NC_CONFIRMED_COMMIT_1_1,
+]
 
 #
 # Get where the script is; we will use this to find snippets for
@@ -43,9 +59,10 @@ CANDIDATE = False
 #
 NCC_DIR, _ = os.path.split(os.path.realpath(__file__))
 
-def display_capabilities(m):
+def display_capabilities(m, out=None):
     """Display the capabilities in a useful, categorized way.
     """
+    out = out or sys.stdout
     ietf_netconf_caps = []
     ietf_models = []
     openconfig_models = []
@@ -61,7 +78,7 @@ def display_capabilities(m):
         if m:
             module_list.append('%s (%s)' % (m.group(2), m.group(1)))
         else:
-            print('UNMATCHED model: %s' % c)
+            out.write('UNMATCHED model: %s\n' % c)
 
     # pre-process capabilities, split into various categories
     ns_to_list = [
@@ -91,7 +108,7 @@ def display_capabilities(m):
                     matched = True
                     break
         if matched==False:
-            print(c)
+            out.write('%s\n' % c)
 
     # now print them
     list_to_heading = [
@@ -105,104 +122,626 @@ def display_capabilities(m):
     ]
     for (l, h) in list_to_heading:
         if len(l) > 0:
-            print(h)
+            out.write('%s\n' % h)
             for s in l:
-                print('\t%s' % s)
+                out.write('\t%s\n' % s)
 
 
-def query_model_support(m, re_module):
+def query_model_support(m, re_module, revision=None):
     """Search the capabilities for one or more models that match the provided
-    regex.
+    regex, and revision if given.
     """
     matches = []
-    re_model = '^([^\?]+)\?module=([^&]+)&?'
     for c in m.server_capabilities:
-        m = re.search(re_model, c)
-        if m:
-            model = m.group(2)
-            match = re.search(re_module, model)
-            if match:
-                matches.append(model)
+        p = ncc_capstore.parse_capability(c)
+        if p and re.search(re_module, p['module']):
+            if revision is None or p['revision'] == revision:
+                matches.append(p['module'])
     return matches
 
-def list_templates(header, source_env):
+
+class StoredCapabilities(object):
+    """Capabilities from the store, for display_capabilities().
+    """
+    def __init__(self, server_capabilities):
+        self.server_capabilities = server_capabilities
+
+
+def query_store(store, args, devices=None, out=None):
+    """Answer --capabilities or --is-supported from the capability store
+    for every device in it, or just those given, without connecting to
+    any of them.
+    """
+    out = out or sys.stdout
+    if args.capabilities:
+        for (device, updated) in store.devices(devices):
+            out.write('=== %s as of %s ===\n' % (
+                device, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(updated))))
+            display_capabilities(StoredCapabilities(store.capabilities(device)), out=out)
+    else:
+        for (device, module, revision) in store.query(args.is_supported, args.revision, devices):
+            out.write('%s\t%s\t%s\n' % (device, module, revision or ''))
+
+def list_templates(header, source_env, cache_dir=None):
     """List out all the templates in the provided environment, parse them
     and extract variables that should be provided.
     UPDATED To present the VARS as JSON dict with enpty values
+    UPDATED The variables are cached, so only changed templates get parsed
     """
     print(header)
-    env = Environment()
-    for tname in sorted(source_env.list_templates()):
-        tfile = source_env.get_template(tname).filename
-        with open(tfile, 'r') as f:
-            vars = meta.find_undeclared_variables(env.parse(f.read()))
-            f.close()
-            print("  {}".format(tname.replace('.tmpl', ''))),
-            if vars:
-                print ":{",
-                #for v in sorted(vars):
-                #    print('"%s" : ""' % v),
-                print ','.join(['"%s" : ""' %v for v in sorted(vars)]) ,
-                print "}"
-            else:
-                print
+    for (tname, vars) in ncc_templates.template_variables(source_env, cache_dir):
+        print("  {}".format(tname.replace('.tmpl', ''))),
+        if vars:
+            print ":{",
+            #for v in sorted(vars):
+            #    print('"%s" : ""' % v),
+            print ','.join(['"%s" : ""' %v for v in sorted(vars)]) ,
+            print "}"
+        else:
+            print
 
 
-def do_templates(m, t_list, default_op='merge', **kwargs):
-    """Execute a list of templates, using the kwargs passed in to
-    complete the rendering.
+def render_templates(t_list, **kwargs):
+    """Render a list of templates, using the kwargs passed in to complete
+    the rendering. All templates are rendered before any are sent, so a
+    missing variable fails the run before the device is touched.
     """
-
+    rendered = []
     for tmpl in t_list:
         try:
-            data = tmpl.render(kwargs)
+            with ncc_stats.span('render', tmpl.name) as s:
+                rendered.append(tmpl.render(kwargs))
+                s['bytes'] = len(rendered[-1])
         except UndefinedError as e:
             print "Undefined variable %s.  Use --params to specify json dict" % e.message
             # assuming we should fail if a single template fails?
             exit(1)
+    return rendered
+
+
+def is_rpc_error(e):
+    """Whether e is the device rejecting an RPC, directly or through
+    nccd.py.
+    """
+    return isinstance(e, RPCError) or getattr(e, 'kind', None) == 'RPCError'
 
-        if CANDIDATE:
-            m.edit_config(data,
-                          format='xml',
-                          target='candidate',
-                          default_operation=default_op)
-        elif RUNNING:
-            m.edit_config(data,
-                          format='xml',
-                          target='running',
-                          default_operation=default_op)
-    if CANDIDATE:
+
+def diff_running(m, config, list_keys=None):
+    """Return what of a rendered config differs from the running config,
+    or None if the device already has it all. A config that can't be
+    parsed is returned as is.
+    """
+    try:
+        with ncc_stats.span('diff', 'parse'):
+            desired = ncc_config.parse(config)
+    except ncc_config.MergeConflict:
+        return config
+    c = m.get_config(source='running', filter=ncc_config.subtree_filter(desired, list_keys))
+    with ncc_stats.span('diff', 'compare'):
+        return ncc_config.diff_config(desired, c.data, list_keys)
+
+
+def send_edits(m, rendered, target, default_op='merge', batch_edits=False, can_discard=False,
+               diff=False, list_keys=None):
+    """Send rendered templates to the target datastore, merged into a
+    single edit-config if batch_edits and they can be, and cut down to
+    what differs from the running config if diff. If the device rejects
+    a merged edit and can_discard, the candidate is discarded and the
+    edits sent separately. Returns the number of edit-configs sent.
+    """
+    def edit(data):
+        if diff:
+            data = diff_running(m, data, list_keys)
+            if data is None:
+                return 0
+        m.edit_config(data,
+                      format='xml',
+                      target=target,
+                      default_operation=default_op)
+        return 1
+
+    if batch_edits and len(rendered) > 1:
+        try:
+            with ncc_stats.span('merge', 'edits', count=len(rendered)):
+                merged = ncc_config.merge_configs(rendered)
+        except ncc_config.MergeConflict as e:
+            sys.stderr.write("Can't merge edits (%s), sending them one at a time\n" % e)
+        else:
+            try:
+                return edit(merged)
+            except Exception as e:
+                #
+                # The merge works without the schema, so it can get a
+                # container and a list wrong. If the device rejects the
+                # merged edit before anything is committed, throw it away
+                # and send the edits separately.
+                #
+                if not can_discard or not is_rpc_error(e):
+                    raise
+                sys.stderr.write("Merged edit rejected (%s), sending edits one at a time\n" % e)
+                m.discard_changes()
+
+    return sum(edit(data) for data in rendered)
+
+
+def do_templates(m, t_list, default_op='merge', batch_edits=False,
+                 params_stream=None, chunk_size=500, diff=False, list_keys=None,
+                 commit=True, rendered=None, **kwargs):
+    """Execute a list of templates, using the kwargs passed in to
+    complete the rendering. With batch_edits, the rendered templates are
+    merged into a single edit-config where possible. With params_stream,
+    the templates are rendered for each row of parameters in that file
+    and sent merged, chunk_size rows to an edit-config; if a later row
+    fails to render, anything already sent to the candidate is discarded.
+    Templates already rendered may be passed in as rendered. With diff, only
+    what differs from the running config is sent, and nothing is
+    committed if nothing differs. Without commit, committing the
+    candidate is left to the caller. Returns the number of edit-configs
+    sent.
+    """
+    candidate = NC_CANDIDATE in m.server_capabilities
+    running = NC_WRITABLE_RUNNING in m.server_capabilities
+    if not candidate and not running:
+        return 0
+    target = 'candidate' if candidate else 'running'
+
+    sent = 0
+    if params_stream:
+        rows = ncc_templates.param_rows(params_stream)
+        rendered = ncc_templates.render_rows(t_list, rows, kwargs)
+        chunks = ncc_templates.chunked(rendered, chunk_size * len(t_list))
+        try:
+            for chunk in ncc_stats.timed_iter('render', 'params-stream', chunks):
+                sent += send_edits(m, chunk, target, default_op, True, candidate and sent == 0,
+                                   diff, list_keys)
+        except (UndefinedError, IOError, ValueError):
+            if candidate and sent:
+                m.discard_changes()
+            raise
+    else:
+        if rendered is None:
+            rendered = render_templates(t_list, **kwargs)
+        sent = send_edits(m, rendered, target, default_op,
+                          batch_edits, candidate, diff, list_keys)
+    if commit and candidate and (sent or not diff):
         m.commit()
+    return sent
+
+
+class ConfirmedCommitError(Exception):
+    """A device can't do a confirmed commit, or the change it committed
+    failed verification and was rolled back.
+    """
+    pass
 
 
-def get_running_config(m, filter=None, xpath=None):
+def verify(m, filter=None, xpath=None, wait=0):
+    """Whether a get with the filter returns any data, trying again once
+    a second for up to wait seconds to give the device's state time to
+    settle.
+    """
+    deadline = time.time() + wait
+    while True:
+        if filter:
+            c = m.get(filter=('subtree', filter))
+        else:
+            c = m.get(filter=('xpath', xpath))
+        if c.data_ele is not None and len(c.data_ele) > 0:
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(1)
+
+
+def push_edits(m, args, named_templates, kwargs, out):
+    """Send the --do-edits templates and commit them. With
+    --confirm-timeout, the commit is a confirmed commit, and what
+    confirm_edits needs to verify and confirm it is returned: when it was
+    committed and, if the device can persist it, its persist token, so
+    that a confirm sent after the device has rolled back fails rather
+    than committing the reverted candidate. Otherwise returns None.
+    """
+    caps = m.server_capabilities
+    if args.confirm_timeout:
+        if NC_CANDIDATE not in caps or not [c for c in NC_CONFIRMED_COMMIT if c in caps]:
+            raise ConfirmedCommitError("device doesn't support confirmed commit of the candidate")
+    sent = do_templates( m,
+                         [named_templates.get_template('%s.tmpl' % t) for t in args.do_edits],
+                         default_op=args.default_op,
+                         batch_edits=args.batch_edits,
+                         params_stream=args.params_stream,
+                         chunk_size=args.chunk_size,
+                         diff=args.diff,
+                         list_keys=args.list_keys,
+                         commit=not args.confirm_timeout,
+                         rendered=args.rendered,
+                         **kwargs)
+    if args.diff:
+        if sent:
+            out.write('Sent %d edit-config(s) of changes\n' % sent)
+        else:
+            out.write('In sync, nothing sent\n')
+    if args.confirm_timeout and (sent or not args.diff):
+        persist = uuid.uuid4().hex if NC_CONFIRMED_COMMIT_1_1 in caps else None
+        #
+        # Time the confirm timeout from before the commit is sent, so we
+        # never think there is longer left than the device does.
+        #
+        pending = {'committed': time.time(), 'persist': persist}
+        m.commit(confirmed=True, timeout=str(args.confirm_timeout), persist=persist)
+        out.write('Committed, to be confirmed within %ds\n' % args.confirm_timeout)
+        return pending
+    return None
+
+
+def cancel_commit(m, persist=None):
+    """Cancel a confirmed commit if the session still allows; if it
+    doesn't, the device rolls back when the confirm timeout runs out (or
+    the session goes, for a commit without persist) anyway.
+    """
+    try:
+        if persist:
+            m.cancel_commit(persist_id=persist)
+        else:
+            m.cancel_commit()
+    except Exception as e:
+        sys.stderr.write("Can't cancel commit (%s), leaving it to time out\n" % e)
+
+
+def confirm_edits(m, args, out, pending):
+    """Verify a confirmed commit made by push_edits with a get using the
+    --filter, --named-filter or --xpath filter, confirming it if the get
+    returns any data, else cancelling it so the device rolls back at
+    once. Raises ConfirmedCommitError if the commit was rolled back,
+    including by the confirm timeout running out first.
+    """
+    persist = pending['persist']
+    expired = ConfirmedCommitError('confirm timeout ran out before verifying, device has rolled back')
+    if time.time() - pending['committed'] >= args.confirm_timeout:
+        raise expired
+    try:
+        with ncc_stats.span('verify', 'get'):
+            ok = verify(m, args.filter, args.xpath, args.verify_wait)
+    except Exception:
+        cancel_commit(m, persist)
+        raise
+    if not ok:
+        cancel_commit(m, persist)
+        raise ConfirmedCommitError('verification get returned no data, commit cancelled')
+    if time.time() - pending['committed'] >= args.confirm_timeout:
+        raise expired
+    if persist:
+        m.commit(persist_id=persist)
+    else:
+        m.commit()
+    out.write('Verified, commit confirmed\n')
+
+
+def write_data(data, out, fmt=None, schema_dir=None):
+    """Write reply data, pretty-printed in one go by default, or streamed
+    out in the given format, which for the ncc_convert formats is typed
+    by the YANG modules in schema_dir.
+    """
+    with ncc_stats.span('serialize', fmt or 'xml') as s:
+        if fmt in ncc_convert.FORMATS:
+            ncc_convert.write(data, out, fmt, schema_dir)
+        elif fmt:
+            ncc_output.write(data, out, fmt)
+        else:
+            text = etree.tostring(data, pretty_print=True)
+            s['bytes'] = len(text)
+            out.write('%s\n' % text)
+
+
+def running_config(m, filter=None, xpath=None):
     """Get running config with a passed in filter. If both types of
     filter are passed in for some reason, the subtree filter "wins".
     """
-    import time
     if filter and len(filter) > 0:
-        c = m.get_config(source='running', filter=('subtree', filter))
+        return m.get_config(source='running', filter=('subtree', filter))
     elif xpath and len(xpath)>0:
-        c = m.get_config(source='running', filter=('xpath', xpath))
-    else:
-        c = m.get_config(source='running')
-    print(etree.tostring(c.data, pretty_print=True))
+        return m.get_config(source='running', filter=('xpath', xpath))
+    return m.get_config(source='running')
+
+
+def get_running_config(m, filter=None, xpath=None, out=None, fmt=None, schema_dir=None):
+    """Get running config and write it out.
+    """
+    out = out or sys.stdout
+    write_data(running_config(m, filter, xpath).data, out, fmt, schema_dir)
+
+
+def archive_running_config(m, archive, host, port, filter=None, xpath=None, out=None):
+    """Get running config and record it as a snapshot in the archive.
+    """
+    out = out or sys.stdout
+    data = running_config(m, filter, xpath).data
+    with ncc_stats.span('archive', 'store', host=host) as s:
+        manifest, written = archive.store(host, port, data)
+        s['bytes'] = written
+    out.write('Archived %s as %s: %d chunks, %d bytes written\n' % (
+        manifest['device'], manifest['id'], len(manifest['chunks']), written))
         
         
-def get(m, filter=None, xpath=None):
+def get(m, filter=None, xpath=None, out=None, fmt=None, schema_dir=None):
     """Get state with a passed in filter. If both types of filter are
     passed in for some reason, the subtree filter "wins".
     """
+    out = out or sys.stdout
     if filter and len(filter) > 0:
         c = m.get(filter=('subtree', filter))
     elif xpath and len(xpath)>0:
         c = m.get(filter=('xpath', xpath))
     else:
-        print("Need a filter for oper get!")
+        out.write("Need a filter for oper get!\n")
         return
-    print(etree.tostring(c.data, pretty_print=True))
-        
-        
+    write_data(c.data, out, fmt, schema_dir)
+
+
+def connect(host, port, username, password, timeout, via_daemon=None):
+    """Connect to a device, ignoring host keys just like all the other
+    scripts here do. If via_daemon is the path of an nccd.py socket,
+    return a proxy that forwards operations to a pooled session in the
+    daemon instead.
+    """
+    if via_daemon:
+        import nccd
+        with ncc_stats.span('connect', 'daemon', host=host):
+            m = nccd.DaemonManager(via_daemon, host, port, username, password, timeout)
+        return ncc_stats.timed(m, host)
+
+    #
+    # Could use this extra param instead of the last four arguments
+    # specified below:
+    #
+    # device_params={'name': 'iosxr'}
+    #
+    def unknown_host_cb(host, fingerprint):
+        return True
+    #
+    # The SSH setup and the NETCONF hello both happen inside
+    # manager.connect(), so they are timed as one.
+    #
+    with ncc_stats.span('connect', 'ssh+hello', host=host):
+        m = manager.connect(host=host,
+                            port=port,
+                            timeout=timeout,
+                            username=username,
+                            password=password,
+                            allow_agent=False,
+                            look_for_keys=False,
+                            hostkey_verify=False,
+                            unknown_host_cb=unknown_host_cb)
+    return ncc_stats.timed(m, host)
+
+
+def close(m):
+    """Orderly teardown of the netconf session.
+    Ignore Value error sometimes returned in cleanup
+    """
+    try:
+        m.close_session()
+    except ValueError:
+        pass
+
+
+def record_capabilities(store, host, port, m):
+    """Record a device's capabilities in the capability store, if there
+    is one, warning rather than failing if they can't be.
+    """
+    if not store:
+        return
+    try:
+        store.record(host, port, m.server_capabilities)
+    except Exception as e:
+        sys.stderr.write("Can't record capabilities of %s:%s: %s\n" % (host, port, e))
+
+
+def do_operation(m, args, named_templates, kwargs, out=None, host=None, port=None):
+    """Run the single operation selected on the command line against an
+    already connected device, writing any output to out, or to the
+    --output file if given for gets. The device's capabilities are
+    recorded in the capability store afterwards.
+    """
+    out = out or sys.stdout
+    try:
+        if args.get_running and args.archive:
+            archive_running_config(m, args.archive, host or args.host, port or args.port,
+                                   filter=args.filter, xpath=args.xpath, out=out)
+        elif args.get_running or args.get_oper:
+            if args.output:
+                f = open(args.output.format(host=host or args.host, port=port or args.port), 'wb')
+            else:
+                f = out
+            try:
+                if args.get_running:
+                    get_running_config(m, xpath=args.xpath, filter=args.filter,
+                                       out=f, fmt=args.format, schema_dir=args.schema_dir)
+                else:
+                    get(m, filter=args.filter, xpath=args.xpath, out=f, fmt=args.format,
+                        schema_dir=args.schema_dir)
+            finally:
+                if f is not out:
+                    f.close()
+        elif args.do_edits:
+            pending = push_edits(m, args, named_templates, kwargs, out)
+            if pending:
+                confirm_edits(m, args, out, pending)
+        elif args.capabilities:
+            display_capabilities(m, out=out)
+        elif args.is_supported:
+            models = query_model_support(m, args.is_supported, args.revision)
+            for model in models:
+                out.write('%s\n' % model)
+    finally:
+        record_capabilities(args.store, host or args.host, port or args.port, m)
+
+
+def run_on_hosts(hosts, workers, args, named_templates, kwargs):
+    """Run the selected operation against every device in the inventory
+    using a bounded pool of worker threads. Each device's output is
+    buffered and printed as a block when that device completes, followed
+    by a summary of successes, failures and latencies. Returns the
+    number of devices that failed.
+    """
+    def run_one(h):
+        out = StringIO()
+        start = time.time()
+        try:
+            m = connect(h['host'], h['port'], h['username'], h['password'], h['timeout'],
+                        via_daemon=args.via_daemon)
+            try:
+                do_operation(m, args, named_templates, kwargs, out=out,
+                             host=h['host'], port=h['port'])
+            finally:
+                close(m)
+            return (h, True, time.time() - start, out.getvalue())
+        except Exception as e:
+            return (h, False, time.time() - start, '%s%s: %s\n' % (
+                out.getvalue(), e.__class__.__name__, e))
+
+    start = time.time()
+    ok = []
+    failed = []
+    pool = ThreadPool(max(1, min(workers, len(hosts))))
+    try:
+        for (h, success, elapsed, output) in pool.imap_unordered(run_one, hosts):
+            print('=== %s:%d %s in %.2fs ===' % (
+                h['host'], h['port'], 'OK' if success else 'FAILED', elapsed))
+            sys.stdout.write(output)
+            (ok if success else failed).append((h, elapsed))
+    finally:
+        pool.close()
+        pool.join()
+    wall = time.time() - start
+
+    latencies = sorted(e for (_, e) in ok + failed)
+    print('=== Summary ===')
+    print('Devices: %d, succeeded: %d, failed: %d, workers: %d, wall time %.2fs' % (
+        len(hosts), len(ok), len(failed), workers, wall))
+    if latencies:
+        print('Latency: min %.2fs, avg %.2fs, p95 %.2fs, max %.2fs' % (
+            latencies[0],
+            sum(latencies) / len(latencies),
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            latencies[-1]))
+    for (h, _) in failed:
+        print('\tFAILED: %s:%d' % (h['host'], h['port']))
+    return len(failed)
+
+
+def run_rollout(hosts, workers, batch_size, args, named_templates, kwargs):
+    """Push --confirm-timeout edits to the devices in the inventory in
+    batches of batch_size, verifying and confirming each batch while the
+    next is pushed, with up to workers devices being pushed to and up to
+    workers being verified at once. At the first batch with a failure the
+    rollout stops: the commits of the batch already pushed after it are
+    cancelled, and later batches aren't touched. Returns the number of
+    devices that didn't end up with the change confirmed.
+    """
+    def push(h):
+        out = StringIO()
+        start = time.time()
+        m = None
+        try:
+            m = connect(h['host'], h['port'], h['username'], h['password'], h['timeout'],
+                        via_daemon=args.via_daemon)
+            try:
+                pending = push_edits(m, args, named_templates, kwargs, out)
+            finally:
+                record_capabilities(args.store, h['host'], h['port'], m)
+            return (h, m, pending, start, out, None)
+        except Exception as e:
+            if m is not None:
+                close(m)
+            return (h, None, None, start, out, e)
+
+    def settle(pushed, go):
+        (h, m, pending, start, out, error) = pushed
+        state = 'OK'
+        if m is not None:
+            try:
+                if pending and go:
+                    confirm_edits(m, args, out, pending)
+                elif pending:
+                    cancel_commit(m, pending['persist'])
+                    out.write('Commit cancelled, as an earlier batch failed\n')
+                    state = 'ROLLED BACK'
+            except Exception as e:
+                error = e
+            finally:
+                close(m)
+        if error is not None:
+            state = 'FAILED'
+            out.write('%s: %s\n' % (error.__class__.__name__, error))
+        return (h, state, time.time() - start, out.getvalue())
+
+    def report(results):
+        for (h, state, elapsed, output) in results:
+            print('=== %s:%d %s in %.2fs ===' % (h['host'], h['port'], state, elapsed))
+            sys.stdout.write(output)
+            done.setdefault(state, []).append((h, elapsed))
+            yield state
+
+    batches = [hosts[i:i + batch_size] for i in range(0, len(hosts), batch_size)]
+    start = time.time()
+    done = {}
+    skipped = []
+    size = max(1, min(workers, len(hosts)))
+    pushers = ThreadPool(size)
+    verifiers = ThreadPool(size)
+    try:
+        pending = pushers.map_async(push, batches[0]) if batches else None
+        for i in range(len(batches)):
+            pushed = pending.get()
+            pending = None
+            if i + 1 < len(batches):
+                pending = pushers.map_async(push, batches[i + 1])
+            states = list(report(verifiers.imap_unordered(lambda p: settle(p, True), pushed)))
+            if 'FAILED' in states:
+                print('=== Batch %d of %d failed, stopping ===' % (i + 1, len(batches)))
+                if pending is not None:
+                    list(report(verifiers.imap_unordered(lambda p: settle(p, False), pending.get())))
+                skipped = [h for b in batches[i + 2:] for h in b]
+                break
+    finally:
+        pushers.close()
+        verifiers.close()
+        pushers.join()
+        verifiers.join()
+    wall = time.time() - start
+
+    latencies = sorted(e for results in done.values() for (_, e) in results)
+    failed = done.get('FAILED', [])
+    print('=== Summary ===')
+    print('Devices: %d, confirmed: %d, failed: %d, rolled back: %d, not pushed: %d, batches of %d, wall time %.2fs' % (
+        len(hosts), len(done.get('OK', [])), len(failed), len(done.get('ROLLED BACK', [])),
+        len(skipped), batch_size, wall))
+    if latencies:
+        print('Latency: min %.2fs, avg %.2fs, p95 %.2fs, max %.2fs' % (
+            latencies[0],
+            sum(latencies) / len(latencies),
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            latencies[-1]))
+    for (h, _) in failed:
+        print('\tFAILED: %s:%d' % (h['host'], h['port']))
+    return len(hosts) - len(done.get('OK', []))
+
+
+def report_stats(args):
+    """Write out whatever timings were asked for.
+    """
+    r = ncc_stats.recorder()
+    if r is None:
+        return
+    if args.stats:
+        r.summary(sys.stderr)
+    if args.trace:
+        r.write_trace(args.trace)
+    if args.prometheus:
+        r.write_prometheus(args.prometheus)
+
+
 if __name__ == '__main__':
 
     parser = ArgumentParser(description='Select your NETCONF operation and parameters:')
@@ -222,17 +761,70 @@ if __name__ == '__main__':
                         help="NETCONF operation timeout in seconds (default 60)")
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="Exceedingly verbose logging to the console")
+    parser.add_argument('--stats', action='store_true',
+                        help="Time connecting, every RPC, parsing replies, rendering templates and writing output, and print a summary of where the time went to stderr at the end")
+    parser.add_argument('--trace', type=str,
+                        help="Write those timings to this file in the Chrome trace event format, to be loaded in chrome://tracing or Perfetto")
+    parser.add_argument('--prometheus', type=str,
+                        help="Write those timings to this file in the Prometheus text exposition format, say for a node exporter textfile collector")
     parser.add_argument('--default-op', type=str, default='merge',
                         help="The NETCONF default operation to use (default 'merge')")
+    parser.add_argument('--batch-edits', action='store_true',
+                        help="Merge the templates given to --do-edits into a single edit-config, falling back to one edit-config per template if they can't be merged safely")
+    parser.add_argument('--diff', action='store_true',
+                        help="Fetch the running config the --do-edits templates touch and send only what differs, committing nothing if the device is already in sync; only with the default 'merge' default operation")
+    parser.add_argument('--confirm-timeout', type=int,
+                        help="With --do-edits, make the commit a confirmed commit that the device rolls back unless it is confirmed within this many seconds, then verify the change with a get using the -f, --named-filter or -x filter, confirming the commit if the get returns any data and cancelling it, rolling back at once, if not; needs candidate and confirmed-commit support")
+    parser.add_argument('--verify-wait', type=int, default=0,
+                        help="Repeat the --confirm-timeout verification get once a second for up to this many seconds until it returns data, to give the device's state time to settle (default 0, get once)")
+    parser.add_argument('--rollout-batch', type=int,
+                        help="With --confirm-timeout and --hosts-file, push to the devices this many at a time (default --workers), verifying each batch while pushing the next, and stop at the first batch with a failure, cancelling the commits of the batch pushed after it; the confirm timeout must allow for verifying the batch before, as a device whose timeout runs out first fails")
+    parser.add_argument('--schema-dir', type=str,
+                        help="Directory of YANG modules, such as downloaded by ncc-get-all-schema.py, to take list keys from for --diff (without it the first leaf of a list entry is taken to be its key) and types from for the rfc7951 and columnar formats")
 
     parser.add_argument('-w', '--where', action='store_true',
                         help="Print where script is and exit")
 
+    #
+    # Fan out across many devices rather than just --host
+    #
+    parser.add_argument('--hosts-file', type=str,
+                        help="File listing devices to run the operation against, either a JSON list of \"host[:port]\" strings or dicts overriding host, port, username, password and timeout, or plain text with one host[:port] per line")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Number of devices to work on concurrently with --hosts-file (default 8)")
+    parser.add_argument('--via-daemon', type=str, nargs='?',
+                        const=os.environ.get('NCC_DAEMON_SOCKET', '/tmp/nccd-%s.sock' % os.environ.get('USER', 'ncc')),
+                        help="Forward operations to pooled sessions in a running nccd.py listening on this socket (default $NCC_DAEMON_SOCKET or /tmp/nccd-$USER.sock)")
+
+    #
+    # Where capabilities are indexed
+    #
+    parser.add_argument('--capability-store', type=str, default=ncc_capstore.DEFAULT_STORE,
+                        help="SQLite database in which the capabilities of every device connected to are recorded (default $NCC_CAPABILITY_STORE or capabilities.db in $NCC_CACHE or ~/.cache/ncc)")
+    parser.add_argument('--no-capability-store', action='store_true',
+                        help="Don't record capabilities in the capability store")
+    parser.add_argument('--from-store', action='store_true',
+                        help="Answer --capabilities or --is-supported from the capability store, for every device in it or just those in --hosts-file, without connecting to any of them")
+    parser.add_argument('--revision', type=str,
+                        help="With --is-supported, only match modules at this revision")
+
+    #
+    # Where and how get and get-config replies are written
+    #
+    parser.add_argument('--output', type=str,
+                        help="Stream the reply of a get or get-config to this file rather than printing it; {host} and {port} are replaced by the device's, which is required with --hosts-file")
+    parser.add_argument('--format', type=str, choices=ncc_output.FORMATS + ncc_convert.FORMATS,
+                        help="Stream the reply of a get or get-config in this format, NDJSON giving one record per list entry, or, typed by the YANG modules in --schema-dir, RFC 7951 JSON or columnar JSON with a table of columns per YANG list (default pretty-printed XML)")
+    parser.add_argument('--archive', type=str,
+                        help="Rather than writing out the reply of --get-running, record it as a snapshot in this archive directory, storing only the top-level containers that have changed since any snapshot already there; see ncc-archive.py")
+
     #
     # Where we want to source snippets from
     #
     parser.add_argument('--snippets', type=str, default=os.environ.get('NCC_SNIPPETS', "%s/snippets" % NCC_DIR),
                         help="Directory where 'snippets' can be found; default is location of script")
+    parser.add_argument('--no-template-cache', action='store_true',
+                        help="Don't cache compiled snippets and their variables (by default cached in $NCC_CACHE or ~/.cache/ncc)")
 
     #
     # Various operation parameters. These will be put into a kwargs
@@ -242,6 +834,10 @@ if __name__ == '__main__':
                         help="JSON-encoded string of parameters dictionaryfor templates")
     parser.add_argument('--params-file', type=str,
                         help="JSON-encoded file of parameters dictionary for templates")
+    parser.add_argument('--params-stream', type=str,
+                        help="With --do-edits, render the templates once for each row of parameters in this file, which is either CSV (if named *.csv) with a header row naming the parameters, or NDJSON with a JSON dict per line; any --params or --params-file parameters are defaults for every row")
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help="Number of --params-stream rows to merge into each edit-config (default 500)")
     #
     # Only one type of filter allowed.
     #
@@ -280,22 +876,43 @@ if __name__ == '__main__':
     #
     # Setup the templates for use.
     #
-    named_filters = Environment(loader=FileSystemLoader(
-        '%s/filters' % args.snippets),
-        undefined=StrictUndefined)
-    named_templates = Environment(loader=FileSystemLoader(
-        '%s/editconfigs' % args.snippets),
-        undefined = StrictUndefined)
+    cache_dir = None if args.no_template_cache else ncc_templates.CACHE_DIR
+    named_filters = ncc_templates.environment('%s/filters' % args.snippets, cache_dir)
+    named_templates = ncc_templates.environment('%s/editconfigs' % args.snippets, cache_dir)
 
     #
     # Do the named template/filter listing first, then exit.
     #
     if args.list_templates:
-        list_templates("Edit-config templates:", named_templates)
+        list_templates("Edit-config templates:", named_templates, cache_dir)
         sys.exit(0)
     elif args.list_filters:
-        list_templates("Named filters:", named_filters)
+        list_templates("Named filters:", named_filters, cache_dir)
+        sys.exit(0)
+
+    #
+    # Open the capability store, answering from it and exiting if asked
+    # to. Not being able to record capabilities shouldn't stop anything
+    # else working.
+    #
+    args.store = None
+    if args.from_store:
+        if not (args.capabilities or args.is_supported):
+            print("--from-store only applies to --capabilities and --is-supported")
+            sys.exit(1)
+        args.store = ncc_capstore.CapabilityStore(args.capability_store)
+        devices = None
+        if args.hosts_file:
+            devices = ['%s:%s' % (h['host'], h['port'])
+                       for h in ncc_hosts.load_hosts_file(args.hosts_file, args)]
+        query_store(args.store, args, devices)
+        args.store.close()
         sys.exit(0)
+    if not args.no_capability_store:
+        try:
+            args.store = ncc_capstore.CapabilityStore(args.capability_store)
+        except Exception as e:
+            sys.stderr.write("Can't open capability store %s: %s\n" % (args.capability_store, e))
 
     #
     # If the user specified verbose logging, set it up.
@@ -307,6 +924,12 @@ if __name__ == '__main__':
             logger.addHandler(handler)
             logger.setLevel(logging.DEBUG)
 
+    #
+    # Lighter weight than that, just time the phases of the run.
+    #
+    if args.stats or args.trace or args.prometheus:
+        ncc_stats.enable()
+
     #
     # set up various keyword arguments that have specific arguments
     #
@@ -333,54 +956,94 @@ if __name__ == '__main__':
             exit(1)
 
     #
-    # Could use this extra param instead of the last four arguments
-    # specified below:
-    #
-    # device_params={'name': 'iosxr'}
+    # Render any edits up front so that a missing variable fails the run
+    # before any device is touched, keeping what was rendered to send.
+    # A --params-stream may be too big to render twice, so only its first
+    # row is checked here; a later row that fails fails each device as it
+    # is reached.
     #
-    def unknown_host_cb(host, fingerprint):
-        return True
-    m =  manager.connect(host=args.host,
-                         port=args.port,
-                         timeout=args.timeout,
-                         username=args.username,
-                         password=args.password,
-                         allow_agent=False,
-                         look_for_keys=False,
-                         hostkey_verify=False,
-                         unknown_host_cb=unknown_host_cb)
+    if args.diff and args.default_op != 'merge':
+        print("--diff only works with the 'merge' default operation")
+        sys.exit(1)
+    args.list_keys = None
+    if args.diff and args.schema_dir:
+        args.list_keys = ncc_config.list_keys(args.schema_dir, cache_dir)
+    if args.params_stream and not args.do_edits:
+        print("--params-stream only applies to --do-edits")
+        sys.exit(1)
+    if args.confirm_timeout and not args.do_edits:
+        print("--confirm-timeout only applies to --do-edits")
+        sys.exit(1)
+    if args.confirm_timeout and not (args.filter or args.xpath):
+        print("--confirm-timeout needs a -f, --named-filter or -x filter to verify the change with")
+        sys.exit(1)
+    if args.confirm_timeout and args.verify_wait >= args.confirm_timeout:
+        print("--verify-wait must be less than --confirm-timeout")
+        sys.exit(1)
+    args.rendered = None
+    if args.params_stream:
+        try:
+            for _ in ncc_templates.render_rows(
+                    [named_templates.get_template('%s.tmpl' % t) for t in args.do_edits],
+                    itertools.islice(ncc_templates.param_rows(args.params_stream), 1), kwargs):
+                pass
+        except UndefinedError as e:
+            print "Undefined variable %s.  Use --params-stream to specify a column or key" % e.message
+            exit(1)
+        except (IOError, ValueError) as e:
+            print "Bad --params-stream: %s" % e
+            exit(1)
+    elif args.do_edits:
+        args.rendered = render_templates(
+            [named_templates.get_template('%s.tmpl' % t) for t in args.do_edits],
+            **kwargs)
 
     #
-    # Extract the key capabilities that determine how we interact with
-    # the device. This script will prefer using candidate config.
+    # Fan out over the inventory if we have one, else just do the one
+    # device.
     #
-    if NC_WRITABLE_RUNNING in m.server_capabilities:
-        RUNNING = True
-    if NC_CANDIDATE in m.server_capabilities:
-        CANDIDATE = True
-
+    if args.format in ncc_convert.FORMATS and not args.schema_dir:
+        print("--format %s needs --schema-dir" % args.format)
+        sys.exit(1)
+    if args.archive:
+        if not args.get_running:
+            print("--archive only applies to --get-running")
+            sys.exit(1)
+        args.archive = ncc_archive.Archive(args.archive)
 
-    if args.get_running:
-        get_running_config(m, xpath=args.xpath, filter=args.filter)
+    if args.hosts_file:
+        if args.output and '{host}' not in args.output:
+            print("--output must include {host} when used with --hosts-file")
+            sys.exit(1)
+        try:
+            if args.confirm_timeout:
+                failures = run_rollout(ncc_hosts.load_hosts_file(args.hosts_file, args),
+                                       args.workers, args.rollout_batch or args.workers,
+                                       args, named_templates, kwargs)
+            else:
+                failures = run_on_hosts(ncc_hosts.load_hosts_file(args.hosts_file, args),
+                                        args.workers, args, named_templates, kwargs)
+        finally:
+            report_stats(args)
+        sys.exit(1 if failures else 0)
 
-    elif args.get_oper:
-        get(m, filter=args.filter, xpath=args.xpath)
-    elif args.do_edits:
-        do_templates( m,
-                      [named_templates.get_template('%s.tmpl' % t) for t in args.do_edits],
-                      default_op=args.default_op,
-                      **kwargs)
-    elif args.capabilities:
-        display_capabilities(m)
-    elif args.is_supported:
-        models = query_model_support(m, args.is_supported)
-        for model in models:
-            print(model)
-
-    #
-    # Orderly teardown of the netconf session.
-    # Ignore Value error sometimes returned in cleanup
     try:
-        m.close_session()
-    except ValueError:
-        pass
+        m = connect(args.host, args.port, args.username, args.password, args.timeout,
+                    via_daemon=args.via_daemon)
+        try:
+            do_operation(m, args, named_templates, kwargs)
+        finally:
+            close(m)
+    except ConfirmedCommitError as e:
+        print(e)
+        sys.exit(1)
+    except UndefinedError as e:
+        print "Undefined variable %s.  Use --params-stream to specify a column or key" % e.message
+        sys.exit(1)
+    except (IOError, ValueError) as e:
+        if not args.params_stream:
+            raise
+        print "Bad --params-stream: %s" % e
+        sys.exit(1)
+    finally:
+        report_stats(args)
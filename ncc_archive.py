@@ -0,0 +1,258 @@
+"""A content-addressed archive of running-config snapshots.
+
+Each snapshot is canonicalized and split into one chunk per top-level
+container, and each chunk is stored compressed under the SHA-256 of its
+canonical bytes. A snapshot is then just a manifest listing its chunks.
+A chunk that hasn't changed since any earlier snapshot, of this device
+or any other, is already there and isn't written again, so archiving a
+fleet nightly costs about as much as what has changed.
+
+The canonical form of a chunk is its exclusive XML C14N serialization
+with whitespace between elements dropped and the entries of every list
+sorted on their first leaf, which NETCONF puts first as the list key,
+in natural order (so sequence numbers 10, 20 and 100 stay in that
+order). The same config therefore gives the same bytes however the
+device happened to order or indent it. Everything else, including the
+order of distinct sibling containers, is kept as it is.
+
+The layout on disk is:
+
+  objects/ab/cdef...            zlib-compressed chunks, by SHA-256
+  snapshots/HOST_PORT/ID.json   manifests, ID being the UTC time taken
+
+Manifests are written after the chunks they list, and every file is
+written to a temporary name and renamed into place, so a snapshot
+that has been recorded is always complete, and several processes can
+archive into the same directory at once.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import difflib
+import hashlib
+import threading
+from lxml import etree
+from ncc_output import elements
+
+NC_NS = 'urn:ietf:params:xml:ns:netconf:base:1.0'
+
+
+def natural(value):
+    """A sort key ordering the runs of digits in value numerically.
+    """
+    return [(0, int(p), '') if p.isdigit() else (1, 0, p) for p in re.split(r'(\d+)', value) if p]
+
+
+def c14n(e):
+    """The exclusive C14N serialization of e, keeping the declarations
+    of prefixes used in the values of leaves, such as identities, which
+    it would otherwise drop as unused.
+    """
+    prefixes = set()
+    for leaf in e.iter(tag=etree.Element):
+        t = (leaf.text or '').strip()
+        prefix, sep, _ = t.partition(':')
+        if sep and prefix in leaf.nsmap:
+            prefixes.add(prefix)
+    return etree.tostring(e, method='c14n', exclusive=True,
+                          inclusive_ns_prefixes=sorted(prefixes) or None)
+
+
+def entry_key(e):
+    """The sort key of a list entry: its first leaf, then its whole
+    canonical form to order entries with the same first leaf.
+    """
+    children = elements(e)
+    first = children[0] if children and not elements(children[0]) else None
+    return (natural((first.text or '') if first is not None else ''),
+            c14n(e))
+
+
+def canonicalize(e):
+    """Drop whitespace between elements and sort list entries, in place,
+    throughout the subtree under e.
+    """
+    children = elements(e)
+    if not children:
+        if e.text is not None and not e.text.strip():
+            e.text = None
+        return
+    e.text = None
+    for c in children:
+        canonicalize(c)
+        c.tail = None
+    groups = {}
+    for c in children:
+        groups.setdefault(c.tag, []).append(c)
+    if len(groups) == len(children):
+        return
+    #
+    # Sort the entries of each list among the places they already take,
+    # leaving everything else where it was.
+    #
+    for tag, entries in groups.items():
+        if len(entries) < 2:
+            continue
+        positions = [i for (i, c) in enumerate(children) if c.tag == tag]
+        for i, c in zip(positions, sorted(entries, key=entry_key)):
+            children[i] = c
+    for c in children:
+        e.remove(c)
+    e.extend(children)
+
+
+def chunks(data):
+    """Canonicalize reply data, returning (tag, canonical bytes) for each
+    top-level container.
+    """
+    result = []
+    for c in elements(data):
+        canonicalize(c)
+        c.tail = None
+        result.append((c.tag, c14n(c)))
+    return result
+
+
+def device_name(host, port):
+    return '%s_%s' % (re.sub(r'[^\w.-]', '_', str(host)), port)
+
+
+class Archive(object):
+    """The archive in a directory; safe to share between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def write_file(self, path, data):
+        d = os.path.dirname(path)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def put(self, chunk):
+        """Store a chunk, returning its digest and the number of bytes
+        written, which is 0 if it was already stored.
+        """
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        data = zlib.compress(chunk, 6)
+        self.write_file(path, data)
+        return digest, len(data)
+
+    def get(self, digest):
+        with open(self.object_path(digest), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def store(self, host, port, data, taken=None):
+        """Archive the data of a get-config reply from a device, returning
+        the manifest recorded and the number of bytes written.
+        """
+        taken = taken or time.time()
+        written = 0
+        entries = []
+        for (tag, chunk) in chunks(data):
+            digest, n = self.put(chunk)
+            written += n
+            entries.append({'tag': tag, 'sha256': digest, 'size': len(chunk)})
+        device = device_name(host, port)
+        d = os.path.join(self.path, 'snapshots', device)
+        snapshot_id = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(taken))
+        with self.lock:
+            #
+            # Two snapshots of a device in the same second get a suffix.
+            #
+            n = 1
+            name = snapshot_id
+            while os.path.exists(os.path.join(d, '%s.json' % name)):
+                n += 1
+                name = '%s.%d' % (snapshot_id, n)
+            manifest = {
+                'device': '%s:%s' % (host, port),
+                'id': name,
+                'taken': taken,
+                'chunks': entries,
+            }
+            text = json.dumps(manifest, indent=1, sort_keys=True)
+            written += len(text)
+            self.write_file(os.path.join(d, '%s.json' % name), text.encode('utf-8'))
+        return manifest, written
+
+    def devices(self):
+        d = os.path.join(self.path, 'snapshots')
+        return sorted(os.listdir(d)) if os.path.isdir(d) else []
+
+    def snapshots(self, device):
+        """The IDs of the snapshots of a device ("HOST:PORT" or as named on
+        disk), oldest first.
+        """
+        if ':' in device:
+            device = device_name(*device.rsplit(':', 1))
+        d = os.path.join(self.path, 'snapshots', device)
+        if not os.path.isdir(d):
+            return []
+        ids = [f[:-len('.json')] for f in os.listdir(d) if f.endswith('.json')]
+        return sorted(ids, key=natural)
+
+    def manifest(self, device, snapshot):
+        """The manifest of a snapshot, given by its ID or by its index in
+        snapshots(), so that -1 is the latest.
+        """
+        ids = self.snapshots(device)
+        try:
+            snapshot = ids[int(snapshot)]
+        except ValueError:
+            pass
+        except IndexError:
+            raise KeyError('%s has no snapshot %s' % (device, snapshot))
+        if snapshot not in ids:
+            raise KeyError('%s has no snapshot %s' % (device, snapshot))
+        if ':' in device:
+            device = device_name(*device.rsplit(':', 1))
+        with open(os.path.join(self.path, 'snapshots', device, '%s.json' % snapshot)) as f:
+            return json.load(f)
+
+    def load(self, manifest):
+        """Reassemble a snapshot as a <data> element.
+        """
+        data = etree.Element('{%s}data' % NC_NS, nsmap={None: NC_NS})
+        for c in manifest['chunks']:
+            data.append(etree.fromstring(self.get(c['sha256'])))
+        return data
+
+    def pretty(self, digest):
+        parser = etree.XMLParser(remove_blank_text=True)
+        text = etree.tostring(etree.fromstring(self.get(digest), parser), pretty_print=True)
+        return text.decode('utf-8').splitlines(True)
+
+    def diff(self, a, b):
+        """Yield the lines of a unified diff between the snapshots with
+        manifests a and b, only decompressing the chunks that differ.
+        """
+        old = dict((c['tag'], c['sha256']) for c in a['chunks'])
+        new = dict((c['tag'], c['sha256']) for c in b['chunks'])
+        tags = [c['tag'] for c in a['chunks']]
+        tags += [c['tag'] for c in b['chunks'] if c['tag'] not in old]
+        for tag in tags:
+            if old.get(tag) == new.get(tag):
+                continue
+            before = self.pretty(old[tag]) if tag in old else []
+            after = self.pretty(new[tag]) if tag in new else []
+            for line in difflib.unified_diff(before, after,
+                                             '%s %s' % (a['id'], tag), '%s %s' % (b['id'], tag)):
+                yield line
@@ -0,0 +1,239 @@
+"""Asynchronous NETCONF operations on ncclient sessions.
+
+ncclient already reads every session on a thread of its own, so a
+blocking call only ties up the calling thread waiting for the reply to
+turn up. AsyncManager sends an RPC and returns a Future at once; the
+Future is completed from the session's own thread when the reply, or an
+error, is delivered. One thread can then keep RPCs outstanding on any
+number of sessions, rather than needing a thread per RPC in flight.
+
+For asyncio code (Python 3), AsyncioManager returns asyncio futures
+instead, so operations can simply be awaited, and connect() connects in
+an executor.
+"""
+import threading
+from ncclient import manager
+from ncclient.operations.rpc import RPCError, RaiseMode
+from ncclient.operations.errors import TimeoutExpiredError
+from ncclient.xml_ import NCElement, to_ele
+
+OPERATIONS = ['get', 'get_config', 'edit_config', 'get_schema', 'commit', 'discard_changes']
+
+
+class Future(object):
+    """The eventual result of an RPC, much like a concurrent.futures
+    Future (which Python 2 doesn't have). Only the first result or
+    exception set counts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def _set(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    def set_result(self, result):
+        return self._set(result, None)
+
+    def set_exception(self, exception):
+        return self._set(None, exception)
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutExpiredError('ncclient timed out while waiting for an rpc reply.')
+        return self._exception
+
+    def result(self, timeout=None):
+        e = self.exception(timeout)
+        if e is not None:
+            raise e
+        return self._result
+
+    def add_done_callback(self, fn):
+        """Call fn with the future when it completes, straight away if it
+        already has. Callbacks run on whichever thread completes it.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+
+_notifying = {}
+
+
+def notifying(cls):
+    """A subclass of an ncclient operation class that calls its
+    on_delivery attribute once its reply or error has been delivered.
+    """
+    if cls not in _notifying:
+        class Notifying(cls):
+            def deliver_reply(self, raw):
+                cls.deliver_reply(self, raw)
+                self.on_delivery(self)
+
+            def deliver_error(self, err):
+                cls.deliver_error(self, err)
+                self.on_delivery(self)
+        Notifying.__name__ = cls.__name__
+        _notifying[cls] = Notifying
+    return _notifying[cls]
+
+
+class AsyncManager(object):
+    """Wraps a connected ncclient manager. The operations in OPERATIONS
+    take the same arguments as the manager's, but return a Future of
+    the reply rather than waiting for it. Replies are checked for
+    rpc-errors just as the manager would.
+    """
+
+    def __init__(self, m):
+        self.m = m
+
+    @property
+    def server_capabilities(self):
+        return self.m.server_capabilities
+
+    @property
+    def connected(self):
+        return self.m.connected
+
+    def call(self, op, *args, **kwargs):
+        m = self.m
+        cls = notifying(manager.OPERATIONS[op])
+        options = {
+            'device_handler': m._device_handler,
+            'timeout': m.timeout,
+            'raise_mode': m.raise_mode,
+        }
+        try:
+            rpc = cls(m._session, async_mode=True, **options)
+        except TypeError:
+            #
+            # ncclient before 0.6 spells it async.
+            #
+            options['async'] = True
+            rpc = cls(m._session, **options)
+        future = Future()
+        rpc.on_delivery = lambda rpc: self.complete(rpc, future)
+        try:
+            rpc.request(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def complete(self, rpc, future):
+        """Complete the future for a delivered RPC, mirroring what ncclient
+        does for a synchronous request.
+        """
+        if rpc.error is not None:
+            future.set_exception(rpc.error)
+            return
+        reply = rpc.reply
+        handler = self.m._device_handler
+        try:
+            reply.parse()
+            if reply.error is not None and not handler.is_rpc_error_exempt(reply.error.message):
+                if self.m.raise_mode == RaiseMode.ALL or (
+                        self.m.raise_mode == RaiseMode.ERRORS and reply.error.severity == 'error'):
+                    if len(reply.errors) > 1:
+                        raise RPCError(to_ele(reply._raw), errs=reply.errors)
+                    raise reply.error
+            if handler.transform_reply():
+                reply = NCElement(reply, handler.transform_reply())
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(reply)
+
+    def get(self, *args, **kwargs):
+        return self.call('get', *args, **kwargs)
+
+    def get_config(self, *args, **kwargs):
+        return self.call('get_config', *args, **kwargs)
+
+    def edit_config(self, *args, **kwargs):
+        return self.call('edit_config', *args, **kwargs)
+
+    def get_schema(self, *args, **kwargs):
+        return self.call('get_schema', *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        return self.call('commit', *args, **kwargs)
+
+    def discard_changes(self, *args, **kwargs):
+        return self.call('discard_changes', *args, **kwargs)
+
+    def close_session(self):
+        self.m.close_session()
+
+
+def wrap(future, loop):
+    """Return an asyncio future completed along with future.
+    """
+    af = loop.create_future()
+
+    def copy(f):
+        if af.cancelled():
+            return
+        e = f.exception(0)
+        if e is not None:
+            af.set_exception(e)
+        else:
+            af.set_result(f.result(0))
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(copy, f))
+    return af
+
+
+class AsyncioManager(AsyncManager):
+    """The same operations as AsyncManager, returning asyncio futures to
+    be awaited on the given event loop.
+    """
+
+    def __init__(self, m, loop):
+        AsyncManager.__init__(self, m)
+        self.loop = loop
+
+    def call(self, op, *args, **kwargs):
+        return wrap(AsyncManager.call(self, op, *args, **kwargs), self.loop)
+
+    def close_session(self):
+        return self.loop.run_in_executor(None, self.m.close_session)
+
+
+def connect(loop=None, **kwargs):
+    """Connect with ncclient's manager.connect() arguments on the loop's
+    default executor, returning an awaitable AsyncioManager. SSH setup is
+    still blocking, so at most as many connects as the executor has
+    threads run at once.
+    """
+    import asyncio
+    loop = loop or asyncio.get_event_loop()
+    af = loop.create_future()
+
+    def connected(f):
+        if af.cancelled():
+            return
+        if f.exception() is not None:
+            af.set_exception(f.exception())
+        else:
+            af.set_result(AsyncioManager(f.result(), loop))
+    loop.run_in_executor(None, lambda: manager.connect(**kwargs)).add_done_callback(connected)
+    return af
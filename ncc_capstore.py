@@ -0,0 +1,166 @@
+"""A local SQLite index of the capabilities devices advertise.
+
+Every time ncc.py connects to a device, the capabilities from its hello
+are parsed once into their module, namespace, revision, features and
+deviations and stored against the device, replacing whatever was stored
+for it before. Questions like which devices advertise a given module at
+a given revision can then be answered from the index across the whole
+fleet without connecting to anything.
+
+Module names are kept in a table of their own, so that a regex is only
+matched against each distinct name once, however many devices advertise
+it, and the matching devices are then found through an index.
+"""
+import os
+import re
+import time
+import sqlite3
+import threading
+
+#
+# Where the store lives unless told otherwise.
+#
+DEFAULT_STORE = os.environ.get('NCC_CAPABILITY_STORE', os.path.join(
+    os.environ.get('NCC_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ncc')),
+    'capabilities.db'))
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS devices (device TEXT PRIMARY KEY, host TEXT, port INTEGER, updated REAL)',
+    'CREATE TABLE IF NOT EXISTS capabilities (device TEXT, uri TEXT)',
+    'CREATE INDEX IF NOT EXISTS capabilities_by_device ON capabilities (device)',
+    'CREATE TABLE IF NOT EXISTS module_names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS modules (device TEXT, module_id INTEGER, namespace TEXT, revision TEXT, features TEXT, deviations TEXT)',
+    'CREATE INDEX IF NOT EXISTS modules_by_module ON modules (module_id, revision)',
+    'CREATE INDEX IF NOT EXISTS modules_by_device ON modules (device)',
+]
+
+
+def parse_capability(uri):
+    """Split a capability advertising a YANG module into a dict of its
+    module, namespace, revision, features and deviations, or return
+    None for any other capability.
+    """
+    namespace, sep, query = uri.partition('?')
+    if not sep:
+        return None
+    params = {}
+    for p in query.replace('&amp;', '&').split('&'):
+        k, _, v = p.partition('=')
+        params[k] = v
+    if not params.get('module'):
+        return None
+    return {
+        'module': params['module'],
+        'namespace': namespace,
+        'revision': params.get('revision') or None,
+        'features': [f for f in params.get('features', '').split(',') if f],
+        'deviations': [d for d in params.get('deviations', '').split(',') if d],
+    }
+
+
+def _regexp(pattern, value):
+    return value is not None and re.search(pattern, value) is not None
+
+
+class CapabilityStore(object):
+    """The store; safe to share between threads.
+    """
+
+    def __init__(self, path=DEFAULT_STORE):
+        d = os.path.dirname(path)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.create_function('REGEXP', 2, _regexp)
+        self.lock = threading.Lock()
+        with self.lock:
+            #
+            # Several ncc.py runs may well be recording at once.
+            #
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                self.db.execute(statement)
+            self.db.commit()
+            self.module_ids = dict(self.db.execute('SELECT name, id FROM module_names'))
+
+    def module_id(self, name):
+        #
+        # Another process may have added the name since the cache was
+        # filled, so add it only if it isn't there and read back its id.
+        #
+        if name not in self.module_ids:
+            self.db.execute('INSERT OR IGNORE INTO module_names (name) VALUES (?)', (name,))
+            self.module_ids[name] = self.db.execute(
+                'SELECT id FROM module_names WHERE name = ?', (name,)).fetchone()[0]
+        return self.module_ids[name]
+
+    def record(self, host, port, capabilities):
+        """Replace what is stored for a device with the capabilities it
+        has just advertised.
+        """
+        device = '%s:%s' % (host, port)
+        capabilities = list(capabilities)
+        with self.lock:
+            try:
+                self.db.execute('DELETE FROM capabilities WHERE device = ?', (device,))
+                self.db.execute('DELETE FROM modules WHERE device = ?', (device,))
+                self.db.execute('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?)',
+                                (device, host, port, time.time()))
+                self.db.executemany('INSERT INTO capabilities VALUES (?, ?)',
+                                    [(device, c) for c in capabilities])
+                rows = []
+                for c in capabilities:
+                    p = parse_capability(c)
+                    if p:
+                        rows.append((device, self.module_id(p['module']), p['namespace'],
+                                     p['revision'], ','.join(p['features']),
+                                     ','.join(p['deviations'])))
+                self.db.executemany('INSERT INTO modules VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                self.module_ids = dict(self.db.execute('SELECT name, id FROM module_names'))
+                raise
+
+    def devices(self, devices=None):
+        """Return (device, updated) for every device stored, or just those
+        given.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT device, updated FROM devices ORDER BY device').fetchall()
+        if devices is not None:
+            wanted = set(devices)
+            rows = [r for r in rows if r[0] in wanted]
+        return rows
+
+    def capabilities(self, device):
+        """The capabilities stored for a device, in the order advertised.
+        """
+        with self.lock:
+            return [r[0] for r in self.db.execute(
+                'SELECT uri FROM capabilities WHERE device = ? ORDER BY rowid', (device,))]
+
+    def query(self, module_re, revision=None, devices=None):
+        """Return (device, module, revision) for every module matching the
+        regex, optionally at just the given revision and on just the given
+        devices.
+        """
+        sql = ('SELECT m.device, n.name, m.revision FROM modules m '
+               'JOIN module_names n ON n.id = m.module_id '
+               'WHERE m.module_id IN (SELECT id FROM module_names WHERE name REGEXP ?)')
+        params = [module_re]
+        if revision:
+            sql += ' AND m.revision = ?'
+            params.append(revision)
+        sql += ' ORDER BY m.device, n.name'
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        if devices is not None:
+            wanted = set(devices)
+            rows = [r for r in rows if r[0] in wanted]
+        return rows
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,433 @@
+"""Operations on edit-config payloads as XML trees.
+
+Rendered snippets are <config> documents. Several of them can be
+merged into one namespace-aware tree, so that a change set goes to the
+device as a single edit-config rather than one per snippet. Siblings
+with the same (namespace-qualified) tag are coalesced into one element
+when they are the same node, which for a list entry means that its
+first leaf, which NETCONF puts first as the list key, has the same
+value; otherwise they are kept as separate siblings, as separate list
+entries or leaf-list values.
+
+Merging is refused, with a MergeConflict, wherever the single edit
+might not mean the same as the separate ones: a leaf set to two
+different values, or a node carrying an operation other than merge in
+either document.
+
+A rendered config can also be diffed against the running config, so
+that only what actually differs gets sent. The diff assumes merge
+semantics: it fetches just the nodes the config touches with a subtree
+filter built from it, and keeps only the leaves that are missing or
+different, the list entries and containers that are missing, and the
+deletes and removes of nodes that are present, along with the keys
+needed to reach them. Where the YANG modules are to hand, list keys are
+taken from them; otherwise the first leaf of a list entry is assumed to
+be its key.
+"""
+import os
+import copy
+import json
+import hashlib
+from lxml import etree
+from ncc_output import elements
+
+NC_NS = 'urn:ietf:params:xml:ns:netconf:base:1.0'
+OPERATION = '{%s}operation' % NC_NS
+
+
+class MergeConflict(Exception):
+    pass
+
+
+def parse(config):
+    """Parse a rendered config document, which Jinja hands us as unicode.
+    """
+    if not isinstance(config, bytes):
+        config = config.encode('utf-8')
+    try:
+        return etree.fromstring(config)
+    except etree.XMLSyntaxError as e:
+        raise MergeConflict('unparseable config: %s' % e)
+
+
+def is_leaf(e):
+    return not elements(e)
+
+
+def text(e):
+    return (e.text or '').strip()
+
+
+def key(e):
+    """The (tag, value) of an element's first child if that is a leaf,
+    and not a leaf-list value, else None.
+    """
+    children = elements(e)
+    if children and is_leaf(children[0]):
+        tags = [c.tag for c in children]
+        if tags.count(tags[0]) == 1:
+            return (children[0].tag, text(children[0]))
+    return None
+
+
+class Siblings(object):
+    """An index of the children of an element, for finding which of them
+    an element from another document is the same node as without
+    comparing it against every one.
+
+    Siblings with the same tag are the same node if both are leaves with
+    the same value, or if both are list entries keyed by the same leaf
+    with the same value. A leaf and a container, or anything without a
+    key, can't be told apart and are taken to be the same node.
+    """
+
+    def __init__(self, parent):
+        self.counts = {}
+        self.leaves = {}
+        self.keyed = {}
+        self.unkeyed = {}
+        for e in elements(parent):
+            self.add(e)
+
+    def add(self, e):
+        self.counts[e.tag] = self.counts.get(e.tag, 0) + 1
+        if is_leaf(e):
+            self.leaves.setdefault(e.tag, {}).setdefault(text(e), []).append(e)
+            return
+        k = key(e)
+        if k is None:
+            self.unkeyed.setdefault(e.tag, []).append(e)
+        else:
+            self.keyed.setdefault(e.tag, {}).setdefault(k[0], {}).setdefault(k[1], []).append(e)
+
+    def matches(self, c):
+        tag = c.tag
+        found = list(self.unkeyed.get(tag, []))
+        leaves = self.leaves.get(tag, {})
+        keyed = self.keyed.get(tag, {})
+        if is_leaf(c):
+            found.extend(leaves.get(text(c), []))
+            for entries in keyed.values():
+                for es in entries.values():
+                    found.extend(es)
+            return found
+        for es in leaves.values():
+            found.extend(es)
+        k = key(c)
+        for key_tag, entries in keyed.items():
+            if k is not None and key_tag == k[0]:
+                found.extend(entries.get(k[1], []))
+            else:
+                for es in entries.values():
+                    found.extend(es)
+        return found
+
+
+def check_attributes(a, b):
+    if dict(a.attrib) != dict(b.attrib):
+        raise MergeConflict('%s has different attributes in different edits' % a.tag)
+    if a.get(OPERATION, 'merge') != 'merge':
+        raise MergeConflict('%s is the target of "%s" in more than one edit' % (
+            a.tag, a.get(OPERATION)))
+
+
+def merge_into(a, others):
+    """Merge the children of each of the elements in others, in turn,
+    into a.
+    """
+    siblings = Siblings(a)
+    merges = []
+    merging = {}
+    for b in others:
+        b_children = elements(b)
+        b_counts = {}
+        for c in b_children:
+            b_counts[c.tag] = b_counts.get(c.tag, 0) + 1
+        added = []
+        for c in b_children:
+            matches = siblings.matches(c)
+            if len(matches) > 1:
+                raise MergeConflict('%s matches more than one sibling' % c.tag)
+            if matches:
+                x = matches[0]
+                check_attributes(x, c)
+                if not is_leaf(c):
+                    if id(x) not in merging:
+                        merging[id(x)] = (x, [])
+                        merges.append(merging[id(x)])
+                    merging[id(x)][1].append(c)
+                continue
+
+            #
+            # A leaf that is already there with a different value is only
+            # fine if it's a leaf-list, which we can only tell by it being
+            # repeated in one document or the other.
+            #
+            if is_leaf(c) and siblings.counts.get(c.tag) == 1 and b_counts[c.tag] == 1:
+                raise MergeConflict('%s is set to different values' % c.tag)
+            added.append(c)
+
+        #
+        # What this document adds can be the same node as what a later one
+        # has, but not as its own siblings.
+        #
+        for c in added:
+            a.append(c)
+            siblings.add(c)
+
+    for x, cs in merges:
+        merge_into(x, cs)
+
+
+def merge_configs(configs):
+    """Merge rendered config documents into one, returned as a string,
+    raising MergeConflict if they can't be merged.
+    """
+    trees = [parse(config) for config in configs]
+    if not trees:
+        return None
+    root = trees[0]
+    for tree in trees[1:]:
+        if tree.tag != root.tag:
+            raise MergeConflict('edits are rooted at both %s and %s' % (root.tag, tree.tag))
+    merge_into(root, trees[1:])
+    return etree.tostring(root)
+
+
+def list_keys(schema_dir, cache_dir=None):
+    """Return a dict mapping the (namespace, name) of every list defined
+    in the YANG modules in schema_dir to the names of its keys. Lists in
+    groupings are credited to the namespace of the module defining the
+    grouping. The result is cached in cache_dir until any of the
+    modules change.
+    """
+    yangfiles = sorted(f for f in os.listdir(schema_dir) if f.endswith('.yang'))
+    signature = hashlib.sha1()
+    for fname in yangfiles:
+        st = os.stat(os.path.join(schema_dir, fname))
+        signature.update(('%s %s %s\n' % (fname, st.st_mtime, st.st_size)).encode('utf-8'))
+    cache_file = None
+    if cache_dir:
+        name = hashlib.sha1(os.path.abspath(schema_dir).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_dir, 'list-keys-%s.json' % name)
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached['signature'] == signature.hexdigest():
+                return dict((tuple(k.split(' ', 1)), v) for k, v in cached['keys'].items())
+        except (IOError, ValueError, KeyError):
+            pass
+
+    import pyang
+    from pyang import yang_parser
+    ctx = pyang.Context(pyang.FileRepository(schema_dir))
+    parser = yang_parser.YangParser()
+    namespaces = {}
+    found = []
+
+    def walk(stmt, module):
+        for s in stmt.substmts:
+            if s.keyword == 'list':
+                k = s.search_one('key')
+                if k is not None:
+                    found.append((module, str(s.arg),
+                                  [n.split(':')[-1] for n in k.arg.split()]))
+            walk(s, module)
+
+    for fname in yangfiles:
+        with open(os.path.join(schema_dir, fname)) as f:
+            module = parser.parse(ctx, fname, f.read())
+        if module is None:
+            continue
+        if module.keyword == 'module':
+            ns = module.search_one('namespace')
+            if ns is not None:
+                namespaces[str(module.arg)] = str(ns.arg)
+            walk(module, str(module.arg))
+        else:
+            belongs_to = module.search_one('belongs-to')
+            if belongs_to is not None:
+                walk(module, str(belongs_to.arg))
+
+    keys = {}
+    for module, name, key_names in found:
+        if module in namespaces:
+            keys[(namespaces[module], name)] = key_names
+    if cache_file:
+        try:
+            with open(cache_file + '.tmp', 'w') as f:
+                json.dump({'signature': signature.hexdigest(),
+                           'keys': dict(('%s %s' % k, v) for k, v in keys.items())}, f)
+            os.rename(cache_file + '.tmp', cache_file)
+        except (IOError, OSError):
+            pass
+    return keys
+
+
+def value(e):
+    """The value of a leaf, with any prefix of an identity resolved to its
+    namespace so that values using different prefixes compare equal.
+    """
+    t = text(e)
+    prefix, sep, local = t.partition(':')
+    if sep and prefix in e.nsmap and prefix is not None:
+        return '{%s}%s' % (e.nsmap[prefix], local)
+    return t
+
+
+def entry_keys(e, keys):
+    """The key leaves of e, if it looks like a list entry, and whether
+    that is known from the YANG modules rather than guessed.
+    """
+    qname = etree.QName(e)
+    names = (keys or {}).get((qname.namespace, qname.localname))
+    if names is not None:
+        by_name = dict((etree.QName(c).localname, c) for c in elements(e) if is_leaf(c))
+        if all(n in by_name for n in names):
+            return [by_name[n] for n in names], True
+    k = key(e)
+    if k is None:
+        return [], False
+    return [elements(e)[0]], False
+
+
+def skeleton(e, keys):
+    """The subtree filter selecting the nodes of e: key leaves become
+    content match nodes and other leaves selection nodes. A node being
+    replaced is selected in full.
+    """
+    f = etree.Element(e.tag, nsmap=e.nsmap)
+    key_leaves, _ = entry_keys(e, keys)
+    for k in key_leaves:
+        etree.SubElement(f, k.tag, nsmap=k.nsmap).text = text(k)
+    if e.get(OPERATION) in ('replace', 'delete', 'remove'):
+        return f
+    selected = set(k.tag for k in key_leaves)
+    for c in elements(e):
+        if c in key_leaves:
+            continue
+        if is_leaf(c):
+            if c.tag not in selected:
+                etree.SubElement(f, c.tag, nsmap=c.nsmap)
+                selected.add(c.tag)
+        else:
+            f.append(skeleton(c, keys))
+    return f
+
+
+def subtree_filter(config, keys=None):
+    """A subtree filter for the nodes a parsed config touches.
+    """
+    f = etree.Element('filter', type='subtree')
+    for c in elements(config):
+        f.append(skeleton(c, keys))
+    return etree.tostring(f)
+
+
+def canonical(e):
+    """A comparable form of a subtree that ignores sibling order,
+    whitespace and prefixes.
+    """
+    children = elements(e)
+    if not children:
+        return (e.tag, value(e))
+    return (e.tag, tuple(sorted(canonical(c) for c in children)))
+
+
+class Running(object):
+    """The children of a running config node, indexed for finding the one
+    a desired node corresponds to.
+    """
+
+    def __init__(self, running):
+        self.by_tag = {}
+        self.indexes = {}
+        for r in elements(running) if running is not None else []:
+            self.by_tag.setdefault(r.tag, []).append(r)
+
+    def find(self, c, keys):
+        candidates = self.by_tag.get(c.tag, [])
+        if not candidates:
+            return None
+        if is_leaf(c):
+            if not text(c):
+                return candidates[0]
+            want = value(c)
+            for r in candidates:
+                if is_leaf(r) and value(r) == want:
+                    return r
+            return None
+        key_leaves, _ = entry_keys(c, keys)
+        if not key_leaves:
+            return candidates[0]
+
+        #
+        # Index the candidates on the values of the desired node's key
+        # leaves, once per tag and set of keys.
+        #
+        key_tags = tuple(k.tag for k in key_leaves)
+        index = self.indexes.get((c.tag, key_tags))
+        if index is None:
+            index = {}
+            for r in candidates:
+                found = [r.find(t) for t in key_tags]
+                if all(f is not None for f in found):
+                    index.setdefault(tuple(value(f) for f in found), r)
+            self.indexes[(c.tag, key_tags)] = index
+        return index.get(tuple(value(k) for k in key_leaves))
+
+
+def diff_children(desired, running, keys):
+    """Return copies of the children of desired, trimmed to what differs
+    from the children of running.
+    """
+    present = Running(running)
+    changes = []
+    for c in elements(desired):
+        op = c.get(OPERATION)
+        match = present.find(c, keys)
+
+        if op in ('delete', 'remove'):
+            if match is not None:
+                changes.append(copy.deepcopy(c))
+            continue
+        if match is None:
+            new = copy.deepcopy(c)
+            if op is None and not is_leaf(c) and entry_keys(c, keys)[1]:
+                new.set(OPERATION, 'create')
+            changes.append(new)
+            continue
+        if is_leaf(c):
+            continue
+        if op == 'replace':
+            if canonical(c) != canonical(match):
+                changes.append(copy.deepcopy(c))
+            continue
+
+        below = diff_children(c, match, keys)
+        if below:
+            e = etree.Element(c.tag, nsmap=c.nsmap)
+            for name, v in c.attrib.items():
+                if not (name == OPERATION and v == 'create'):
+                    e.set(name, v)
+            key_leaves, _ = entry_keys(c, keys)
+            for k in key_leaves:
+                e.append(copy.deepcopy(k))
+            for b in below:
+                e.append(b)
+            changes.append(e)
+    return changes
+
+
+def diff_config(config, running, keys=None):
+    """Return what of the parsed config differs from running, the data
+    element of a get-config reply filtered with subtree_filter(), as a
+    string, or None if there's nothing to change.
+    """
+    changes = diff_children(config, running, keys)
+    if not changes:
+        return None
+    root = etree.Element(config.tag, nsmap=config.nsmap)
+    for c in changes:
+        root.append(c)
+    return etree.tostring(root)
@@ -0,0 +1,270 @@
+"""Schema-driven conversion of reply data to RFC 7951 JSON or columns.
+
+ncc_output's JSON is a straightforward mapping of the XML with every
+leaf a string, because without the schema there is no telling a number
+from a string, or a list with one entry from a container. With the
+YANG modules to hand (see ncc_filters.Schema), a reply can instead be
+written as RFC 7951 JSON:
+
+  - member names are qualified by module name wherever the module
+    changes, as at the top level and in augments,
+  - lists and leaf-lists are always arrays, however many entries they
+    have, and containers always objects,
+  - 8, 16 and 32 bit integers are numbers and booleans true or false;
+    64 bit integers and decimal64 stay strings, as RFC 7951 has them,
+    and empty leaves are [null],
+  - identityref values are qualified by module name rather than by
+    whatever XML prefix the device used, and union and leafref values
+    are typed by the member and target types.
+
+Or as columns: one table per YANG list, named by the schema path of the
+list, with a row per entry. Each row has the keys of the entries it is
+nested in (named LIST/KEY), then its own leaves, including those of
+containers inside the entry (named by their path from the entry).
+Columns are arrays of values, padded with nulls where an entry doesn't
+have a leaf, which is easy to load into a data frame or a column store.
+
+Both are written in a single pass over the reply, freeing each subtree
+once converted, with the type of every leaf and the children of every
+schema node worked out once and cached. Anything in a reply that isn't
+in the schema is written as ncc_output would, without types.
+"""
+import json
+import threading
+from lxml import etree
+from ncc_output import elements, to_dict
+from ncc_filters import Schema, LEAF_KEYWORDS, list_keys
+
+FORMATS = ['rfc7951', 'columnar']
+
+NUMBER_TYPES = set(['int8', 'int16', 'int32', 'uint8', 'uint16', 'uint32'])
+
+
+class Converter(object):
+    """Converts replies using a Schema; safe to share between threads.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.kinds = {}
+        self.module_names = schema.modules()
+
+    def module(self, stmt):
+        return stmt.i_module.i_modulename
+
+    def type_kind(self, t):
+        """The JSON encoding of a type statement: 'number', 'boolean',
+        'empty', 'identityref', 'string', or a tuple of the kinds of the
+        members of a union.
+        """
+        while getattr(t, 'i_typedef', None) is not None:
+            t = t.i_typedef.search_one('type')
+        name = t.arg.split(':')[-1]
+        if name in NUMBER_TYPES:
+            return 'number'
+        if name in ('boolean', 'empty', 'identityref'):
+            return name
+        if name == 'union':
+            return tuple(self.type_kind(m) for m in t.search('type'))
+        if name == 'leafref':
+            target = getattr(getattr(t, 'i_type_spec', None), 'i_target_node', None)
+            if target is not None and target.search_one('type') is not None:
+                return self.type_kind(target.search_one('type'))
+        return 'string'
+
+    def kind(self, stmt):
+        k = self.kinds.get(id(stmt))
+        if k is None:
+            t = stmt.search_one('type')
+            k = self.type_kind(t) if t is not None else 'string'
+            self.kinds[id(stmt)] = k
+        return k
+
+    def value(self, e, stmt):
+        """The RFC 7951 value of a leaf.
+        """
+        return self.convert(e, (e.text or '').strip(), self.kind(stmt))
+
+    def convert(self, e, text, kind):
+        if isinstance(kind, tuple):
+            for k in kind:
+                if k == 'string':
+                    break
+                v = self.convert(e, text, k)
+                if v is not text:
+                    return v
+            return text
+        if kind == 'number':
+            try:
+                return int(text)
+            except ValueError:
+                return text
+        if kind == 'boolean':
+            return {'true': True, 'false': False}.get(text, text)
+        if kind == 'empty':
+            return [None] if not text else text
+        if kind == 'identityref':
+            prefix, sep, name = text.partition(':')
+            module = self.module_names.get(e.nsmap.get(prefix if sep else None))
+            if module is not None:
+                return '%s:%s' % (module, name if sep else text)
+        return text
+
+    def groups(self, e, stmt):
+        """Group the children of e by schema node, or by tag where they
+        aren't in the schema, in the order each first appears.
+        """
+        groups = []
+        by_tag = {}
+        for c in elements(e):
+            if c.tag not in by_tag:
+                s = self.schema.top.get(c.tag) if stmt is None else self.schema.child(stmt, c.tag)
+                by_tag[c.tag] = []
+                groups.append((s, c, by_tag[c.tag]))
+            by_tag[c.tag].append(c)
+        return groups
+
+    def _write(self, e, stmt, f, depth):
+        pad = b'\n' + b' ' * (depth + 1)
+        f.write(b'{')
+        parent = self.module(stmt) if stmt is not None else None
+        for i, (s, first, group) in enumerate(self.groups(e, stmt)):
+            f.write((b',' if i else b'') + pad)
+            if s is None:
+                name = etree.QName(first).localname
+            elif self.module(s) != parent:
+                name = '%s:%s' % (self.module(s), s.arg)
+            else:
+                name = s.arg
+            f.write(json.dumps(name).encode('utf-8') + b': ')
+            if s is None:
+                v = [to_dict(c) for c in group]
+                f.write(json.dumps(v if len(v) > 1 else v[0]).encode('utf-8'))
+            elif s.keyword in ('leaf', 'leaf-list'):
+                v = [self.value(c, s) for c in group]
+                f.write(json.dumps(v if s.keyword == 'leaf-list' else v[0]).encode('utf-8'))
+            elif s.keyword in LEAF_KEYWORDS:
+                f.write(json.dumps(to_dict(first)).encode('utf-8'))
+            elif s.keyword == 'list':
+                f.write(b'[')
+                for j, c in enumerate(group):
+                    f.write((b',' if j else b'') + pad + b' ')
+                    self._write(c, s, f, depth + 2)
+                f.write(pad + b']')
+            else:
+                self._write(first, s, f, depth + 1)
+            for c in group:
+                c.clear()
+        f.write(b'\n' + b' ' * depth + b'}')
+
+    def write_rfc7951(self, data, f):
+        """Write the data of a reply to binary file f as RFC 7951 JSON.
+        """
+        self._write(data, None, f, 0)
+        f.write(b'\n')
+
+    def tables(self, data):
+        """Return the tables of a reply, as explained above, as a list of
+        (name, column names, dict of columns).
+        """
+        tables = []
+        by_name = {}
+
+        def add_row(table, names, row):
+            t = by_name.get(table)
+            if t is None:
+                t = by_name[table] = (table, [], {}, [0])
+                tables.append(t)
+            (_, columns, values, rows) = t
+            for n in names:
+                if n not in values:
+                    columns.append(n)
+                    values[n] = [None] * rows[0]
+            for n in columns:
+                values[n].append(row.get(n))
+            rows[0] += 1
+
+        def entry(e, stmt, table, inherited):
+            names = [n for (n, _) in inherited]
+            row = dict(inherited)
+            nested = []
+
+            def collect(x, xstmt, prefix):
+                for c in elements(x):
+                    s = self.schema.child(xstmt, c.tag)
+                    if s is None:
+                        continue
+                    name = prefix + s.arg
+                    if s.keyword == 'list':
+                        nested.append((c, s, name))
+                    elif s.keyword == 'leaf-list':
+                        if name not in row:
+                            names.append(name)
+                            row[name] = []
+                        row[name].append(self.value(c, s))
+                    elif s.keyword in LEAF_KEYWORDS:
+                        names.append(name)
+                        row[name] = self.value(c, s) if s.keyword == 'leaf' else to_dict(c)
+                    else:
+                        collect(c, s, name + '/')
+
+            collect(e, stmt, '')
+            if len(names) > len(inherited):
+                add_row(table, names, row)
+            keys = list(inherited)
+            if stmt.keyword == 'list':
+                keys += [('%s/%s' % (stmt.arg, k), row.get(k)) for k in list_keys(stmt)]
+            for (c, s, name) in nested:
+                entry(c, s, '%s/%s' % (table, name), keys)
+                c.clear()
+
+        for c in elements(data):
+            s = self.schema.top.get(c.tag)
+            if s is None:
+                continue
+            table = '/%s:%s' % (self.module(s), s.arg)
+            if s.keyword == 'list':
+                entry(c, s, table, [])
+            elif s.keyword not in LEAF_KEYWORDS:
+                entry(c, s, table, [])
+            c.clear()
+        return [(name, columns, values) for (name, columns, values, _) in tables]
+
+    def write_columnar(self, data, f):
+        """Write the tables of a reply to binary file f as a JSON object of
+        tables, each an object of columns.
+        """
+        f.write(b'{')
+        for i, (name, columns, values) in enumerate(self.tables(data)):
+            f.write((b',' if i else b'') + b'\n ' + json.dumps(name).encode('utf-8') + b': {')
+            for j, n in enumerate(columns):
+                f.write((b',' if j else b'') + b'\n  ' + json.dumps(n).encode('utf-8') + b': ' +
+                        json.dumps(values[n]).encode('utf-8'))
+            f.write(b'\n }')
+        f.write(b'\n}\n')
+
+    def write(self, data, f, fmt):
+        {'rfc7951': self.write_rfc7951, 'columnar': self.write_columnar}[fmt](data, f)
+
+
+_converters = {}
+_lock = threading.Lock()
+
+
+def converter(schema_dir, data):
+    """A Converter for the modules in schema_dir defining the top-level
+    namespaces of the data, made once and then shared.
+    """
+    namespaces = tuple(sorted(set(etree.QName(c).namespace for c in elements(data)) - set([None])))
+    with _lock:
+        key = (schema_dir, namespaces)
+        if key not in _converters:
+            _converters[key] = Converter(Schema(schema_dir, namespaces, ignore_missing=True))
+        return _converters[key]
+
+
+def write(data, f, fmt, schema_dir):
+    """Write data to binary file f in one of FORMATS, using the modules in
+    schema_dir.
+    """
+    converter(schema_dir, data).write(data, f, fmt)
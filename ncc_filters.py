@@ -0,0 +1,351 @@
+"""Checking and tightening subtree filters against YANG modules.
+
+Named filters tend to select far more than is wanted: a container with
+no children selects everything under it, which on a big device can be
+megabytes the device has to gather and serialize only for most of it to
+be thrown away. Given the leaves that are actually wanted, a filter can
+be rewritten to select just those. Each node of the filter is looked up
+in the schema tree, as pyang builds it from the YANG modules (with
+groupings expanded and augments applied), and:
+
+  - content match nodes (leaves with a value) are kept as they are,
+  - leaf selection nodes are kept only if they are wanted,
+  - a node that selects everything under it is replaced by the paths
+    down to the wanted leaves under it in the schema, and
+  - anything with nothing wanted under it is dropped altogether.
+
+The keys of every list on the way are selected too, so that the entries
+in the reply can be told apart, and extra content match nodes can be
+added on any leaf along the way to cut the reply down further.
+
+Only the modules defining the filter's namespaces, and those importing
+them that augment or deviate something, are loaded, so a directory of
+every module a device has can be used without parsing all of it.
+
+The size of a reply can only really be known by asking the device;
+estimate() gives a rough figure from the schema, as the bytes of XML
+for one entry of every list with every leaf holding a short value,
+which is enough to compare two filters by.
+"""
+import os
+import re
+import copy
+from lxml import etree
+from ncc_output import elements
+
+#
+# Bytes taken to be in the value of every leaf, and the keywords of the
+# statements that are nodes in the data tree.
+#
+VALUE_BYTES = 8
+DATA_KEYWORDS = ('container', 'list', 'leaf', 'leaf-list', 'anyxml', 'anydata')
+LEAF_KEYWORDS = ('leaf', 'leaf-list', 'anyxml', 'anydata')
+
+RE_MODULE = re.compile(r'^\s*(?:sub)?module\s+"?([\w.-]+)', re.M)
+RE_NAMESPACE = re.compile(r'^\s*namespace\s+"?([^";\s]+)', re.M)
+RE_IMPORT = re.compile(r'^\s*import\s+"?([\w.-]+)', re.M)
+RE_AUGMENTS = re.compile(r'^\s*(augment|deviation)\s', re.M)
+
+
+class FilterError(Exception):
+    pass
+
+
+def parse(text):
+    """Parse a filter, which may have more than one top-level element,
+    returning the top-level elements.
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    try:
+        return elements(etree.fromstring(b'<filter>' + text + b'</filter>'))
+    except etree.XMLSyntaxError as e:
+        raise FilterError('unparseable filter: %s' % e)
+
+
+def serialize(nodes):
+    return ''.join(etree.tostring(n, pretty_print=True).decode('utf-8') for n in nodes)
+
+
+def is_content_match(e):
+    return not elements(e) and bool((e.text or '').strip())
+
+
+def data_children(stmt):
+    """The children of a schema node in the data tree, looking through
+    choices and cases.
+    """
+    for s in getattr(stmt, 'i_children', []):
+        if s.keyword in ('choice', 'case'):
+            for c in data_children(s):
+                yield c
+        elif s.keyword in DATA_KEYWORDS:
+            yield s
+
+
+def list_keys(stmt):
+    """The names of the keys of a list.
+    """
+    k = stmt.search_one('key')
+    return [n.split(':')[-1] for n in k.arg.split()] if k is not None else []
+
+
+def node_bytes(name):
+    return 2 * len(name) + 5
+
+
+def leaf_bytes(name):
+    return node_bytes(name) + VALUE_BYTES
+
+
+class Schema(object):
+    """The schema trees of the YANG modules in a directory that define,
+    augment or deviate the given namespaces. A namespace no module has
+    is an error unless ignore_missing.
+    """
+
+    def __init__(self, schema_dir, namespaces, ignore_missing=False):
+        import pyang
+        self.ctx = pyang.Context(pyang.FileRepository(schema_dir))
+        self.namespaces = {}
+        self.children = {}
+        by_namespace = {}
+        importers = []
+        for fname in sorted(os.listdir(schema_dir)):
+            if not fname.endswith('.yang'):
+                continue
+            with open(os.path.join(schema_dir, fname)) as f:
+                text = f.read()
+            m = RE_MODULE.search(text)
+            if m is None:
+                continue
+            ns = RE_NAMESPACE.search(text)
+            if ns is not None:
+                by_namespace[ns.group(1)] = (m.group(1), fname, text)
+            if RE_AUGMENTS.search(text):
+                importers.append((set(RE_IMPORT.findall(text)), fname, text))
+
+        missing = [ns for ns in namespaces if ns not in by_namespace]
+        if missing and not ignore_missing:
+            raise FilterError('no module in %s has namespace %s' % (schema_dir, ', '.join(missing)))
+        namespaces = [ns for ns in namespaces if ns in by_namespace]
+        wanted = set(by_namespace[ns][0] for ns in namespaces)
+        load = [(fname, text) for (_, fname, text) in
+                (by_namespace[ns] for ns in sorted(set(namespaces)))]
+        load += [(fname, text) for (imports, fname, text) in importers
+                 if imports & wanted and (fname, text) not in load]
+        for (fname, text) in load:
+            self.ctx.add_module(fname, text)
+        self.ctx.validate()
+
+        self.top = {}
+        for module in self.ctx.modules.values():
+            if module.keyword != 'module':
+                continue
+            for s in data_children(module):
+                self.top[self.qname(s)] = s
+
+    def namespace(self, stmt):
+        name = stmt.i_module.i_modulename
+        if name not in self.namespaces:
+            module = self.ctx.get_module(name)
+            self.namespaces[name] = module.search_one('namespace').arg
+        return self.namespaces[name]
+
+    def qname(self, stmt):
+        return '{%s}%s' % (self.namespace(stmt), stmt.arg)
+
+    def child(self, stmt, tag):
+        if id(stmt) not in self.children:
+            self.children[id(stmt)] = dict((self.qname(s), s) for s in data_children(stmt))
+        return self.children[id(stmt)].get(tag)
+
+    def modules(self):
+        """A dict mapping the namespace of every module loaded, including
+        those imported, to its name.
+        """
+        result = {}
+        for module in self.ctx.modules.values():
+            ns = module.search_one('namespace')
+            if ns is not None:
+                result[ns.arg] = module.arg
+        return result
+
+    def full_bytes(self, stmt):
+        """The estimated bytes of everything under a schema node.
+        """
+        if stmt.keyword in LEAF_KEYWORDS:
+            return leaf_bytes(stmt.arg)
+        return node_bytes(stmt.arg) + sum(self.full_bytes(c) for c in data_children(stmt))
+
+
+def path_of(path):
+    return '/' + '/'.join(path)
+
+
+def validate(nodes, schema):
+    """Return a list of what in a filter doesn't match the schema: nodes
+    that don't exist where they are, and content match nodes on
+    anything but a leaf.
+    """
+    problems = []
+
+    def walk(e, stmt, path):
+        path = path + [etree.QName(e).localname]
+        if stmt is None:
+            problems.append('%s: no such node in the schema' % path_of(path))
+            return
+        if is_content_match(e) and stmt.keyword not in ('leaf', 'leaf-list'):
+            problems.append('%s: content match on a %s' % (path_of(path), stmt.keyword))
+        if elements(e) and stmt.keyword in LEAF_KEYWORDS:
+            problems.append('%s: children given for a %s' % (path_of(path), stmt.keyword))
+            return
+        for c in elements(e):
+            walk(c, schema.child(stmt, c.tag), path)
+
+    for e in nodes:
+        walk(e, schema.top.get(e.tag), [])
+    return problems
+
+
+def estimate(nodes, schema):
+    """The estimated bytes of the reply to a filter, as explained above.
+    """
+    def size(e, stmt):
+        if stmt is None:
+            return 0
+        if stmt.keyword in LEAF_KEYWORDS:
+            return leaf_bytes(stmt.arg)
+        selection = [c for c in elements(e) if not is_content_match(c)]
+        if not selection:
+            return schema.full_bytes(stmt)
+        content = [c for c in elements(e) if is_content_match(c)]
+        return (node_bytes(stmt.arg) +
+                sum(leaf_bytes(etree.QName(c).localname) for c in content) +
+                sum(size(c, schema.child(stmt, c.tag)) for c in selection))
+
+    return sum(size(e, schema.top.get(e.tag)) for e in nodes)
+
+
+def wanted(path, specs):
+    """Whether the leaf at path is one of those wanted, each given as its
+    name or the last few names of its path, separated by slashes.
+    """
+    for spec in specs:
+        if path[-len(spec):] == spec:
+            return True
+    return False
+
+
+def tighten(nodes, schema, leaves, matches=None):
+    """Rewrite a filter to select only the wanted leaves, as explained
+    above. leaves are leaf names or paths, and matches a dict mapping
+    leaf names or paths to values to add content match nodes for.
+    Returns the new top-level nodes and the leaves and matches that
+    were found nowhere under the filter.
+    """
+    matches = sorted((matches or {}).items())
+    specs = [l.strip('/').split('/') for l in leaves]
+    match_specs = [(m.strip('/').split('/'), v) for (m, v) in matches]
+    used = set()
+
+    def element(stmt, parent_ns):
+        ns = schema.namespace(stmt)
+        return etree.Element('{%s}%s' % (ns, stmt.arg), nsmap=None if ns == parent_ns else {None: ns})
+
+    def finish(out, stmt, path):
+        """Add the keys, if stmt is a list, and any matches on leaves of
+        stmt that aren't already in the filter.
+        """
+        present = set(etree.QName(c).localname for c in elements(out))
+        ns = schema.namespace(stmt)
+        index = 0
+        for s in data_children(stmt):
+            if s.keyword != 'leaf' or s.arg in present:
+                continue
+            for (i, (spec, value)) in enumerate(match_specs):
+                if wanted(path + [s.arg], [spec]):
+                    c = element(s, ns)
+                    c.text = value
+                    out.insert(index, c)
+                    index += 1
+                    present.add(s.arg)
+                    used.add(('match', i))
+                    break
+        if stmt.keyword == 'list':
+            for k in list_keys(stmt):
+                if k not in present:
+                    out.insert(index, element(schema.child(stmt, '{%s}%s' % (ns, k)), ns))
+                    index += 1
+        return out
+
+    def expand(out, stmt, path, skip=()):
+        """Add paths to the wanted leaves under stmt to out, returning
+        whether there were any.
+        """
+        found = False
+        ns = schema.namespace(stmt)
+        for s in data_children(stmt):
+            if s.arg in skip:
+                continue
+            p = path + [s.arg]
+            if s.keyword in LEAF_KEYWORDS:
+                for (i, spec) in enumerate(specs):
+                    if wanted(p, [spec]):
+                        out.append(element(s, ns))
+                        used.add(('leaf', i))
+                        found = True
+                        break
+            else:
+                c = element(s, ns)
+                if expand(c, s, p):
+                    out.append(finish(c, s, p))
+                    found = True
+        return found
+
+    def rewrite(e, stmt, path):
+        path = path + [stmt.arg]
+        out = etree.Element(e.tag, nsmap=e.nsmap)
+        content = [c for c in elements(e) if is_content_match(c)]
+        selection = [c for c in elements(e) if not is_content_match(c)]
+        for c in content:
+            m = copy.copy(c)
+            m.text = c.text.strip()
+            m.tail = None
+            out.append(m)
+        if not selection:
+            found = expand(out, stmt, path, skip=set(etree.QName(c).localname for c in content))
+        else:
+            found = False
+            for c in selection:
+                s = schema.child(stmt, c.tag)
+                if s is None:
+                    continue
+                if s.keyword in LEAF_KEYWORDS:
+                    for (i, spec) in enumerate(specs):
+                        if wanted(path + [s.arg], [spec]):
+                            out.append(etree.Element(c.tag))
+                            used.add(('leaf', i))
+                            found = True
+                            break
+                else:
+                    r = rewrite(c, s, path)
+                    if r is not None:
+                        out.append(r)
+                        found = True
+        if not found:
+            return None
+        return finish(out, stmt, path)
+
+    result = []
+    for e in nodes:
+        stmt = schema.top.get(e.tag)
+        if stmt is None:
+            continue
+        r = rewrite(e, stmt, [])
+        if r is not None:
+            result.append(r)
+    unused = [l for (i, l) in enumerate(leaves) if ('leaf', i) not in used]
+    unused += ['%s=%s' % (m, v) for (i, (m, v)) in enumerate(matches)
+               if ('match', i) not in used]
+    return result, unused
@@ -0,0 +1,57 @@
+"""Device inventories, shared by ncc.py and rc-xr.py.
+
+An inventory is either a JSON list or a plain text file with one device
+per line, lines starting with # being comments. JSON entries may be a
+simple "host[:port]" string or a dictionary overriding any of host,
+port, username, password and timeout; plain text lines are
+"host[:port]". Anything not given comes from the command line
+arguments.
+"""
+import json
+
+
+def split_host_port(text):
+    """Split "host[:port]" into the host and the port, or None if there
+    isn't one. An IPv6 address takes a port as "[address]:port"; a bare
+    one, with colons of its own, is all host.
+    """
+    if text.startswith('['):
+        h, _, rest = text[1:].partition(']')
+        p = rest[1:] if rest.startswith(':') else None
+    elif text.count(':') == 1:
+        h, _, p = text.partition(':')
+    else:
+        h, p = text, None
+    if p is not None and not p.isdigit():
+        raise ValueError('bad port in %s' % text)
+    return h, int(p) if p else None
+
+
+def load_hosts_file(filename, args):
+    """Load an inventory of devices, returning a dict of host, port,
+    username, password and timeout for each, with anything the file
+    doesn't give taken from the args.
+    """
+    with open(filename) as f:
+        text = f.read()
+    try:
+        entries = json.loads(text)
+    except ValueError:
+        entries = [l.strip() for l in text.splitlines()
+                   if l.strip() and not l.strip().startswith('#')]
+
+    hosts = []
+    for e in entries:
+        if not isinstance(e, dict):
+            h, p = split_host_port(e)
+            e = {'host': h}
+            if p:
+                e['port'] = p
+        hosts.append({
+            'host': e['host'],
+            'port': int(e.get('port', args.port)),
+            'username': e.get('username', args.username),
+            'password': e.get('password', args.password),
+            'timeout': int(e.get('timeout', args.timeout)),
+        })
+    return hosts
@@ -0,0 +1,160 @@
+"""Write NETCONF reply data out incrementally as XML, JSON or NDJSON.
+
+Each subtree is serialized straight to the output file as it is walked
+and then freed, so we never build a second, serialized copy of the
+whole reply in memory the way etree.tostring() does.
+
+The JSON produced is a straightforward, schema-less mapping of the XML:
+elements become members named by their local name, repeated sibling
+elements become arrays, and leaves become strings (or null if empty).
+NDJSON writes one JSON record per line for each "entry" in the reply,
+that is, the outermost elements that either repeat or directly hold
+leaves, which in practice means one record per list entry.
+"""
+import json
+from lxml import etree
+
+FORMATS = ['xml', 'json', 'ndjson']
+
+
+def localname(e):
+    return etree.QName(e).localname
+
+
+def elements(e):
+    """The element children of e, skipping comments and processing
+    instructions.
+    """
+    return list(e.iterchildren(tag=etree.Element))
+
+
+def release(e):
+    """Free a subtree that has been written out, along with any siblings
+    before it, which have been written out already too.
+    """
+    e.clear()
+    parent = e.getparent()
+    if parent is not None:
+        while e.getprevious() is not None:
+            del parent[0]
+
+
+def to_dict(e):
+    """Convert a (small) subtree into plain Python values.
+    """
+    children = elements(e)
+    if not children:
+        return e.text if e.text else None
+    dups = repeated(children)
+    d = {}
+    for c in children:
+        name = localname(c)
+        if name in dups:
+            d.setdefault(name, []).append(to_dict(c))
+        else:
+            d[name] = to_dict(c)
+    return d
+
+
+def repeated(children):
+    """The set of local names that occur more than once among children.
+    """
+    seen = set()
+    dups = set()
+    for c in children:
+        name = localname(c)
+        if name in seen:
+            dups.add(name)
+        seen.add(name)
+    return dups
+
+
+def write_xml(data, f):
+    """Write the data element and its children, one top-level subtree
+    at a time.
+    """
+    with etree.xmlfile(f, encoding='utf-8') as xf:
+        with xf.element(data.tag, nsmap=data.nsmap):
+            xf.write('\n')
+            child = data[0] if len(data) else None
+            while child is not None:
+                following = child.getnext()
+                xf.write(child, pretty_print=True)
+                release(child)
+                child = following
+    f.write(b'\n')
+
+
+def _write_json(e, f, depth):
+    children = elements(e)
+    if not children:
+        f.write(json.dumps(e.text if e.text else None).encode('utf-8'))
+        release(e)
+        return
+    pad = b'\n' + b' ' * (depth + 1)
+    f.write(b'{')
+
+    #
+    # Group repeated siblings so that they can be written as an array,
+    # keeping the order in which each name first appears.
+    #
+    groups = []
+    by_name = {}
+    for c in children:
+        name = localname(c)
+        if name not in by_name:
+            by_name[name] = []
+            groups.append((name, by_name[name]))
+        by_name[name].append(c)
+
+    for i, (name, group) in enumerate(groups):
+        f.write((b',' if i else b'') + pad)
+        f.write(json.dumps(name).encode('utf-8') + b': ')
+        if len(group) > 1:
+            f.write(b'[')
+            for j, c in enumerate(group):
+                f.write((b',' if j else b'') + pad + b' ')
+                _write_json(c, f, depth + 2)
+            f.write(pad + b']')
+        else:
+            _write_json(group[0], f, depth + 1)
+    f.write(b'\n' + b' ' * depth + b'}')
+    release(e)
+
+
+def write_json(data, f):
+    """Write the whole reply as a single JSON object.
+    """
+    _write_json(data, f, 0)
+    f.write(b'\n')
+
+
+def entries(e, path=''):
+    """Yield (path, element) for each entry under e; see above.
+    """
+    children = elements(e)
+    dups = repeated(children)
+    for c in children:
+        name = localname(c)
+        grandchildren = elements(c)
+        if name in dups or any(not elements(g) for g in grandchildren):
+            yield ('%s/%s' % (path, name), c)
+        elif grandchildren:
+            for entry in entries(c, '%s/%s' % (path, name)):
+                yield entry
+        else:
+            yield ('%s/%s' % (path, name), c)
+
+
+def write_ndjson(data, f):
+    """Write one JSON record per entry, each as its own line.
+    """
+    for path, e in entries(data):
+        f.write(json.dumps({'path': path, 'entry': to_dict(e)}).encode('utf-8') + b'\n')
+        release(e)
+
+
+def write(data, f, fmt):
+    """Write data to binary file f in the given format.
+    """
+    {'xml': write_xml, 'json': write_json, 'ndjson': write_ndjson}[fmt](data, f)
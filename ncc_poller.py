@@ -0,0 +1,399 @@
+"""A poller engine that runs many (device, filter, cadence) jobs from
+one process.
+
+Jobs are kept on a heap ordered by when each is next due. Due times are
+fixed cadence boundaries (aligned to the wall clock, so a 10 second
+cadence samples at :00, :10, :20, ...) and are tracked on a monotonic
+clock, so the interval doesn't drift by however long each RPC takes.
+Due jobs have their gets sent asynchronously, straight from the
+scheduling thread, on sessions reused from an nccd.SessionPool, and the
+replies are handled on the threads ncclient reads each session with, so
+however many gets are in flight no thread waits on any of them. Only
+connecting, which blocks for the SSH and NETCONF handshakes, is handed
+to a pool of worker threads. A job still in flight when it next falls
+due has that sample counted as missed rather than queued up behind it,
+one whose reply hasn't arrived within the device's timeout is failed and
+its session dropped, and one that starts more than a fraction of its
+cadence late is counted as late.
+"""
+import sys
+import time
+import socket
+import heapq
+import threading
+import itertools
+from array import array
+from multiprocessing.pool import ThreadPool
+from lxml import etree
+from nccd import SessionPool
+from ncc_async import AsyncManager
+from ncclient.transport import TransportError
+from ncclient.operations.errors import TimeoutExpiredError
+from ncc_output import elements, repeated, localname
+
+#
+# Python 2 has no monotonic clock in the standard library; fall back to
+# the wall clock there.
+#
+clock = getattr(time, 'monotonic', time.time)
+
+
+def display_values(data, tags):
+    """Find the text of the first element with each of the given tag
+    names, ignoring namespaces, in a single pass over the reply.
+    """
+    wanted = set(tags)
+    found = {}
+    for e in data.iter(tag=etree.Element):
+        tag = etree.QName(e).localname
+        if tag in wanted and tag not in found:
+            found[tag] = ''.join(e.itertext())
+            if len(found) == len(wanted):
+                break
+    return found
+
+
+def counter_values(data, tags):
+    """Return (key, value) for every integer leaf in data whose local name
+    is in tags. The key identifies the counter from one sample to the
+    next: it is the path of local names to the leaf, with every element
+    whose first child is a leaf qualified by that leaf, which for a list
+    entry in a NETCONF reply is the list key. Qualifying whether or not
+    the entry has siblings keeps the key the same as a list grows from
+    one entry to more and back. The first leaf of an element holding
+    counters wanted is more likely another counter, changing from sample
+    to sample, than a key, so such an element is only qualified when it
+    is repeated among its siblings, and never by a counter wanted.
+    Siblings that would still end up with the same path, such as entries
+    of a list without keys or whose first child isn't a leaf, are told
+    apart by their position among them, so no two counters in a sample
+    share a key.
+    """
+    wanted = set(tags)
+    values = []
+
+    def walk(e, path):
+        children = elements(e)
+        dups = repeated(children)
+        paths = []
+        for c in children:
+            name = localname(c)
+            grandchildren = elements(c)
+            p = '%s/%s' % (path, name)
+            if grandchildren:
+                first = grandchildren[0]
+                counters = any(localname(g) in wanted and not elements(g) for g in grandchildren)
+                if (not elements(first) and localname(first) not in wanted
+                        and (name in dups or not counters)):
+                    p = '%s[%s=%s]' % (p, localname(first), first.text)
+            paths.append((c, name, grandchildren, p))
+        clashes = repeated_paths(p for (_, _, _, p) in paths)
+        positions = {}
+        for (c, name, grandchildren, p) in paths:
+            if p in clashes:
+                positions[p] = positions.get(p, 0) + 1
+                p = '%s[%d]' % (p, positions[p])
+            if grandchildren:
+                walk(c, p)
+            elif name in wanted:
+                try:
+                    values.append((p, int(c.text)))
+                except (TypeError, ValueError):
+                    pass
+
+    walk(data, '')
+    return values
+
+
+def repeated_paths(paths):
+    """The set of paths that occur more than once.
+    """
+    seen = set()
+    dups = set()
+    for p in paths:
+        if p in seen:
+            dups.add(p)
+        seen.add(p)
+    return dups
+
+
+class RateTracker(object):
+    """Keeps the previous sample of every counter, per job, to turn
+    cumulative counters into deltas and per-second rates.
+
+    Each counter gets a slot the first time it is seen; previous values
+    and timestamps are kept in flat per-slot arrays rather than a dict
+    of objects per counter, so a reply with thousands of interfaces is
+    handled in one pass over a compact store. The slots of a job's
+    counters missing from its latest sample, such as those of a deleted
+    interface, are freed for reuse, so the store doesn't grow with churn.
+
+    A counter that goes backwards has either wrapped or been reset (say,
+    by a reboot or a clear). A 32-bit counter that was in the top half of
+    its range is taken to have wrapped; anything else is taken to have
+    been reset, and has no delta or rate for that sample.
+    """
+
+    COUNTER32 = 2 ** 32
+
+    def __init__(self):
+        self.slots = {}
+        self.values = []
+        self.times = array('d')
+        self.free = []
+        self.job_keys = {}
+        self.lock = threading.Lock()
+
+    def update(self, job, timestamp, samples):
+        """Record a job's (key, value) samples taken at timestamp and return
+        (key, value, delta, rate) for each, with delta and rate None for
+        a counter's first sample or after a reset.
+        """
+        results = []
+        with self.lock:
+            seen = set()
+            for key, value in samples:
+                seen.add(key)
+                slot = self.slots.get((job, key))
+                if slot is None:
+                    if self.free:
+                        slot = self.free.pop()
+                        self.values[slot] = value
+                        self.times[slot] = timestamp
+                    else:
+                        slot = len(self.values)
+                        self.values.append(value)
+                        self.times.append(timestamp)
+                    self.slots[(job, key)] = slot
+                    results.append((key, value, None, None))
+                    continue
+                prev, prev_time = self.values[slot], self.times[slot]
+                self.values[slot] = value
+                self.times[slot] = timestamp
+                delta = value - prev
+                if delta < 0:
+                    if self.COUNTER32 // 2 <= prev < self.COUNTER32:
+                        delta += self.COUNTER32
+                    else:
+                        results.append((key, value, None, None))
+                        continue
+                elapsed = timestamp - prev_time
+                results.append((key, value, delta, delta / elapsed if elapsed > 0 else None))
+            for key in self.job_keys.get(job, set()) - seen:
+                self.free.append(self.slots.pop((job, key)))
+            self.job_keys[job] = seen
+        return results
+
+
+class Job(object):
+    """One device, filter and cadence to poll, with its statistics.
+    """
+
+    def __init__(self, device, filter=None, xpath=None, cadence=5, display_tags=None,
+                 name=None, rates=None, measurement='ncc'):
+        self.device = device
+        self.filter = filter
+        self.xpath = xpath
+        self.cadence = cadence
+        self.timeout = int(device.get('timeout', 60))
+        self.display_tags = display_tags
+        self.rates = rates
+        self.measurement = measurement
+        self.name = name or '%s:%s' % (device['host'], device.get('port', 830))
+        self.running = False
+        self.samples = 0
+        self.missed = 0
+        self.late = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def get(self, m):
+        """Get the job's data with a manager, or send the get with an
+        AsyncManager and return a Future of the reply.
+        """
+        if self.filter:
+            return m.get(filter=('subtree', self.filter))
+        return m.get(filter=('xpath', self.xpath))
+
+    def report(self):
+        return '%s: %d samples, %d missed, %d late, %d failed, latency avg %.3fs max %.3fs' % (
+            self.name, self.samples, self.missed, self.late, self.failed,
+            self.latency_total / self.samples if self.samples else 0.0,
+            self.latency_max)
+
+
+class Poller(object):
+    """Schedule and run a set of jobs. on_sample(job, timestamp, reply) is
+    called for every successful sample, with the wall clock time of the
+    cadence boundary the sample was due at, and on_error(job, timestamp,
+    exception) for every failed one. Both are called from whichever
+    thread the reply or error turns up on. workers is the number of
+    devices that can be connecting at once.
+    """
+
+    def __init__(self, jobs, on_sample, on_error=None, workers=16, pool=None, late_fraction=0.1):
+        self.jobs = jobs
+        self.on_sample = on_sample
+        self.on_error = on_error
+        self.workers = ThreadPool(max(1, min(workers, len(jobs))))
+        self.pool = pool or SessionPool()
+        self.late_fraction = late_fraction
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.inflight = {}
+
+    def poll(self, job, due, timestamp):
+        """Start a sample, sending the get now if the device already has a
+        session, or once a worker has connected to it if not.
+        """
+        start = clock()
+        if start - due > job.cadence * self.late_fraction:
+            with self.lock:
+                job.late += 1
+        s = self.pool.cached(job.device)
+        if s is None:
+            self.workers.apply_async(self.connect_and_send, (job, start, timestamp))
+        else:
+            self.send(job, s, start, timestamp)
+
+    def connect_and_send(self, job, start, timestamp):
+        try:
+            s = self.pool.session(job.device)
+        except Exception as e:
+            self.failed(job, timestamp, e)
+            return
+        self.send(job, s, start, timestamp)
+
+    def send(self, job, s, start, timestamp):
+        try:
+            future = job.get(AsyncManager(s.m))
+        except Exception as e:
+            self.failed(job, timestamp, e)
+            return
+        with self.lock:
+            self.inflight[job] = (future, start + job.timeout)
+        future.add_done_callback(lambda f: self.complete(job, s, start, timestamp, f))
+
+    def complete(self, job, s, start, timestamp, future):
+        with self.lock:
+            self.inflight.pop(job, None)
+        e = future.exception(0)
+        if e is not None:
+            if isinstance(e, (TransportError, socket.error, EOFError, TimeoutExpiredError)):
+                #
+                # A get that timed out is still registered with the
+                # session, waiting for a reply that may never come, so
+                # the session goes too rather than collecting them.
+                #
+                # This may well be the session's own reader thread, which
+                # closing the session would wait on, so leave that to a
+                # thread of its own.
+                #
+                t = threading.Thread(target=self.pool.discard, args=(job.device, s))
+                t.daemon = True
+                t.start()
+            self.failed(job, timestamp, e)
+            return
+        elapsed = clock() - start
+        with self.lock:
+            job.samples += 1
+            job.latency_total += elapsed
+            job.latency_max = max(job.latency_max, elapsed)
+        try:
+            self.on_sample(job, timestamp, future.result(0))
+        except Exception as e:
+            self.failed(job, timestamp, e)
+            return
+        job.running = False
+
+    def failed(self, job, timestamp, e):
+        with self.lock:
+            job.failed += 1
+        try:
+            if self.on_error:
+                self.on_error(job, timestamp, e)
+        finally:
+            job.running = False
+
+    def expire(self, now):
+        """Fail the gets that have been waiting for a reply for longer than
+        their device's timeout, returning when the next one will expire.
+        """
+        with self.lock:
+            expired = [(f, job) for (job, (f, deadline)) in self.inflight.items() if deadline <= now]
+            pending = [deadline for (f, deadline) in self.inflight.values() if deadline > now]
+        for (f, job) in expired:
+            f.set_exception(TimeoutExpiredError(
+                'no reply from %s within %ds' % (job.name, job.timeout)))
+        return min(pending) if pending else None
+
+    def run(self, duration=None):
+        """Run until stop() is called or for duration seconds.
+        """
+        #
+        # Work out the offset between wall clock and monotonic time
+        # once, so due times can be aligned to wall clock boundaries but
+        # tracked monotonically.
+        #
+        if not self.jobs:
+            return
+        offset = time.time() - clock()
+        end = clock() + duration if duration else None
+        counter = itertools.count()
+        heap = []
+        for job in self.jobs:
+            first = (int((clock() + offset) / job.cadence) + 1) * job.cadence - offset
+            heapq.heappush(heap, (first, next(counter), job))
+
+        while not self.stopped.is_set():
+            due, _, job = heap[0]
+            now = clock()
+            if end is not None and min(due, now) >= end:
+                break
+            if due > now:
+                wake = min(due, end or due)
+                expiry = self.expire(now)
+                if expiry is not None:
+                    wake = min(wake, expiry)
+                self.stopped.wait(wake - now)
+                continue
+            heapq.heappop(heap)
+
+            if job.running:
+                job.missed += 1
+            else:
+                job.running = True
+                self.poll(job, due, due + offset)
+
+            #
+            # Schedule the next boundary, counting any we've already
+            # slipped past as missed.
+            #
+            due += job.cadence
+            while due <= now:
+                job.missed += 1
+                due += job.cadence
+            heapq.heappush(heap, (due, next(counter), job))
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        """Wait for any samples still connecting or in flight, then close
+        the sessions.
+        """
+        self.workers.close()
+        self.workers.join()
+        while True:
+            with self.lock:
+                if not self.inflight:
+                    break
+            self.expire(clock())
+            time.sleep(0.05)
+        self.pool.close_all()
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        for job in self.jobs:
+            out.write('%s\n' % job.report())
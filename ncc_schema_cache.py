@@ -0,0 +1,113 @@
+"""A content-addressed on-disk cache of YANG schemas, shared across
+devices.
+
+Devices running the same software advertise identical schemas, so the
+first device a schema is seen on pays for the download and every other
+device gets a hard link (or a symlink if the cache is on another
+filesystem) to the cached copy.
+
+The cache directory looks like:
+
+    objects/<sha256 of schema text>.yang
+    index/<module>@<revision>-<entry hash>
+
+where the entry hash is over the identifier, version and namespace from
+the device's netconf-state schema entry, and each index file just holds
+the sha256 of the schema text. Everything is written to a temporary file
+and renamed into place, so several processes can share one cache.
+"""
+import os
+import errno
+import hashlib
+import threading
+import tempfile
+from os.path import join, exists
+
+
+def entry_key(identifier, version, namespace):
+    """The cache key for a netconf-state schema entry.
+    """
+    h = hashlib.sha256(('%s\n%s\n%s' % (identifier, version or '', namespace or '')).encode('utf-8'))
+    return '%s@%s-%s' % (identifier, version or 'unknown', h.hexdigest()[:16])
+
+
+class SchemaCache(object):
+    """A shared schema cache rooted at cache_dir, counting hits and
+    misses as it goes.
+    """
+
+    def __init__(self, cache_dir, symlink=False):
+        self.cache_dir = cache_dir
+        self.symlink = symlink
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+        for d in ('objects', 'index'):
+            try:
+                os.makedirs(join(cache_dir, d))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _write(self, path, data, mode=None):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.rename(tmp, path)
+
+    def _object(self, digest):
+        return join(self.cache_dir, 'objects', digest + '.yang')
+
+    def lookup(self, key):
+        """Return the path of the cached schema for key, or None, counting
+        the hit or miss.
+        """
+        try:
+            with open(join(self.cache_dir, 'index', key)) as f:
+                obj = self._object(f.read().strip())
+                f.close()
+        except IOError:
+            obj = None
+        if obj is not None and exists(obj):
+            with self.lock:
+                self.hits += 1
+                self.bytes_saved += os.path.getsize(obj)
+            return obj
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def store(self, key, data):
+        """Add downloaded schema text (bytes) to the cache under key and
+        return the path of the cached copy. Cached copies are read-only,
+        since any device directory may hold a hard link to them.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        obj = self._object(digest)
+        if not exists(obj):
+            self._write(obj, data, mode=0o444)
+        self._write(join(self.cache_dir, 'index', key), digest.encode('ascii'))
+        return obj
+
+    def link(self, obj, dest):
+        """Populate dest with the cached schema obj.
+        """
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        if not self.symlink:
+            try:
+                os.link(obj, dest)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        os.symlink(os.path.abspath(obj), dest)
+
+    def summary(self):
+        return 'Schema cache: %d hits, %d misses, %.1f KB not downloaded' % (
+            self.hits, self.misses, self.bytes_saved / 1024.0)
@@ -0,0 +1,1233 @@
+#!/usr/bin/env python
+"""A NETCONF-over-SSH device simulator, so that the scripts here can be
+exercised, measured and tested without a real router.
+
+The simulated device listens on localhost (port 8830 by default) and
+speaks NETCONF 1.0 and 1.1 framing over an SSH netconf subsystem, with:
+
+  * a configurable capability list, defaulting to candidate,
+    confirmed-commit, rollback-on-error, validate and xpath, plus a
+    capability for every module it has a schema for;
+  * schemas listed under netconf-state and served by get-schema, either
+    the YANG files in a directory or a canned set of synthetic modules;
+  * running and candidate datastores supporting get-config,
+    edit-config (merge, replace, create, delete and remove), commit,
+    confirmed commit, cancel-commit, discard-changes, lock, unlock and
+    validate;
+  * synthetic operational data, sized by the number of interfaces, for
+    the models the filters in snippets/filters ask for, with counters
+    that increase steadily so that rates can be polled;
+  * subtree and XPath filtering of get and get-config;
+  * injectable latency, jitter, rpc-errors and dropped sessions, per
+    operation.
+
+Without a schema, list entries in edits are matched on their first
+leaf, as NETCONF puts list keys first, and a leaf repeated in an edit
+is taken to be a leaf-list.
+
+Simulator can also be run in-process, on a port of its own choosing,
+by benchmarks and tests.
+"""
+import io
+import os
+import re
+import sys
+import copy
+import time
+import random
+import socket
+import logging
+import threading
+import itertools
+from argparse import ArgumentParser
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+import paramiko
+from lxml import etree
+from ncc_config import NC_NS, OPERATION, is_leaf, text, key
+from ncc_output import elements, localname
+
+
+NCM_NS = 'urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring'
+BASE_1_0 = 'urn:ietf:params:netconf:base:1.0'
+BASE_1_1 = 'urn:ietf:params:netconf:base:1.1'
+CANDIDATE = 'urn:ietf:params:netconf:capability:candidate:1.0'
+CONFIRMED_COMMIT = 'urn:ietf:params:netconf:capability:confirmed-commit:'
+WRITABLE_RUNNING = 'urn:ietf:params:netconf:capability:writable-running:1.0'
+
+DEFAULT_CAPABILITIES = [
+    BASE_1_0,
+    BASE_1_1,
+    CANDIDATE,
+    CONFIRMED_COMMIT + '1.0',
+    CONFIRMED_COMMIT + '1.1',
+    'urn:ietf:params:netconf:capability:rollback-on-error:1.0',
+    'urn:ietf:params:netconf:capability:validate:1.1',
+    'urn:ietf:params:netconf:capability:xpath:1.0',
+]
+
+DEFAULT_PORT = 8830
+
+#
+# End of message marker for NETCONF 1.0 framing.
+#
+EOM = b']]>]]>'
+
+XR_IM_NS = 'http://cisco.com/ns/yang/Cisco-IOS-XR-pfi-im-cmd-oper'
+XR_QOS_NS = 'http://cisco.com/ns/yang/Cisco-IOS-XR-qos-ma-oper'
+OC_IF_NS = 'http://openconfig.net/yang/interfaces'
+OC_BGP_NS = 'http://openconfig.net/yang/bgp'
+IETF_IF_NS = 'urn:ietf:params:xml:ns:yang:ietf-interfaces'
+IANA_IF_NS = 'urn:ietf:params:xml:ns:yang:iana-if-type'
+
+#
+# The canned schemas: (module, revision, namespace, prefix, imports).
+# The data models the simulator has operational data for, plus those
+# of the configuration filters in snippets/filters.
+#
+CANNED_SCHEMAS = [
+    ('ietf-netconf-monitoring', '2010-10-04', NCM_NS, 'ncm', []),
+    ('iana-if-type', '2014-05-08', IANA_IF_NS, 'ianaift', []),
+    ('ietf-interfaces', '2014-05-08', IETF_IF_NS, 'if', []),
+    ('openconfig-interfaces', '2016-05-26', OC_IF_NS, 'oc-if', ['ietf-interfaces']),
+    ('openconfig-bgp', '2016-06-21', OC_BGP_NS, 'oc-bgp', []),
+    ('Cisco-IOS-XR-pfi-im-cmd-oper', '2015-11-09', XR_IM_NS, 'pfi-im-cmd-oper', []),
+    ('Cisco-IOS-XR-qos-ma-oper', '2015-11-09', XR_QOS_NS, 'qos-ma-oper', []),
+    ('Cisco-IOS-XR-ipv4-acl-cfg', '2015-11-09',
+     'http://cisco.com/ns/yang/Cisco-IOS-XR-ipv4-acl-cfg', 'ipv4-acl-cfg', []),
+    ('Cisco-IOS-XR-ethernet-lldp-cfg', '2015-11-09',
+     'http://cisco.com/ns/yang/Cisco-IOS-XR-ethernet-lldp-cfg', 'ethernet-lldp-cfg', []),
+    ('Cisco-IOS-XR-telemetry-model-driven-cfg', '2015-11-09',
+     'http://cisco.com/ns/yang/Cisco-IOS-XR-telemetry-model-driven-cfg',
+     'telemetry-model-driven-cfg', []),
+    ('Cisco-IOS-XR-ipv4-vrrp-cfg', '2015-11-09',
+     'http://cisco.com/ns/yang/Cisco-IOS-XR-ipv4-vrrp-cfg', 'ipv4-vrrp-cfg', []),
+]
+
+log = logging.getLogger('ncc_simulator')
+
+
+class NetconfError(Exception):
+    """An operation failed, to be returned as an rpc-error.
+    """
+    def __init__(self, tag, message, type='application', info=None):
+        Exception.__init__(self, message)
+        self.tag = tag
+        self.type = type
+        self.info = info or {}
+
+
+class SessionDropped(Exception):
+    """The session is to be closed without a reply.
+    """
+    pass
+
+
+def yang_module(name, revision, namespace, prefix, imports=(), leaves=40):
+    """The text of a synthetic YANG module, with a container of string
+    leaves to give it some bulk.
+    """
+    lines = ['module %s {' % name,
+             '  namespace "%s";' % namespace,
+             '  prefix %s;' % prefix]
+    for i in imports:
+        lines += ['  import %s {' % i, '    prefix %s;' % i, '  }']
+    lines += ['  organization "ncc simulator";',
+              '  description "Synthetic module served by the ncc simulator.";',
+              '  revision %s {' % revision,
+              '    description "Synthetic revision.";',
+              '  }',
+              '  container %s {' % name]
+    for n in range(leaves):
+        lines += ['    leaf leaf-%d {' % n,
+                  '      type string;',
+                  '      description "Synthetic leaf %d of %s.";' % (n, name),
+                  '    }']
+    lines += ['  }', '}', '']
+    return '\n'.join(lines)
+
+
+def canned_schemas(extra=0):
+    """Schemas for the canned modules, plus extra synthetic ones, each
+    importing another so that there is a dependency graph to follow.
+    """
+    schemas = []
+    for (name, revision, namespace, prefix, imports) in CANNED_SCHEMAS:
+        schemas.append({
+            'identifier': name,
+            'version': revision,
+            'namespace': namespace,
+            'prefix': prefix,
+            'module': True,
+            'text': yang_module(name, revision, namespace, prefix, imports),
+        })
+    for i in range(extra):
+        name = 'sim-module-%04d' % i
+        imports = ['sim-module-%04d' % ((i - 1) // 2)] if i else []
+        namespace = 'urn:ncc:simulator:%s' % name
+        schemas.append({
+            'identifier': name,
+            'version': '2017-01-01',
+            'namespace': namespace,
+            'prefix': 'sim%d' % i,
+            'module': True,
+            'text': yang_module(name, '2017-01-01', namespace, 'sim%d' % i, imports),
+        })
+    return schemas
+
+
+def load_schemas(schema_dir):
+    """Schemas for the YANG files in a directory, identified by the module
+    or submodule they define, at their most recent revision.
+    """
+    schemas = []
+    namespaces = {}
+    for fname in sorted(os.listdir(schema_dir)):
+        if not fname.endswith('.yang'):
+            continue
+        with io.open(os.path.join(schema_dir, fname), encoding='utf-8') as f:
+            source = f.read()
+            f.close()
+        m = re.search(r'^\s*(module|submodule)\s+"?([\w.-]+)', source, re.M)
+        if not m:
+            log.warning('%s defines no module, skipping it', fname)
+            continue
+        revisions = re.findall(r'^\s*revision\s+"?(\d{4}-\d{2}-\d{2})', source, re.M)
+        schema = {
+            'identifier': m.group(2),
+            'version': max(revisions) if revisions else '',
+            'module': m.group(1) == 'module',
+            'text': source,
+        }
+        if schema['module']:
+            ns = re.search(r'^\s*namespace\s+"?([^";\s]+)', source, re.M)
+            prefix = re.search(r'^\s*prefix\s+"?([\w.-]+)', source, re.M)
+            schema['namespace'] = ns.group(1) if ns else ''
+            schema['prefix'] = prefix.group(1) if prefix else None
+            namespaces[schema['identifier']] = schema['namespace']
+        else:
+            belongs = re.search(r'^\s*belongs-to\s+"?([\w.-]+)', source, re.M)
+            schema['belongs_to'] = belongs.group(1) if belongs else None
+        schemas.append(schema)
+
+    #
+    # Submodules are listed with the namespace of their module.
+    #
+    for s in schemas:
+        if not s['module']:
+            s['namespace'] = namespaces.get(s.pop('belongs_to'), '')
+    return schemas
+
+
+def module_capability(schema):
+    c = '%s?module=%s' % (schema['namespace'], schema['identifier'])
+    if schema['version']:
+        c += '&revision=%s' % schema['version']
+    return c
+
+
+def read_capabilities(filename):
+    """Read capabilities one per line, as ncc.py --capabilities writes
+    them, ignoring blank lines and # comments.
+    """
+    with open(filename) as f:
+        caps = [l.strip() for l in f if l.strip() and not l.strip().startswith('#')]
+        f.close()
+    return caps
+
+
+def sub(parent, tag, value=None):
+    """Add a child element in the parent's namespace.
+    """
+    e = etree.SubElement(parent, '{%s}%s' % (etree.QName(parent).namespace, tag))
+    if value is not None:
+        e.text = '%s' % value
+    return e
+
+
+class OperData(object):
+    """Synthetic operational data for n interfaces (and a tenth as many
+    BGP neighbors), generated once. Counters are recalculated from
+    their start value and rate at most once a second, as they are
+    read.
+    """
+
+    def __init__(self, interfaces=24, seed=0):
+        self.start = time.time()
+        self.updated = None
+        self.counters = []
+        self.random = random.Random(seed)
+        names = ['GigabitEthernet0/0/%d/%d' % (i // 48, i % 48) for i in range(interfaces)]
+        self.roots = [
+            self.xr_interfaces(names),
+            self.xr_qos(names),
+            self.oc_interfaces(names),
+            self.ietf_interfaces_state(names),
+            self.oc_bgp(max(1, interfaces // 10)),
+        ]
+
+    def counter(self, parent, tag, rate):
+        """Add a counter increasing at about the given rate per second,
+        starting from up to a month's worth.
+        """
+        e = sub(parent, tag)
+        self.counters.append((e, self.random.randint(0, int(rate * 30 * 86400)),
+                              rate * self.random.uniform(0.5, 1.5)))
+        return e
+
+    def packet_counters(self, parent, received, sent, packets='packets', octets='bytes'):
+        pps = self.random.randint(10, 10000)
+        self.counter(parent, received % packets, pps)
+        self.counter(parent, received % octets, pps * 500)
+        self.counter(parent, sent % packets, pps)
+        self.counter(parent, sent % octets, pps * 500)
+
+    def xr_interfaces(self, names):
+        root = etree.Element('{%s}interfaces' % XR_IM_NS, nsmap={None: XR_IM_NS})
+        briefs = sub(root, 'interface-briefs')
+        for name in names:
+            b = sub(briefs, 'interface-brief')
+            sub(b, 'interface-name', name)
+            sub(b, 'interface', name)
+            sub(b, 'type', 'IFT_GETHERNET')
+            sub(b, 'state', 'im-state-up')
+            sub(b, 'actual-state', 'im-state-up')
+            sub(b, 'line-state', 'im-state-up')
+            sub(b, 'encapsulation', 'ether')
+            sub(b, 'mtu', 1514)
+            sub(b, 'bandwidth', 1000000)
+        xr = sub(root, 'interface-xr')
+        for n, name in enumerate(names):
+            i = sub(xr, 'interface')
+            sub(i, 'interface-name', name)
+            sub(i, 'interface-handle', name)
+            sub(i, 'interface-type', 'IFT_GETHERNET')
+            sub(i, 'state', 'im-state-up')
+            sub(i, 'line-state', 'im-state-up')
+            sub(i, 'mtu', 1514)
+            sub(i, 'description', 'simulated interface %d' % n)
+            stats = sub(i, 'interface-statistics')
+            sub(stats, 'stats-type', 'full')
+            full = sub(stats, 'full-interface-stats')
+            self.packet_counters(full, '%s-received', '%s-sent')
+            self.counter(full, 'multicast-packets-received', 5)
+            self.counter(full, 'broadcast-packets-received', 1)
+            for c in ['input-drops', 'input-errors', 'output-drops', 'output-errors', 'crc-errors']:
+                self.counter(full, c, 0.01)
+        return root
+
+    def xr_qos(self, names):
+        root = etree.Element('{%s}qos' % XR_QOS_NS, nsmap={None: XR_QOS_NS})
+        table = sub(root, 'interface-table')
+        for name in names:
+            i = sub(table, 'interface')
+            sub(i, 'interface-name', name)
+            for direction, policy in (('input', 'INGRESS'), ('output', 'EGRESS')):
+                instance = sub(sub(sub(i, direction), 'service-policy-names'), 'service-policy-instance')
+                sub(instance, 'service-policy-name', policy)
+                stats = sub(instance, 'statistics')
+                sub(stats, 'policy-name', policy)
+                sub(stats, 'state', 'active')
+                cs = sub(stats, 'class-stats')
+                sub(cs, 'class-name', 'class-default')
+                general = sub(cs, 'general-stats')
+                pps = self.random.randint(10, 10000)
+                self.counter(general, 'transmit-packets', pps)
+                self.counter(general, 'transmit-bytes', pps * 500)
+                self.counter(general, 'total-drop-packets', 0.1)
+        return root
+
+    def oc_interfaces(self, names):
+        root = etree.Element('{%s}interfaces' % OC_IF_NS,
+                             nsmap={None: OC_IF_NS, 'ianaift': IANA_IF_NS})
+        for n, name in enumerate(names):
+            i = sub(root, 'interface')
+            sub(i, 'name', name)
+            config = sub(i, 'config')
+            sub(config, 'name', name)
+            sub(config, 'type', 'ianaift:ethernetCsmacd')
+            sub(config, 'mtu', 1514)
+            sub(config, 'description', 'simulated interface %d' % n)
+            sub(config, 'enabled', 'true')
+            state = sub(i, 'state')
+            sub(state, 'name', name)
+            sub(state, 'type', 'ianaift:ethernetCsmacd')
+            sub(state, 'mtu', 1514)
+            sub(state, 'enabled', 'true')
+            sub(state, 'admin-status', 'UP')
+            sub(state, 'oper-status', 'UP')
+            counters = sub(state, 'counters')
+            self.packet_counters(counters, 'in-%s', 'out-%s', 'unicast-pkts', 'octets')
+            for c in ['in-errors', 'in-discards', 'out-errors', 'out-discards']:
+                self.counter(counters, c, 0.01)
+            s = sub(sub(i, 'subinterfaces'), 'subinterface')
+            sub(s, 'index', 0)
+            sub(sub(s, 'config'), 'index', 0)
+            sub(sub(s, 'state'), 'index', 0)
+        return root
+
+    def ietf_interfaces_state(self, names):
+        root = etree.Element('{%s}interfaces-state' % IETF_IF_NS,
+                             nsmap={None: IETF_IF_NS, 'ianaift': IANA_IF_NS})
+        for n, name in enumerate(names):
+            i = sub(root, 'interface')
+            sub(i, 'name', name)
+            sub(i, 'type', 'ianaift:ethernetCsmacd')
+            sub(i, 'admin-status', 'up')
+            sub(i, 'oper-status', 'up')
+            sub(i, 'if-index', n + 1)
+            sub(i, 'phys-address', '02:00:00:%02x:%02x:%02x' % (
+                (n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff))
+            sub(i, 'speed', 1000000000)
+            stats = sub(i, 'statistics')
+            sub(stats, 'discontinuity-time', time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.start)))
+            self.packet_counters(stats, 'in-%s', 'out-%s', 'unicast-pkts', 'octets')
+        return root
+
+    def oc_bgp(self, neighbors):
+        root = etree.Element('{%s}bgp' % OC_BGP_NS, nsmap={None: OC_BGP_NS})
+        g = sub(root, 'global')
+        for c in (sub(g, 'config'), sub(g, 'state')):
+            sub(c, 'as', 65000)
+            sub(c, 'router-id', '192.0.2.1')
+        ns = sub(root, 'neighbors')
+        for n in range(neighbors):
+            address = '10.%d.%d.%d' % ((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff)
+            nb = sub(ns, 'neighbor')
+            sub(nb, 'neighbor-address', address)
+            config = sub(nb, 'config')
+            sub(config, 'neighbor-address', address)
+            sub(config, 'peer-as', 65001 + n)
+            state = sub(nb, 'state')
+            sub(state, 'neighbor-address', address)
+            sub(state, 'peer-as', 65001 + n)
+            sub(state, 'session-state', 'ESTABLISHED')
+            messages = sub(state, 'messages')
+            for direction in ('sent', 'received'):
+                d = sub(messages, direction)
+                self.counter(d, 'UPDATE', 2)
+                self.counter(d, 'NOTIFICATION', 0.001)
+        return root
+
+    def refresh(self):
+        now = int(time.time())
+        if now == self.updated:
+            return
+        self.updated = now
+        elapsed = now - self.start
+        for (e, base, rate) in self.counters:
+            e.text = '%d' % (base + int(rate * elapsed))
+
+
+def netconf_state(capabilities, schemas):
+    root = etree.Element('{%s}netconf-state' % NCM_NS, nsmap={None: NCM_NS})
+    caps = sub(root, 'capabilities')
+    for c in capabilities:
+        sub(caps, 'capability', c)
+    s = sub(root, 'schemas')
+    for schema in schemas:
+        e = sub(s, 'schema')
+        sub(e, 'identifier', schema['identifier'])
+        sub(e, 'version', schema['version'])
+        sub(e, 'format', 'yang')
+        sub(e, 'namespace', schema['namespace'])
+        sub(e, 'location', 'NETCONF')
+    return root
+
+
+def same_node(a, f):
+    """Does data node a have the tag of filter node f? A filter node
+    without a namespace matches in any namespace.
+    """
+    if a.tag == f.tag:
+        return True
+    return etree.QName(f).namespace is None and localname(a) == f.tag
+
+
+def shallow(e):
+    return etree.Element(e.tag, dict(e.attrib), nsmap=e.nsmap)
+
+
+def combine(results):
+    """Combine what more than one filter sibling selected from the same
+    node.
+    """
+    out = results[0]
+    seen = set(etree.tostring(c) for c in elements(out))
+    for r in results[1:]:
+        for c in elements(r):
+            s = etree.tostring(c)
+            if s not in seen:
+                seen.add(s)
+                out.append(c)
+    return out
+
+
+def filter_node(d, f):
+    """What filter node f selects from data node d, per RFC 6241 subtree
+    filtering, as a copy, or None.
+    """
+    children = elements(f)
+    if not children:
+        if text(f):
+            return copy.deepcopy(d) if is_leaf(d) and text(d) == text(f) else None
+        return copy.deepcopy(d)
+
+    content = [c for c in children if is_leaf(c) and text(c)]
+    others = [c for c in children if not (is_leaf(c) and text(c))]
+    d_children = elements(d)
+    for c in content:
+        if not [x for x in d_children if same_node(x, c) and text(x) == text(c)]:
+            return None
+    if not others:
+        return copy.deepcopy(d)
+
+    out = shallow(d)
+    selected = False
+    for x in d_children:
+        fs = [c for c in children if same_node(x, c)]
+        if not fs:
+            continue
+        if [c for c in fs if c in content and is_leaf(x) and text(x) == text(c)]:
+            out.append(copy.deepcopy(x))
+            continue
+        results = [r for r in (filter_node(x, c) for c in fs if c not in content) if r is not None]
+        if results:
+            out.append(combine(results))
+            selected = True
+    if not selected and not content:
+        return None
+    return out
+
+
+def subtree_filter(nodes, f):
+    """The copies of what the children of filter element f select from
+    nodes.
+    """
+    out = []
+    top = elements(f)
+    for d in nodes:
+        results = [r for r in (filter_node(d, c) for c in top if same_node(d, c)) if r is not None]
+        if results:
+            out.append(combine(results))
+    return out
+
+
+def is_list_entry(e):
+    parent = e.getparent()
+    return parent is not None and len(parent.findall(e.tag)) > 1
+
+
+def xpath_filter(nodes, select, namespaces):
+    """Copies of the nodes selected by an XPath expression evaluated with
+    each top-level node as the document root, along with their
+    ancestors and the keys of the ancestors that are (as far as we can tell
+    without a schema) list entries.
+    """
+    out = []
+    copies = {}
+    for root in nodes:
+        if root.getparent() is not None:
+            root = copy.deepcopy(root)
+        try:
+            found = etree.ElementTree(root).xpath(select, namespaces=namespaces)
+        except etree.XPathError as e:
+            raise NetconfError('invalid-value', 'bad XPath %s: %s' % (select, e), type='protocol')
+        if not isinstance(found, list):
+            raise NetconfError('invalid-value', 'XPath %s does not select nodes' % select,
+                               type='protocol')
+        selected = set()
+        for e in found:
+            if not isinstance(e, etree._Element):
+                continue
+            ancestors = list(e.iterancestors())
+            if [a for a in ancestors if a in selected]:
+                continue
+            selected.add(e)
+            parent = None
+            for a in reversed(ancestors):
+                if a not in copies:
+                    copies[a] = shallow(a)
+                    if key(a) is not None and is_list_entry(a):
+                        copies[a].append(copy.deepcopy(elements(a)[0]))
+                    if parent is None:
+                        out.append(copies[a])
+                    else:
+                        parent.append(copies[a])
+                parent = copies[a]
+            c = copy.deepcopy(e)
+            if parent is None:
+                out.append(c)
+            else:
+                parent.append(c)
+    return out
+
+
+def apply_filter(nodes, f, prefixes=None):
+    """Apply a <filter> element, if any, to nodes. XPath prefixes not
+    declared on the filter can be any in prefixes, as devices commonly
+    allow module names and prefixes.
+    """
+    if f is None:
+        return nodes
+    kind = f.get('type', 'subtree')
+    if kind == 'subtree':
+        return subtree_filter(nodes, f)
+    if kind == 'xpath':
+        namespaces = dict(prefixes or {})
+        namespaces.update((k, v) for (k, v) in f.nsmap.items() if k)
+        return xpath_filter(nodes, f.get('select', ''), namespaces)
+    raise NetconfError('bad-attribute', 'unknown filter type %s' % kind, type='protocol')
+
+
+def find(parent, c, repeated):
+    """Find the child of parent that the edit node c is the same node as.
+    repeated is whether c's tag appears more than once in its edit.
+    """
+    candidates = [x for x in elements(parent) if x.tag == c.tag]
+    if is_leaf(c):
+        for x in candidates:
+            if is_leaf(x) and text(x) == text(c):
+                return x
+        if len(candidates) == 1 and not repeated:
+            return candidates[0]
+        return None
+    k = key(c)
+    for x in candidates:
+        if not is_leaf(x) and key(x) == k:
+            return x
+    return None
+
+
+def clean(c):
+    """A copy of an edit node to be stored, without operation attributes
+    or any deletes and removes beneath it.
+    """
+    c = copy.deepcopy(c)
+    for e in list(c.iter(tag=etree.Element)):
+        op = e.attrib.pop(OPERATION, None)
+        if op in ('delete', 'remove') and e is not c:
+            e.getparent().remove(e)
+    #
+    # Keep the declarations of prefixes used in values, like identities.
+    #
+    used = set()
+    for e in c.iter(tag=etree.Element):
+        prefix, sep, _ = (e.text or '').strip().partition(':')
+        if sep and prefix in e.nsmap:
+            used.add(prefix)
+    etree.cleanup_namespaces(c, keep_ns_prefixes=sorted(used))
+    return c
+
+
+def apply_edit(target, config, default_op):
+    """Apply the children of an edit-config <config> to the children of
+    the datastore element target, in place.
+    """
+    children = elements(config)
+    counts = {}
+    for c in children:
+        counts[c.tag] = counts.get(c.tag, 0) + 1
+    for c in children:
+        op = c.get(OPERATION, default_op)
+        x = find(target, c, counts[c.tag] > 1)
+        if op in ('delete', 'remove'):
+            if x is not None:
+                target.remove(x)
+            elif op == 'delete':
+                raise NetconfError('data-missing', '%s is not present to delete' % localname(c))
+            continue
+        if op == 'create' and x is not None:
+            raise NetconfError('data-exists', '%s is already present' % localname(c))
+        if x is None or op in ('create', 'replace'):
+            new = clean(c)
+            if x is None:
+                target.append(new)
+            else:
+                target.replace(x, new)
+            continue
+        if is_leaf(c):
+            if op == 'merge':
+                x.text = c.text
+            continue
+        apply_edit(x, c, op)
+
+
+class Device(object):
+    """The state of the simulated device, shared by all its sessions.
+    """
+
+    def __init__(self, capabilities=None, schemas=None, config=None, interfaces=24,
+                 latency=0, jitter=0, fail=None, drop=None, seed=None):
+        self.schemas = schemas if schemas is not None else canned_schemas()
+        self.capabilities = capabilities or (
+            DEFAULT_CAPABILITIES + [module_capability(s) for s in self.schemas if s['module']])
+        self.stores = {
+            'running': etree.Element('data'),
+            'candidate': None,
+        }
+        if config is not None:
+            for c in elements(config):
+                self.stores['running'].append(copy.deepcopy(c))
+        self.stores['candidate'] = copy.deepcopy(self.stores['running'])
+        self.oper = OperData(interfaces, seed or 0)
+        self.state = netconf_state(self.capabilities, self.schemas)
+        self.prefixes = {}
+        for s in self.schemas:
+            if s['module']:
+                self.prefixes[s['identifier']] = s['namespace']
+                if s.get('prefix'):
+                    self.prefixes.setdefault(s['prefix'], s['namespace'])
+        self.latency = latency
+        self.jitter = jitter
+        self.fail = fail or {}
+        self.drop = drop or {}
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.locks = {}
+        self.sessions = {}
+        self.session_ids = itertools.count(1)
+        self.confirm = None
+        self.timings = {}
+
+    def open_session(self, session):
+        with self.lock:
+            session.id = next(self.session_ids)
+            self.sessions[session.id] = session
+
+    def close_session(self, session):
+        """Release what a session held: its locks, along with any
+        uncommitted candidate changes under its candidate lock, and any
+        confirmed commit it hasn't confirmed.
+        """
+        with self.lock:
+            self.sessions.pop(session.id, None)
+            for store, holder in list(self.locks.items()):
+                if holder == session.id:
+                    self.release(store)
+            if self.confirm and self.confirm['session'] == session.id and not self.confirm['persist']:
+                log.info('session %d closed without confirming its commit', session.id)
+                self.rollback()
+
+    def release(self, store):
+        del self.locks[store]
+        if store == 'candidate':
+            self.stores['candidate'] = copy.deepcopy(self.stores['running'])
+
+    def chance(self, rates, op):
+        rate = rates.get(op, rates.get('*', 0))
+        return rate > 0 and self.random.random() < rate
+
+    def handle(self, session, rpc):
+        """Carry out an rpc, returning the body of its reply.
+        """
+        ops = elements(rpc)
+        if not ops:
+            raise NetconfError('missing-element', 'rpc has no operation', type='rpc')
+        op = ops[0]
+        name = localname(op)
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay / 1000.0)
+        if self.chance(self.drop, name):
+            raise SessionDropped()
+        if self.chance(self.fail, name):
+            raise NetconfError('operation-failed', 'simulated failure of %s' % name)
+        method = getattr(self, 'rpc_' + name.replace('-', '_'), None)
+        if method is None:
+            raise NetconfError('operation-not-supported', '%s is not supported' % name, type='protocol')
+        return method(session, op)
+
+    def record(self, rpc, elapsed):
+        """Record how long an rpc took, from being read to its reply being
+        sent.
+        """
+        ops = elements(rpc)
+        name = localname(ops[0]) if ops else 'rpc'
+        with self.lock:
+            self.timings.setdefault(name, []).append(elapsed)
+
+    def datastore(self, op, name):
+        e = op.find('{%s}%s' % (NC_NS, name))
+        stores = [localname(c) for c in elements(e)] if e is not None else []
+        if len(stores) != 1 or stores[0] not in self.stores:
+            raise NetconfError('invalid-value', 'bad %s' % name, type='protocol')
+        return stores[0]
+
+    def check_lock(self, session, store):
+        holder = self.locks.get(store)
+        if holder is not None and holder != session.id:
+            raise NetconfError('in-use', '%s is locked by session %d' % (store, holder),
+                               type='protocol', info={'session-id': holder})
+
+    def rpc_get(self, session, op):
+        with self.lock:
+            self.oper.refresh()
+            nodes = elements(self.stores['running']) + self.oper.roots + [self.state]
+            nodes = apply_filter(nodes, op.find('{%s}filter' % NC_NS), self.prefixes)
+            return data(nodes)
+
+    def rpc_get_config(self, session, op):
+        source = self.datastore(op, 'source')
+        with self.lock:
+            nodes = apply_filter(elements(self.stores[source]), op.find('{%s}filter' % NC_NS),
+                                 self.prefixes)
+            return data(nodes)
+
+    def rpc_edit_config(self, session, op):
+        target = self.datastore(op, 'target')
+        if target == 'running' and WRITABLE_RUNNING not in self.capabilities:
+            raise NetconfError('operation-not-supported', 'running is not writable', type='protocol')
+        #
+        # Snippets often have a <config> without a namespace, which
+        # ncclient passes on as is.
+        #
+        config = op.find('{%s}config' % NC_NS)
+        if config is None:
+            config = op.find('config')
+        if config is None:
+            raise NetconfError('missing-element', 'only inline config is supported', type='protocol')
+        default_op = op.findtext('{%s}default-operation' % NC_NS) or 'merge'
+        with self.lock:
+            self.check_lock(session, target)
+
+            #
+            # Edit a copy, so that a failed edit leaves no trace, as if
+            # with rollback-on-error.
+            #
+            if default_op == 'replace':
+                store = etree.Element('data')
+                default_op = 'merge'
+            else:
+                store = copy.deepcopy(self.stores[target])
+            apply_edit(store, config, default_op)
+            self.stores[target] = store
+        return OK
+
+    def rpc_commit(self, session, op):
+        confirmed = op.find('{%s}confirmed' % NC_NS) is not None
+        if confirmed and not [c for c in self.capabilities if c.startswith(CONFIRMED_COMMIT)]:
+            raise NetconfError('operation-not-supported', 'confirmed commit is not supported',
+                               type='protocol')
+        timeout = int(op.findtext('{%s}confirm-timeout' % NC_NS) or 600)
+        persist = op.findtext('{%s}persist' % NC_NS)
+        persist_id = op.findtext('{%s}persist-id' % NC_NS)
+        with self.lock:
+            self.check_lock(session, 'running')
+            if persist_id is not None and not self.confirm:
+                raise NetconfError('invalid-value', 'no confirmed commit is pending for persist-id',
+                                   type='protocol')
+            if self.confirm:
+                self.check_confirm(session, persist_id)
+                self.confirm['timer'].cancel()
+                rollback = self.confirm['rollback']
+                self.confirm = None
+            else:
+                rollback = copy.deepcopy(self.stores['running'])
+            self.stores['running'] = copy.deepcopy(self.stores['candidate'])
+            if confirmed:
+                timer = threading.Timer(timeout, self.expire)
+                timer.daemon = True
+                self.confirm = {
+                    'session': session.id,
+                    'persist': persist,
+                    'rollback': rollback,
+                    'timer': timer,
+                }
+                timer.start()
+        return OK
+
+    def check_confirm(self, session, persist_id):
+        if self.confirm['persist']:
+            if persist_id != self.confirm['persist']:
+                raise NetconfError('invalid-value', 'persist-id does not match', type='protocol')
+        elif self.confirm['session'] != session.id:
+            raise NetconfError('in-use', 'a confirmed commit is pending on session %d' % (
+                self.confirm['session']), type='protocol')
+
+    def rpc_cancel_commit(self, session, op):
+        with self.lock:
+            if not self.confirm:
+                raise NetconfError('operation-failed', 'no confirmed commit is pending')
+            self.check_confirm(session, op.findtext('{%s}persist-id' % NC_NS))
+            self.rollback()
+        return OK
+
+    def expire(self):
+        with self.lock:
+            if self.confirm:
+                log.info('confirmed commit timed out, rolling back')
+                self.rollback()
+
+    def rollback(self):
+        self.confirm['timer'].cancel()
+        self.stores['running'] = self.confirm['rollback']
+        self.stores['candidate'] = copy.deepcopy(self.stores['running'])
+        self.confirm = None
+
+    def rpc_discard_changes(self, session, op):
+        with self.lock:
+            self.check_lock(session, 'candidate')
+            self.stores['candidate'] = copy.deepcopy(self.stores['running'])
+        return OK
+
+    def rpc_validate(self, session, op):
+        return OK
+
+    def rpc_lock(self, session, op):
+        target = self.datastore(op, 'target')
+        with self.lock:
+            holder = self.locks.get(target)
+            if holder is not None:
+                raise NetconfError('lock-denied', '%s is locked by session %d' % (target, holder),
+                                   type='protocol', info={'session-id': holder})
+            self.locks[target] = session.id
+        return OK
+
+    def rpc_unlock(self, session, op):
+        target = self.datastore(op, 'target')
+        with self.lock:
+            if self.locks.get(target) != session.id:
+                raise NetconfError('operation-failed', '%s is not locked by this session' % target,
+                                   type='protocol')
+            self.release(target)
+        return OK
+
+    def rpc_get_schema(self, session, op):
+        identifier = op.findtext('{%s}identifier' % NCM_NS)
+        version = op.findtext('{%s}version' % NCM_NS)
+        found = [s for s in self.schemas if s['identifier'] == identifier
+                 and (not version or s['version'] == version)]
+        if not found:
+            raise NetconfError('invalid-value', 'no schema %s' % identifier, type='protocol')
+        if len(found) > 1:
+            raise NetconfError('operation-failed', 'more than one version of %s' % identifier,
+                               type='protocol')
+        e = etree.Element('{%s}data' % NCM_NS, nsmap={None: NCM_NS})
+        e.text = found[0]['text']
+        return etree.tostring(e)
+
+    def rpc_close_session(self, session, op):
+        session.closing = True
+        return OK
+
+    def rpc_kill_session(self, session, op):
+        try:
+            victim = int(op.findtext('{%s}session-id' % NC_NS))
+        except (TypeError, ValueError):
+            raise NetconfError('invalid-value', 'bad session-id', type='protocol')
+        with self.lock:
+            s = self.sessions.get(victim)
+        if s is None or s is session:
+            raise NetconfError('invalid-value', 'no other session %d' % victim, type='protocol')
+        s.channel.close()
+        return OK
+
+
+OK = b'<ok/>'
+
+
+def data(nodes):
+    return b''.join([b'<data>'] + [etree.tostring(e, with_tail=False) for e in nodes] + [b'</data>'])
+
+
+def error_reply(e):
+    r = etree.Element('{%s}rpc-error' % NC_NS, nsmap={None: NC_NS})
+    sub(r, 'error-type', e.type)
+    sub(r, 'error-tag', e.tag)
+    sub(r, 'error-severity', 'error')
+    sub(r, 'error-message', '%s' % e).set('{http://www.w3.org/XML/1998/namespace}lang', 'en')
+    if e.info:
+        info = sub(r, 'error-info')
+        for (k, v) in e.info.items():
+            sub(info, k, v)
+    return etree.tostring(r)
+
+
+class Session(object):
+    """A NETCONF session on an SSH channel, framing messages as 1.0 or
+    1.1 depending on what both ends say in their hellos.
+    """
+
+    def __init__(self, device, channel):
+        self.device = device
+        self.channel = channel
+        self.id = None
+        self.closing = False
+        self.chunked = False
+        self.buffer = bytearray()
+        self.scanned = 0
+
+    def read(self):
+        """The next message, or None if the channel has closed.
+        """
+        while True:
+            msg = self.chunk() if self.chunked else self.message()
+            if msg is not None:
+                return msg
+            data = self.channel.recv(65536)
+            if not data:
+                return None
+            self.buffer.extend(data)
+
+    def message(self):
+        i = self.buffer.find(EOM, self.scanned)
+        if i < 0:
+            self.scanned = max(0, len(self.buffer) - len(EOM))
+            return None
+        msg = bytes(self.buffer[:i])
+        del self.buffer[:i + len(EOM)]
+        self.scanned = 0
+        return msg
+
+    def chunk(self):
+        pos = 0
+        parts = []
+        while True:
+            if len(self.buffer) < pos + 4:
+                return None
+            if self.buffer[pos:pos + 4] == b'\n##\n':
+                del self.buffer[:pos + 4]
+                return b''.join(parts)
+            if self.buffer[pos:pos + 2] != b'\n#':
+                raise IOError('bad chunk framing')
+            i = self.buffer.find(b'\n', pos + 2)
+            if i < 0:
+                return None
+            size = int(self.buffer[pos + 2:i])
+            if len(self.buffer) < i + 1 + size:
+                return None
+            parts.append(bytes(self.buffer[i + 1:i + 1 + size]))
+            pos = i + 1 + size
+
+    def write(self, msg):
+        if self.chunked:
+            self.channel.sendall(('\n#%d\n' % len(msg)).encode('ascii') + msg + b'\n##\n')
+        else:
+            self.channel.sendall(msg + EOM)
+
+    def hello(self):
+        h = etree.Element('{%s}hello' % NC_NS, nsmap={None: NC_NS})
+        caps = sub(h, 'capabilities')
+        for c in self.device.capabilities:
+            sub(caps, 'capability', c)
+        sub(h, 'session-id', self.id)
+        self.write(etree.tostring(h))
+        msg = self.read()
+        if msg is None:
+            return False
+        client = etree.fromstring(msg)
+        caps = [text(c) for c in client.iter('{%s}capability' % NC_NS)]
+        self.chunked = BASE_1_1 in caps and BASE_1_1 in self.device.capabilities
+        return True
+
+    def reply(self, rpc, body):
+        r = etree.Element('{%s}rpc-reply' % NC_NS, nsmap={None: NC_NS})
+        for (k, v) in rpc.attrib.items():
+            r.set(k, v)
+        head = etree.tostring(r)
+        self.write(head[:-2] + b'>' + body + b'</rpc-reply>')
+
+    def run(self):
+        self.device.open_session(self)
+        try:
+            if not self.hello():
+                return
+            log.info('session %d started, %s framing', self.id, '1.1' if self.chunked else '1.0')
+            while not self.closing:
+                msg = self.read()
+                if msg is None:
+                    break
+                start = time.time()
+                try:
+                    rpc = etree.fromstring(msg)
+                except etree.XMLSyntaxError as e:
+                    log.warning('session %d: malformed message: %s', self.id, e)
+                    continue
+                try:
+                    body = self.device.handle(self, rpc)
+                except NetconfError as e:
+                    body = error_reply(e)
+                except SessionDropped:
+                    log.info('session %d: dropping session', self.id)
+                    break
+                self.reply(rpc, body)
+                self.device.record(rpc, time.time() - start)
+        except (socket.error, EOFError, IOError, paramiko.SSHException) as e:
+            log.info('session %d: %s', self.id, e)
+        finally:
+            self.device.close_session(self)
+            self.channel.close()
+            log.info('session %d closed', self.id)
+
+
+class SSHServer(paramiko.ServerInterface):
+    """Password authentication, against the given credentials or, if
+    there are none, anything at all, and a netconf subsystem.
+    """
+
+    def __init__(self, username=None, password=None):
+        self.username = username
+        self.password = password
+        self.netconf = threading.Event()
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if self.username is None or (username, password) == (self.username, self.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_subsystem_request(self, channel, name):
+        if name == 'netconf':
+            self.netconf.set()
+            return True
+        return False
+
+
+class ConnectionHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sim = self.server.simulator
+        t = paramiko.Transport(self.request)
+        try:
+            t.add_server_key(sim.host_key)
+            server = SSHServer(sim.username, sim.password)
+            t.start_server(server=server)
+            channel = t.accept(30)
+            if channel is None or not server.netconf.wait(30):
+                return
+            Session(sim.device, channel).run()
+        except (socket.error, EOFError, paramiko.SSHException) as e:
+            log.info('connection from %s failed: %s', self.client_address[0], e)
+        finally:
+            t.close()
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Simulator(object):
+    """A simulated device listening for SSH connections. Port 0 picks a
+    free port, which is then in the port attribute.
+    """
+
+    def __init__(self, device=None, host='127.0.0.1', port=DEFAULT_PORT,
+                 username=None, password=None, host_key=None):
+        self.device = device or Device()
+        self.username = username
+        self.password = password
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.server = ThreadingServer((host, port), ConnectionHandler)
+        self.server.simulator = self
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        """Serve on a background thread.
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def rates(specs):
+    """Turn OP=RATE specs into a dict, a bare RATE applying to any
+    operation.
+    """
+    result = {}
+    for spec in specs or []:
+        op, _, rate = spec.rpartition('=')
+        result[op or '*'] = float(rate)
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Run a simulated NETCONF device:')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help="Port to listen on (default %d)" % DEFAULT_PORT)
+    parser.add_argument('-u', '--username', type=str,
+                        help="Username to accept; by default any username and password are accepted")
+    parser.add_argument('-p', '--password', type=str,
+                        help="Password to accept along with --username")
+    parser.add_argument('--host-key', type=str,
+                        help="File holding the RSA host key to use, rather than generating one at startup")
+    parser.add_argument('--capabilities', type=str,
+                        help="File of capabilities to advertise, one per line, instead of the defaults and one for each schema's module, e.g. as saved from ncc.py --capabilities")
+    parser.add_argument('--schema-dir', type=str,
+                        help="Directory of YANG files to list in netconf-state and serve with get-schema, instead of the canned synthetic modules")
+    parser.add_argument('--synthetic-schemas', type=int, default=0,
+                        help="Number of extra synthetic modules to add to the canned ones, each importing an earlier one (default 0)")
+    parser.add_argument('--config', type=str,
+                        help="XML file with the initial running config, as the children of its root element")
+    parser.add_argument('--interfaces', type=int, default=24,
+                        help="Number of interfaces to generate operational data for; there is a BGP neighbor for every ten (default 24)")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Milliseconds to wait before replying to each RPC (default 0)")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="Up to this many milliseconds more to wait, at random (default 0)")
+    parser.add_argument('--fail', type=str, action='append',
+                        help="OP=RATE, the fraction of OP RPCs (e.g. get, edit-config, commit, or * for all) to reply to with an rpc-error. May be given more than once.")
+    parser.add_argument('--drop', type=str, action='append',
+                        help="OP=RATE, the fraction of OP RPCs to drop the session on instead of replying. May be given more than once.")
+    parser.add_argument('--seed', type=int,
+                        help="Random seed, to make jitter, failures and drops reproducible")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Log sessions coming and going")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger('paramiko').setLevel(logging.WARNING)
+
+    if args.schema_dir:
+        schemas = load_schemas(args.schema_dir)
+    else:
+        schemas = canned_schemas(args.synthetic_schemas)
+    config = None
+    if args.config:
+        config = etree.parse(args.config).getroot()
+    device = Device(capabilities=read_capabilities(args.capabilities) if args.capabilities else None,
+                    schemas=schemas,
+                    config=config,
+                    interfaces=args.interfaces,
+                    latency=args.latency,
+                    jitter=args.jitter,
+                    fail=rates(args.fail),
+                    drop=rates(args.drop),
+                    seed=args.seed)
+    host_key = paramiko.RSAKey.from_private_key_file(args.host_key) if args.host_key else None
+    sim = Simulator(device, args.host, args.port, args.username, args.password, host_key)
+    print('Simulating a device on %s port %d with %d schemas and %d interfaces' % (
+        sim.host, sim.port, len(schemas), args.interfaces))
+    sys.stdout.flush()
+
+    try:
+        sim.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+        for (op, timings) in sorted(device.timings.items()):
+            print('%s: %d' % (op, len(timings)))
@@ -0,0 +1,366 @@
+"""Batched time-series sinks for poller samples.
+
+A sample is a timestamp, a measurement name, a dict of tags (strings
+identifying the series, such as the host) and a dict of typed fields.
+Sinks buffer samples and write them out in batches, whenever
+batch_size samples have built up or flush_interval seconds have passed,
+so that a high sample rate isn't bottlenecked on formatting and writing
+a line at a time. Batches are written by a flusher thread of the sink's
+own, so a slow or failing write never holds up the threads adding
+samples.
+
+Sinks are named on the command line as KIND:TARGET:
+
+    csv:FILE             rotating CSV files, one row per field
+    columnar:FILE        one JSON object of column arrays per batch
+    influx:FILE          InfluxDB line protocol to a file,
+    influx:udp://H:P     ... a UDP socket,
+    influx:tcp://H:P     ... or a TCP socket
+"""
+import os
+import sys
+import csv
+import json
+import math
+import time
+import socket
+import threading
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+try:
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    string_types = str
+    integer_types = (int,)
+
+KINDS = ['csv', 'columnar', 'influx']
+
+
+def typed(value):
+    """Turn a value pulled out of XML into an int or float where it looks
+    like one, leaving it a string otherwise. NaN and infinity stay
+    strings, since InfluxDB won't take them as numbers.
+    """
+    if not isinstance(value, string_types):
+        return value
+    for t in (int, float):
+        try:
+            v = t(value)
+        except ValueError:
+            continue
+        if t is float and (math.isnan(v) or math.isinf(v)):
+            break
+        return v
+    if value in ('true', 'false'):
+        return value == 'true'
+    return value
+
+
+class Sample(object):
+    __slots__ = ['timestamp', 'measurement', 'tags', 'fields']
+
+    def __init__(self, timestamp, measurement, tags, fields):
+        self.timestamp = timestamp
+        self.measurement = measurement
+        self.tags = tags
+        self.fields = fields
+
+
+class Sink(object):
+    """Buffering common to all sinks; subclasses implement write() to
+    write out a batch.
+
+    add() only appends to the buffer, and hands a full one to the
+    flusher thread through a queue; it is called on ncclient's reader
+    threads, which mustn't wait on a file or socket. The flusher writes
+    each batch it is handed, and whatever has built up every
+    flush_interval seconds. A batch that can't be written is reported
+    and dropped, and the flusher carries on with the next. If the
+    flusher falls max_batches behind, say because the sink has stalled,
+    further batches are dropped and counted rather than held in memory.
+    """
+
+    def __init__(self, batch_size=1000, flush_interval=5, max_batches=100):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.batches = Queue(max_batches)
+        self.dropped = 0
+        self.flusher_thread = threading.Thread(target=self.flusher)
+        self.flusher_thread.daemon = True
+        self.flusher_thread.start()
+
+    def add(self, sample):
+        with self.lock:
+            self.buffer.append(sample)
+            if len(self.buffer) < self.batch_size:
+                return
+            batch, self.buffer = self.buffer, []
+        self.queue(batch)
+
+    def queue(self, batch):
+        try:
+            self.batches.put_nowait(batch)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+                if self.dropped == 1:
+                    sys.stderr.write("%s can't keep up, dropping batches\n" % self.__class__.__name__)
+
+    def take(self):
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        return batch
+
+    def flush(self):
+        batch = self.take()
+        if batch:
+            self.queue(batch)
+
+    def flusher(self):
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                batch = self.batches.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                batch = self.take()
+                deadline = time.time() + self.flush_interval
+            if batch is None:
+                break
+            if not batch:
+                continue
+            try:
+                self.write(batch)
+            except Exception as e:
+                sys.stderr.write("%s dropped %d sample(s): %s\n" % (
+                    self.__class__.__name__, len(batch), e))
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.flusher_thread.join()
+        if self.dropped:
+            sys.stderr.write('%s dropped %d batch(es) it couldn\'t keep up with\n' % (
+                self.__class__.__name__, self.dropped))
+
+
+class RotatingFile(object):
+    """A file that moves aside to FILE.<timestamp> once it gets bigger than
+    max_bytes.
+    """
+
+    def __init__(self, filename, max_bytes=None, mode='ab'):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.f = open(filename, mode)
+
+    def maybe_rotate(self):
+        if self.max_bytes and self.f.tell() >= self.max_bytes:
+            self.f.close()
+            os.rename(self.filename, '%s.%s' % (
+                self.filename, time.strftime('%Y%m%d%H%M%S')))
+            self.f = open(self.filename, self.mode)
+            return True
+        return False
+
+    def close(self):
+        self.f.close()
+
+
+class CSVSink(Sink):
+    """Rotating CSV in long format, one row per field, so that samples
+    with different fields can share a file.
+    """
+
+    HEADER = ['timestamp', 'measurement', 'tags', 'field', 'value']
+
+    def __init__(self, filename, max_bytes=64 * 1024 * 1024, **kwargs):
+        self.out = RotatingFile(filename, max_bytes)
+        if self.out.f.tell() == 0:
+            csv.writer(self.out.f).writerow(self.HEADER)
+        Sink.__init__(self, **kwargs)
+
+    def write(self, batch):
+        w = csv.writer(self.out.f)
+        for s in batch:
+            tags = ','.join('%s=%s' % kv for kv in sorted(s.tags.items()))
+            for field, value in s.fields.items():
+                w.writerow([repr(s.timestamp), s.measurement, tags, field, value])
+        self.out.f.flush()
+        if self.out.maybe_rotate():
+            csv.writer(self.out.f).writerow(self.HEADER)
+
+    def close(self):
+        Sink.close(self)
+        self.out.close()
+
+
+class ColumnarSink(Sink):
+    """Each batch is written as one line holding a JSON object of
+    equal-length column arrays: timestamp, measurement, one column per
+    tag and one per field, with null where a sample lacks that tag or
+    field. This is cheap to load straight into a dataframe.
+    """
+
+    def __init__(self, filename, max_bytes=256 * 1024 * 1024, **kwargs):
+        self.out = RotatingFile(filename, max_bytes)
+        Sink.__init__(self, **kwargs)
+
+    def write(self, batch):
+        tags = sorted(set(k for s in batch for k in s.tags))
+        fields = sorted(set(k for s in batch for k in s.fields))
+        columns = {
+            'timestamp': [s.timestamp for s in batch],
+            'measurement': [s.measurement for s in batch],
+        }
+        for t in tags:
+            columns['tag:' + t] = [s.tags.get(t) for s in batch]
+        for f in fields:
+            columns['field:' + f] = [s.fields.get(f) for s in batch]
+        self.out.f.write(json.dumps(columns).encode('utf-8') + b'\n')
+        self.out.f.flush()
+        self.out.maybe_rotate()
+
+    def close(self):
+        Sink.close(self)
+        self.out.close()
+
+
+def _escape(s, chars):
+    s = '%s' % s
+    for c in chars:
+        s = s.replace(c, '\\' + c)
+    return s
+
+
+def line_protocol(s):
+    """Format a sample as an InfluxDB line protocol line.
+    """
+    fields = []
+    for k, v in sorted(s.fields.items()):
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            v = 'true' if v else 'false'
+        elif isinstance(v, integer_types):
+            v = '%di' % v
+        elif isinstance(v, float):
+            v = repr(v)
+        else:
+            v = '"%s"' % _escape(v, '\\"')
+        fields.append('%s=%s' % (_escape(k, ', ='), v))
+    if not fields:
+        return None
+    tags = ''.join(',%s=%s' % (_escape(k, ', ='), _escape(v, ', ='))
+                   for k, v in sorted(s.tags.items()) if v not in (None, ''))
+    return '%s%s %s %d' % (_escape(s.measurement, ', '), tags, ','.join(fields),
+                           int(s.timestamp * 1e9))
+
+
+class InfluxSink(Sink):
+    """InfluxDB line protocol, to a file or a UDP or TCP socket. A TCP
+    connection that fails is reconnected on a later batch, backing off
+    from one second up to MAX_BACKOFF between attempts; batches written
+    meanwhile are dropped.
+    """
+
+    MAX_BACKOFF = 60
+
+    def __init__(self, target, **kwargs):
+        self.sock = None
+        self.out = None
+        if target.startswith('udp://') or target.startswith('tcp://'):
+            host, _, port = target[6:].rpartition(':')
+            self.address = (host, int(port))
+            self.kind = socket.SOCK_DGRAM if target.startswith('udp') else socket.SOCK_STREAM
+            self.udp = self.kind == socket.SOCK_DGRAM
+            self.backoff = 0
+            self.retry_at = 0
+            self.connect()
+        else:
+            self.out = RotatingFile(target, 256 * 1024 * 1024)
+        Sink.__init__(self, **kwargs)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, self.kind)
+        try:
+            sock.connect(self.address)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def disconnect(self):
+        """Drop a failed connection and work out when to try again.
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.backoff = min(self.MAX_BACKOFF, self.backoff * 2 or 1)
+        self.retry_at = time.time() + self.backoff
+
+    def reconnect(self):
+        if time.time() < self.retry_at:
+            raise socket.error('not connected to %s:%d, retrying in %.1fs' % (
+                self.address[0], self.address[1], self.retry_at - time.time()))
+        try:
+            self.connect()
+        except socket.error:
+            self.disconnect()
+            raise
+        self.backoff = 0
+
+    def write(self, batch):
+        lines = [l for l in (line_protocol(s) for s in batch) if l]
+        if self.out:
+            self.out.f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            self.out.f.flush()
+            self.out.maybe_rotate()
+        elif self.udp:
+            #
+            # Keep datagrams under a typical MTU's worth of payload.
+            #
+            chunk = []
+            size = 0
+            for l in lines + [None]:
+                if l is None or size + len(l) > 1400:
+                    if chunk:
+                        self.sock.send(('\n'.join(chunk) + '\n').encode('utf-8'))
+                    chunk = []
+                    size = 0
+                if l is not None:
+                    chunk.append(l)
+                    size += len(l) + 1
+        else:
+            if self.sock is None:
+                self.reconnect()
+            try:
+                self.sock.sendall(('\n'.join(lines) + '\n').encode('utf-8'))
+            except socket.error:
+                self.disconnect()
+                raise
+
+    def close(self):
+        Sink.close(self)
+        if self.out:
+            self.out.close()
+        elif self.sock is not None:
+            self.sock.close()
+
+
+def make_sink(spec, **kwargs):
+    """Create a sink from a KIND:TARGET command line spec.
+    """
+    kind, _, target = spec.partition(':')
+    if kind not in KINDS or not target:
+        raise ValueError('sink must be one of %s followed by :TARGET, not %s' % (
+            ', '.join(KINDS), spec))
+    return {'csv': CSVSink, 'columnar': ColumnarSink, 'influx': InfluxSink}[kind](target, **kwargs)
@@ -0,0 +1,259 @@
+"""Lightweight timing of where a run spends its time.
+
+Rather than logging every message at DEBUG the way --verbose does, the
+scripts record a span for each phase of the work that matters: setting
+up the session (SSH and the NETCONF hello), every RPC up to the arrival
+of its reply, parsing the reply, rendering templates and writing the
+output. A span is a name, a start time, a duration, the thread it ran on
+and a few arguments, typically the device and how many bytes were
+involved, so a slow run can be put down to SSH, to the device or to our
+own XML handling.
+
+Recording is off until enable() is called, and span() costs next to
+nothing while it is. What has been recorded can be summarized as a
+table, written as a Chrome trace (load it in chrome://tracing or
+Perfetto) or written in the Prometheus text exposition format.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from ncclient import manager
+from ncclient.transport import SessionListener
+
+#
+# Quantiles given in the summary table and the Prometheus output.
+#
+QUANTILES = [0.5, 0.9, 0.99]
+
+_recorder = None
+
+
+class Recorder(object):
+    """Collects spans from any number of threads.
+    """
+
+    def __init__(self):
+        self.origin = time.time()
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def add(self, phase, name, start, duration, **args):
+        with self.lock:
+            self.spans.append((phase, name, start, duration,
+                               threading.current_thread().ident, args))
+
+    def groups(self):
+        """Return ((phase, name), durations, total bytes) for each kind of
+        span, in the order they were first seen, durations sorted.
+        """
+        order = []
+        found = {}
+        with self.lock:
+            spans = list(self.spans)
+        for (phase, name, _, duration, _, args) in spans:
+            key = (phase, name)
+            if key not in found:
+                order.append(key)
+                found[key] = ([], [0])
+            found[key][0].append(duration)
+            found[key][1][0] += args.get('bytes') or 0
+        return [(key, sorted(found[key][0]), found[key][1][0]) for key in order]
+
+    def summary(self, out=None):
+        """Write a table of the count, total, quantiles and maximum time
+        of each kind of span, and the bytes they handled.
+        """
+        out = out or sys.stderr
+        out.write('%-10s %-24s %6s %9s %9s %9s %9s %9s %11s\n' % (
+            'phase', 'name', 'count', 'total',
+            'p50', 'p90', 'p99', 'max', 'bytes'))
+        for ((phase, name), durations, nbytes) in self.groups():
+            out.write('%-10s %-24s %6d %8.3fs %8.3fs %8.3fs %8.3fs %8.3fs %11s\n' % (
+                phase, name, len(durations), sum(durations),
+                quantile(durations, 0.5), quantile(durations, 0.9),
+                quantile(durations, 0.99), durations[-1], nbytes or ''))
+        out.write('wall time %.3fs\n' % (time.time() - self.origin))
+
+    def write_trace(self, filename):
+        """Write the spans as complete ("X") events in the Chrome trace
+        event format, times in microseconds from when recording started.
+        """
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+        events = []
+        for (phase, name, start, duration, tid, args) in spans:
+            events.append({
+                'name': name,
+                'cat': phase,
+                'ph': 'X',
+                'ts': int((start - self.origin) * 1000000),
+                'dur': int(duration * 1000000),
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            })
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def write_prometheus(self, filename):
+        """Write a summary metric of span durations and a counter of bytes
+        handled, labelled by phase and name, in the Prometheus text
+        exposition format. The file is replaced in one go, so a node
+        exporter textfile collector never reads half of it.
+        """
+        lines = [
+            '# HELP ncc_span_seconds Time spent in each phase of an ncc run.',
+            '# TYPE ncc_span_seconds summary',
+        ]
+        groups = self.groups()
+        for ((phase, name), durations, _) in groups:
+            labels = 'phase="%s",name="%s"' % (escape(phase), escape(name))
+            for q in QUANTILES:
+                lines.append('ncc_span_seconds{%s,quantile="%s"} %f' % (
+                    labels, q, quantile(durations, q)))
+            lines.append('ncc_span_seconds_sum{%s} %f' % (labels, sum(durations)))
+            lines.append('ncc_span_seconds_count{%s} %d' % (labels, len(durations)))
+        lines += [
+            '# HELP ncc_span_bytes_total Bytes of XML received or rendered in each phase of an ncc run.',
+            '# TYPE ncc_span_bytes_total counter',
+        ]
+        for ((phase, name), _, nbytes) in groups:
+            if nbytes:
+                lines.append('ncc_span_bytes_total{phase="%s",name="%s"} %d' % (
+                    escape(phase), escape(name), nbytes))
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, filename)
+
+
+def quantile(durations, q):
+    """The nearest-rank quantile of a sorted, non-empty list.
+    """
+    return durations[min(len(durations) - 1, int(len(durations) * q))]
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def enable():
+    """Start recording, returning the Recorder.
+    """
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def recorder():
+    """The Recorder, or None if recording isn't enabled.
+    """
+    return _recorder
+
+
+@contextmanager
+def span(phase, name, **args):
+    """Record the time taken by the body of the with statement. The
+    arguments dict is what's bound by "as", so the body can add to it,
+    say the number of bytes it handled.
+    """
+    r = _recorder
+    if r is None:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    finally:
+        r.add(phase, name, start, time.time() - start, **args)
+
+
+def timed_iter(phase, name, iterable, **args):
+    """Yield what iterable does, recording the time taken to produce
+    each item.
+    """
+    it = iter(iterable)
+    while True:
+        with span(phase, name, **args):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+class ReplyListener(SessionListener):
+    """Notes when the latest rpc-reply on a session arrived, with its
+    message-id and size, from ncclient's reader thread.
+    """
+
+    def __init__(self):
+        self.last = (None, None, None)
+
+    def callback(self, root, raw):
+        tag, attrs = root
+        if tag.endswith('rpc-reply'):
+            self.last = (attrs.get('message-id'), time.time(), len(raw))
+
+    def errback(self, ex):
+        pass
+
+
+class TimedManager(object):
+    """Wraps a manager, or anything standing in for one, so that every
+    NETCONF operation is recorded as an "rpc" span. Operations are called
+    on the manager just as they would be otherwise. On an ncclient
+    session, a ReplyListener notes when each reply arrives, so the rpc
+    span ends there and the time ncclient then takes to parse the reply
+    is recorded as a "parse" span of its own; if the reply can't be
+    matched up, say because the device returned an error, the rpc span
+    covers both. Everything else is passed straight through to the
+    manager.
+    """
+
+    def __init__(self, m, host=None):
+        self.m = m
+        self.host = host
+        self.listener = None
+        if hasattr(m, '_session'):
+            self.listener = ReplyListener()
+            m._session.add_listener(self.listener)
+
+    def __getattr__(self, name):
+        if name in manager.OPERATIONS:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        return getattr(self.m, name)
+
+    def call(self, op, *args, **kwargs):
+        r = _recorder
+        if r is None:
+            return getattr(self.m, op)(*args, **kwargs)
+        if self.listener is None:
+            with span('rpc', op, host=self.host):
+                return getattr(self.m, op)(*args, **kwargs)
+        start = time.time()
+        reply = None
+        try:
+            reply = getattr(self.m, op)(*args, **kwargs)
+            return reply
+        finally:
+            end = time.time()
+            root = getattr(reply, '_root', None)
+            message_id, delivered, size = self.listener.last
+            if root is None or message_id != root.get('message-id') or delivered < start:
+                r.add('rpc', op, start, end - start, host=self.host)
+            else:
+                r.add('rpc', op, start, delivered - start, host=self.host, bytes=size)
+                r.add('parse', op, delivered, end - delivered, host=self.host)
+
+
+def timed(m, host=None):
+    """Wrap a manager in a TimedManager if recording is enabled.
+    """
+    if _recorder is None:
+        return m
+    return TimedManager(m, host)
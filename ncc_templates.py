@@ -0,0 +1,154 @@
+"""Jinja environments for snippets, with caching.
+
+Compiled templates are cached as bytecode by Jinja itself, and the
+variables each template needs (which --list-templates and
+--list-filters display) are cached in an index per snippets directory,
+so neither has to be worked out again unless a template's mtime or size
+changes.
+
+Templates can also be rendered in bulk, once for each row of a stream of
+parameters, lazily, so that a file of many thousands of rows never has
+to be held in memory.
+"""
+import os
+import csv
+import json
+import errno
+import hashlib
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, StrictUndefined
+from jinja2 import meta
+from jinja2.exceptions import UndefinedError
+
+#
+# Where caches go unless told otherwise.
+#
+CACHE_DIR = os.environ.get('NCC_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ncc'))
+
+
+def cache_dir_or_none(cache_dir):
+    """Make sure the cache directory exists, returning None if it can't
+    be created so that callers carry on without caching.
+    """
+    if not cache_dir:
+        return None
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return None
+    return cache_dir
+
+
+def environment(path, cache_dir=CACHE_DIR):
+    """A strict environment for the templates under path, caching
+    compiled templates in cache_dir if given.
+    """
+    cache_dir = cache_dir_or_none(cache_dir)
+    return Environment(loader=FileSystemLoader(path),
+                       undefined=StrictUndefined,
+                       bytecode_cache=FileSystemBytecodeCache(cache_dir) if cache_dir else None)
+
+
+def template_variables(source_env, cache_dir=CACHE_DIR):
+    """Return (name, sorted variables) for every template in the
+    environment, only parsing templates that have changed since the
+    index was last written.
+    """
+    cache_dir = cache_dir_or_none(cache_dir)
+    searchpath = source_env.loader.searchpath
+    index_file = None
+    index = {}
+    if cache_dir:
+        key = hashlib.sha1(os.path.abspath(searchpath[0]).encode('utf-8')).hexdigest()
+        index_file = os.path.join(cache_dir, 'templates-%s.json' % key)
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+                f.close()
+        except (IOError, ValueError):
+            index = {}
+
+    env = Environment()
+    changed = False
+    result = []
+    names = sorted(source_env.list_templates())
+    for tname in names:
+        tfile = [os.path.join(p, tname) for p in searchpath
+                 if os.path.exists(os.path.join(p, tname))][0]
+        st = os.stat(tfile)
+        entry = index.get(tname)
+        if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+            with open(tfile, 'r') as f:
+                vars = meta.find_undeclared_variables(env.parse(f.read()))
+                f.close()
+            entry = {'mtime': st.st_mtime, 'size': st.st_size, 'vars': sorted(vars)}
+            index[tname] = entry
+            changed = True
+        result.append((tname, entry['vars']))
+
+    #
+    # Forget templates that have gone away.
+    #
+    for tname in set(index) - set(names):
+        del index[tname]
+        changed = True
+
+    if index_file and changed:
+        tmp = index_file + '.%d' % os.getpid()
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+                f.close()
+            os.rename(tmp, index_file)
+        except (IOError, OSError):
+            pass
+    return result
+
+
+def param_rows(filename):
+    """Yield a dict of parameters for each row of a CSV file (if its name
+    ends in .csv), with the parameter names in a header row, or else of
+    an NDJSON file, with a JSON dict on each line.
+    """
+    with open(filename) as f:
+        if filename.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise ValueError('%s line %d: %s' % (filename, n, e))
+                if not isinstance(row, dict):
+                    raise ValueError('%s line %d: not a JSON dict' % (filename, n))
+                yield row
+
+
+def render_rows(t_list, rows, params=None):
+    """Lazily render each template in t_list for each row of parameters,
+    the row's parameters overriding any in params.
+    """
+    for n, row in enumerate(rows, 1):
+        p = dict(params or {})
+        p.update(row)
+        for tmpl in t_list:
+            try:
+                yield tmpl.render(p)
+            except UndefinedError as e:
+                raise UndefinedError('%s in row %d' % (e.message, n))
+
+
+def chunked(iterable, size):
+    """Yield lists of up to size items from iterable.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+"""A long-lived local daemon that keeps NETCONF sessions open so that
+scripts don't pay for an SSH key exchange, NETCONF hello and
+capability exchange on every invocation.
+
+Clients talk to the daemon over a Unix socket, one JSON-encoded request
+per line and one JSON-encoded response per line. Sessions are pooled,
+keyed on (host, port, username, password hash), and are evicted when idle, kept alive
+with SSH keepalives and transparently reconnected when a read operation
+finds the session dead. The DaemonManager class is the client side; it
+looks enough like an ncclient manager for the functions in ncc.py to
+use it unchanged.
+
+Note that all clients share the one session per device, and so share
+its candidate configuration. A client that starts changing it holds the
+session's writes to itself until it commits, discards its changes or
+cancels a confirmed commit, so two clients' edits and commits can't
+interleave; other clients' writes wait, while reads carry on. Anything a
+client leaves uncommitted when it hangs up is discarded.
+"""
+import sys
+import os
+import json
+import socket
+import threading
+import time
+import hashlib
+import logging
+from argparse import ArgumentParser
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+from ncclient import manager
+from ncclient.operations.rpc import RPCError
+from ncclient.transport import TransportError
+from lxml import etree
+
+
+#
+# Where the daemon listens unless told otherwise.
+#
+DEFAULT_SOCKET = os.environ.get(
+    'NCC_DAEMON_SOCKET', '/tmp/nccd-%s.sock' % os.environ.get('USER', 'ncc'))
+
+NC_NS = 'urn:ietf:params:xml:ns:netconf:base:1.0'
+
+#
+# Operations that can safely be retried on a fresh session if the
+# pooled one turns out to be dead.
+#
+READ_OPS = ['get', 'get_config', 'get_schema', 'capabilities']
+WRITE_OPS = ['edit_config', 'commit', 'cancel_commit', 'discard_changes', 'lock', 'unlock', 'validate']
+
+log = logging.getLogger('nccd')
+
+#
+# Salt for the password hashes in pool keys, so that they can't be
+# looked up in a table of common passwords.
+#
+KEY_SALT = os.urandom(16)
+
+
+class DaemonError(Exception):
+    """An operation forwarded to the daemon failed; the message is that
+    of the exception raised in the daemon.
+    """
+    def __init__(self, message, kind=None):
+        Exception.__init__(self, message)
+        self.kind = kind
+
+
+class PooledSession(object):
+    """A connected manager plus the bookkeeping the pool needs.
+    """
+    def __init__(self, m):
+        self.m = m
+        self.lock = threading.Lock()
+        self.owner = threading.Lock()
+        self.users = 0
+        self.last_used = time.time()
+
+
+class Client(object):
+    """A daemon client's hold on the session whose candidate it is
+    changing. Holding a session's owner lock keeps other clients' writes
+    out until the client's edits are committed or discarded.
+    """
+    def __init__(self):
+        self.held = None
+        self.dirty = False
+
+    def hold(self, s):
+        if self.held is s:
+            return
+        self.release()
+        s.owner.acquire()
+        self.held = s
+
+    def release(self):
+        """Let other clients write again, first discarding anything this
+        client left uncommitted.
+        """
+        s, self.held = self.held, None
+        if s is None:
+            return
+        try:
+            if self.dirty:
+                with s.lock:
+                    s.m.discard_changes()
+        except Exception as e:
+            log.info('discarding uncommitted changes failed: %s', e)
+        finally:
+            self.dirty = False
+            s.owner.release()
+
+
+class SessionPool(object):
+    """A keyed pool of ncclient manager sessions, one per device. RPCs on
+    a session are serialized; RPCs to different devices run in
+    parallel. A session that is being used, or held by a client, is
+    never reaped.
+    """
+
+    def __init__(self, idle_timeout=300, keepalive=30):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    @staticmethod
+    def key(device):
+        """The pool key of a device. It includes a hash of the password,
+        so that a client only gets a session opened with the credentials
+        it gave.
+        """
+        password = hashlib.sha256(KEY_SALT + (device.get('password') or '').encode('utf-8')).hexdigest()
+        return (device['host'], int(device.get('port', 830)), device.get('username'), password)
+
+    def connect(self, device):
+        def unknown_host_cb(host, fingerprint):
+            return True
+        m = manager.connect(host=device['host'],
+                            port=int(device.get('port', 830)),
+                            timeout=int(device.get('timeout', 60)),
+                            username=device.get('username'),
+                            password=device.get('password'),
+                            allow_agent=False,
+                            look_for_keys=False,
+                            hostkey_verify=False,
+                            unknown_host_cb=unknown_host_cb)
+        #
+        # SSH-level keepalives are far cheaper than a NETCONF RPC and
+        # stop middleboxes timing out the idle session.
+        #
+        try:
+            m._session._transport.set_keepalive(self.keepalive)
+        except AttributeError:
+            pass
+        log.info('connected to %s:%s', device['host'], device.get('port', 830))
+        return PooledSession(m)
+
+    def session(self, device):
+        """Get the pooled session for a device, connecting if necessary.
+        Connecting is done under a per-device lock so that concurrent
+        requests for a new device only connect once.
+        """
+        k = self.key(device)
+        with self.lock:
+            s = self.sessions.get(k)
+            if s is not None and s.m.connected:
+                s.last_used = time.time()
+                return s
+            key_lock = self.key_locks.setdefault(k, threading.Lock())
+        with key_lock:
+            with self.lock:
+                s = self.sessions.get(k)
+                if s is not None and s.m.connected:
+                    s.last_used = time.time()
+                    return s
+            s = self.connect(device)
+            with self.lock:
+                self.sessions[k] = s
+            return s
+
+    def cached(self, device):
+        """Get the pooled session for a device if there is a live one,
+        else None, without connecting.
+        """
+        with self.lock:
+            s = self.sessions.get(self.key(device))
+            if s is not None and s.m.connected:
+                s.last_used = time.time()
+                return s
+        return None
+
+    def discard(self, device, s):
+        k = self.key(device)
+        with self.lock:
+            if self.sessions.get(k) is s:
+                del self.sessions[k]
+        self.close(s)
+
+    @staticmethod
+    def close(s):
+        try:
+            s.m.close_session()
+        except Exception:
+            #
+            # A device that doesn't answer the close-session still has
+            # its transport dropped, failing anything left waiting on it.
+            #
+            try:
+                s.m._session.close()
+            except Exception:
+                pass
+
+    def call(self, device, fn, retry=True, client=None):
+        """Call fn with the device's pooled session, reconnecting and
+        calling it again once if the session turns out to have died and
+        retry is set. With client, the session is first held for that
+        client, waiting for any other client holding it to finish.
+        """
+        for attempt in (1, 2):
+            s = self.session(device)
+            with self.lock:
+                s.users += 1
+            try:
+                if client is not None:
+                    client.hold(s)
+                with s.lock:
+                    return fn(s.m)
+            except (TransportError, socket.error, EOFError) as e:
+                log.info('session to %s failed: %s', device['host'], e)
+                self.discard(device, s)
+                if not retry or attempt == 2:
+                    raise
+            finally:
+                with self.lock:
+                    s.users -= 1
+                    s.last_used = time.time()
+
+    def run(self, device, op, args, client=None):
+        """Run one operation on the device's pooled session, retrying on a
+        fresh session only for read operations. Writes are made holding
+        the session for client, if given, which lets go of it once its
+        changes are committed or discarded.
+        """
+        if client is None or op not in WRITE_OPS:
+            return self.call(device, lambda m: do_op(m, op, args), retry=op in READ_OPS)
+        if op == 'edit_config':
+            client.dirty = True
+        resp = self.call(device, lambda m: do_op(m, op, args), retry=False, client=client)
+        if op in ('discard_changes', 'cancel_commit') or (op == 'commit' and not args.get('confirmed')):
+            client.dirty = False
+            client.release()
+        return resp
+
+    def reap(self):
+        """Close sessions that have been idle too long or have died.
+        """
+        now = time.time()
+        with self.lock:
+            dead = [(k, s) for (k, s) in self.sessions.items()
+                    if not s.users and not s.owner.locked() and
+                    (not s.m.connected or now - s.last_used > self.idle_timeout)]
+            for (k, s) in dead:
+                del self.sessions[k]
+        for (k, s) in dead:
+            log.info('evicting session to %s:%s', k[0], k[1])
+            self.close(s)
+
+    def reaper(self):
+        while True:
+            time.sleep(min(self.keepalive, self.idle_timeout))
+            self.reap()
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for s in sessions:
+            self.close(s)
+
+
+def to_filter(f):
+    """JSON turns the (type, criteria) filter tuples ncclient wants into
+    lists, so turn them back.
+    """
+    if isinstance(f, list):
+        return tuple(f)
+    return f
+
+
+def do_op(m, op, args):
+    """Run one operation against a real manager and return a JSON-able
+    response.
+    """
+    if op == 'capabilities':
+        return {'capabilities': list(m.server_capabilities)}
+    if 'filter' in args:
+        args['filter'] = to_filter(args['filter'])
+    if op in READ_OPS or op in WRITE_OPS:
+        reply = getattr(m, op)(**args)
+        return {'xml': reply.xml}
+    raise ValueError('unsupported operation %s' % op)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handle a client connection, which may carry any number of
+    requests.
+    """
+
+    def handle(self):
+        pool = self.server.pool
+        client = Client()
+        try:
+            for line in iter(self.rfile.readline, b''):
+                if not line.strip():
+                    continue
+                try:
+                    req = json.loads(line.decode('utf-8'))
+                    resp = pool.run(req['device'], req['op'], req.get('args', {}), client)
+                    resp['ok'] = True
+                except Exception as e:
+                    resp = {'ok': False, 'kind': e.__class__.__name__, 'error': str(e)}
+                self.wfile.write((json.dumps(resp) + '\n').encode('utf-8'))
+                self.wfile.flush()
+        finally:
+            client.release()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class DaemonReply(object):
+    """Enough of an ncclient reply for the scripts here.
+    """
+
+    def __init__(self, xml, schema=False):
+        self.xml = xml
+        root = etree.fromstring(xml.encode('utf-8'))
+        self.data_ele = root.find('{%s}data' % NC_NS)
+        self.ok = root.find('{%s}ok' % NC_NS) is not None
+        if self.data_ele is not None:
+            self.data_xml = etree.tostring(self.data_ele)
+        else:
+            self.data_xml = None
+        if schema and self.data_ele is not None:
+            self.data = self.data_ele.text
+        else:
+            self.data = self.data_ele
+
+
+class DaemonManager(object):
+    """Client side of the daemon, standing in for an ncclient manager
+    connected to one device.
+    """
+
+    def __init__(self, socket_path, host, port, username, password, timeout):
+        self.device = {
+            'host': host,
+            'port': port,
+            'username': username,
+            'password': password,
+            'timeout': timeout,
+        }
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.f = self.sock.makefile('rwb')
+        self._capabilities = None
+
+    def request(self, op, **args):
+        req = {'device': self.device, 'op': op, 'args': args}
+        self.f.write((json.dumps(req) + '\n').encode('utf-8'))
+        self.f.flush()
+        line = self.f.readline()
+        if not line:
+            raise DaemonError('daemon closed the connection')
+        resp = json.loads(line.decode('utf-8'))
+        if not resp['ok']:
+            raise DaemonError(resp['error'], resp.get('kind'))
+        return resp
+
+    @property
+    def server_capabilities(self):
+        if self._capabilities is None:
+            self._capabilities = self.request('capabilities')['capabilities']
+        return self._capabilities
+
+    def get(self, filter=None):
+        return DaemonReply(self.request('get', filter=filter)['xml'])
+
+    def get_config(self, source, filter=None):
+        return DaemonReply(self.request('get_config', source=source, filter=filter)['xml'])
+
+    def get_schema(self, identifier, version=None, format=None):
+        return DaemonReply(self.request('get_schema', identifier=identifier,
+                                        version=version, format=format)['xml'],
+                           schema=True)
+
+    def edit_config(self, config, **kwargs):
+        return DaemonReply(self.request('edit_config', config=config, **kwargs)['xml'])
+
+    def commit(self, **kwargs):
+        return DaemonReply(self.request('commit', **kwargs)['xml'])
+
+    def cancel_commit(self, **kwargs):
+        return DaemonReply(self.request('cancel_commit', **kwargs)['xml'])
+
+    def discard_changes(self):
+        return DaemonReply(self.request('discard_changes')['xml'])
+
+    def close_session(self):
+        """The device session stays open in the daemon; just hang up.
+        """
+        self.f.close()
+        self.sock.close()
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Run a NETCONF session pooling daemon:')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                        help="Unix socket to listen on (default %s)" % DEFAULT_SOCKET)
+    parser.add_argument('--idle-timeout', type=int, default=300,
+                        help="Close sessions idle for this many seconds (default 300)")
+    parser.add_argument('--keepalive', type=int, default=30,
+                        help="SSH keepalive and health check interval in seconds (default 30)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Log sessions coming and going")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    #
+    # The socket carries device credentials, so only we get to use it,
+    # from the moment it is bound.
+    #
+    pool = SessionPool(idle_timeout=args.idle_timeout, keepalive=args.keepalive)
+    umask = os.umask(0o077)
+    try:
+        server = DaemonServer(args.socket, RequestHandler)
+    finally:
+        os.umask(umask)
+    server.pool = pool
+    os.chmod(args.socket, 0o600)
+
+    t = threading.Thread(target=pool.reaper)
+    t.daemon = True
+    t.start()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close_all()
+        os.unlink(args.socket)
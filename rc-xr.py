@@ -1,33 +1,147 @@
 #!/usr/bin/env python
 import sys
+import time
 import requests
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+import ncc_hosts
+try:
+    from cStringIO import StringIO as BytesIO
+except ImportError:
+    from io import BytesIO
 
+#
+# Media types for the --encoding choices.
+#
+MEDIA_TYPES = {
+    'json': 'application/yang.data+json',
+    'xml': 'application/yang.data+xml',
+}
+ERROR_TYPES = 'application/yang.errors+json, application/yang.errors+xml'
 
-def send_request(protocol, host, port, username, password):
-    '''Generate a simple RESTCONF request.
-    '''
-    # url = "{}://{}:{}/restconf/data/Cisco-IOS-XR-ifmgr-cfg:interface-configurations/interface-configuration=act,GigabitEthernet0%2f0%2f0%2f0/description".format(
-    url = "{}://{}:{}/restconf/data/Cisco-IOS-XR-ifmgr-cfg:interface-configurations".format(
-        protocol, host, port)
+DEFAULT_PATH = 'Cisco-IOS-XR-ifmgr-cfg:interface-configurations'
+
+CHUNK_SIZE = 64 * 1024
+
+
+def counting(pool_cls, adapter):
+    """A subclass of a urllib3 connection pool class whose connections
+    count every time they connect, including reconnecting after the
+    server closed them, in adapter.connections.
+    """
+    base = pool_cls.ConnectionCls
+
+    class CountingConnection(base):
+        def connect(self):
+            adapter.connections += 1
+            return base.connect(self)
+
+    return type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': CountingConnection})
+
+
+class CountingAdapter(HTTPAdapter):
+    """An HTTPAdapter counting the TCP connections it makes, which shows
+    whether the device kept them alive between requests.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.connections = 0
+        HTTPAdapter.__init__(self, *args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        pm = self.poolmanager
+        pm.pool_classes_by_scheme = dict(
+            (scheme, counting(cls, self)) for (scheme, cls) in pm.pool_classes_by_scheme.items())
+
+
+def make_session(username, password, verify=True, pool_size=1):
+    """A session for one device, keeping its connections alive so that
+    repeated requests don't each pay for a TCP (and TLS) handshake.
+    Returns the session and its adapter.
+    """
+    s = requests.Session()
+    s.auth = HTTPBasicAuth(username, password)
+    s.verify = verify
+    adapter = CountingAdapter(pool_connections=1, pool_maxsize=pool_size)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s, adapter
+
+
+def send_request(session, method, url, out, params=None, data=None, encoding='json', timeout=60):
+    """Send a RESTCONF request on a session, streaming the body of the
+    response to out as it arrives rather than holding it all in memory.
+    Returns (status code, bytes of body, seconds until the headers
+    arrived, seconds until all of the body had).
+    """
+    headers = {'Accept': '%s, %s' % (MEDIA_TYPES[encoding], ERROR_TYPES)}
+    if data is not None:
+        headers['Content-Type'] = MEDIA_TYPES[encoding]
+    start = time.time()
+    response = session.request(method, url, params=params, data=data, headers=headers,
+                               timeout=timeout, stream=True)
+    headers_at = time.time() - start
+    size = 0
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            out.write(chunk)
+            size += len(chunk)
+    finally:
+        response.close()
+    return (response.status_code, size, headers_at, time.time() - start)
+
+
+def run_one(h, args, body, direct=False):
+    """Send the request --repeat times to one device on one pooled
+    session. Returns (device, timings, connections opened, output,
+    error), where output is the body of the last response unless it was
+    written to --output, or straight to stdout if direct.
+    """
+    url = '{}://{}:{}{}/data/{}'.format(
+        args.protocol, h['host'], h['port'], args.root, args.path.lstrip('/'))
+    params = {}
+    if args.content:
+        params['content'] = args.content
+    if args.depth:
+        params['depth'] = args.depth
+    if args.fields:
+        params['fields'] = args.fields
+    session, adapter = make_session(h['username'], h['password'], verify=not args.insecure)
+    timings = []
+    buf = None
+    error = None
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
     try:
-        response = requests.get(
-            auth=HTTPBasicAuth(username, password),
-            url=url,
-            params={
-                "content": "config",
-            },
-            headers={
-                "Accept": "application/yang.data+json, application/yang.errors+json",
-            },
-        )
-        print('Response HTTP Status Code: {status_code}'.format(
-            status_code=response.status_code))
-        print('Response HTTP Response Body: {content}'.format(
-            content=response.content))
-    except requests.exceptions.RequestException:
-        print('HTTP Request failed')
+        for i in range(args.repeat):
+            if args.output:
+                out = open(args.output.format(host=h['host'], port=h['port']), 'wb')
+            elif direct:
+                out = stdout
+            else:
+                out = buf = BytesIO()
+            try:
+                status, size, headers_at, elapsed = send_request(
+                    session, args.method, url, out, params, body, args.encoding, h['timeout'])
+            finally:
+                if out is stdout:
+                    out.write(b'\n')
+                    out.flush()
+                elif out is not buf:
+                    out.close()
+            timings.append((status, size, headers_at, elapsed))
+            if status >= 400:
+                break
+    except requests.exceptions.RequestException as e:
+        error = 'HTTP request failed: %s' % e
+    except (IOError, OSError) as e:
+        error = "Can't write output: %s" % e
+    finally:
+        session.close()
+    output = buf.getvalue() if buf is not None and error is None else b''
+    return (h, timings, adapter.connections, output, error)
 
 
 if __name__ == '__main__':
@@ -35,7 +149,7 @@ if __name__ == '__main__':
     parser = ArgumentParser(description='Do a RESTCONF operation:')
 
     # Input parameters
-    parser.add_argument('--host', type=str, required=True,
+    parser.add_argument('--host', type=str,
                         help="The device IP or DN")
     parser.add_argument('-u', '--username', type=str, default='cisco',
                         help="Go on, guess!")
@@ -43,7 +157,115 @@ if __name__ == '__main__':
                         help="Yep, this one too! ;-)")
     parser.add_argument('--port', type=int, default=830,
                         help="Specify this if you want a non-default port")
+    parser.add_argument('--protocol', type=str, choices=['http', 'https'], default='http',
+                        help="Protocol to use (default http)")
+    parser.add_argument('--insecure', action='store_true',
+                        help="Don't verify the device's certificate with https")
+    parser.add_argument('--timeout', type=int, default=60,
+                        help="Seconds to wait for the device to respond (default 60)")
+
+    # The request
+    parser.add_argument('--method', type=str, default='GET',
+                        choices=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE'],
+                        help="HTTP method (default GET)")
+    parser.add_argument('--root', type=str, default='/restconf',
+                        help="The RESTCONF root resource (default /restconf)")
+    parser.add_argument('--path', type=str, default=DEFAULT_PATH,
+                        help="Data resource path under {root}/data, e.g. Cisco-IOS-XR-ifmgr-cfg:interface-configurations/interface-configuration=act,GigabitEthernet0%%2f0%%2f0%%2f0 (default %s)" % DEFAULT_PATH)
+    parser.add_argument('--content', type=str, default='config', choices=['config', 'nonconfig', 'all', ''],
+                        help="The content query parameter for GETs, or '' for none (default config)")
+    parser.add_argument('--depth', type=str,
+                        help="The depth query parameter")
+    parser.add_argument('--fields', type=str,
+                        help="The fields query parameter")
+    parser.add_argument('--encoding', type=str, choices=sorted(MEDIA_TYPES), default='json',
+                        help="Encoding of the data sent and asked for (default json)")
+    parser.add_argument('--data', type=str,
+                        help="Body to send with POST, PUT or PATCH")
+    parser.add_argument('--data-file', type=str,
+                        help="File holding the body to send with POST, PUT or PATCH")
+    parser.add_argument('--output', type=str,
+                        help="Stream response bodies to this file rather than printing them; {host} and {port} are replaced by the device's, which is required with --hosts-file")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Send the request this many times on each device's session, to see what reusing the connection saves (default 1)")
+
+    # Fan out across many devices rather than just --host
+    parser.add_argument('--hosts-file', type=str,
+                        help="File listing devices to send the request to, in the same formats as ncc.py takes")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Number of devices to work on concurrently with --hosts-file (default 8)")
 
     args = parser.parse_args()
 
-    send_request( "http", args.host, args.port, args.username, args.password)
+    if not args.host and not args.hosts_file:
+        print("One of --host or --hosts-file is required")
+        sys.exit(1)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.hosts_file and args.output and '{host}' not in args.output:
+        print("--output must include {host} when used with --hosts-file")
+        sys.exit(1)
+    body = args.data
+    if args.data_file:
+        with open(args.data_file, 'rb') as f:
+            body = f.read()
+    if body is not None and args.method not in ('POST', 'PUT', 'PATCH'):
+        print("--data and --data-file only apply to POST, PUT and PATCH")
+        sys.exit(1)
+    if args.method != 'GET':
+        args.content = None
+
+    if args.hosts_file:
+        hosts = ncc_hosts.load_hosts_file(args.hosts_file, args)
+    else:
+        hosts = [{'host': args.host, 'port': args.port,
+                  'username': args.username, 'password': args.password,
+                  'timeout': args.timeout}]
+
+    #
+    # Each device gets a session of its own, used for all its requests,
+    # with up to --workers devices being worked on at once. The bodies of
+    # responses from a single device are streamed straight to stdout;
+    # with several, each device's is buffered and printed as a block
+    # when it completes, unless --output is given.
+    #
+    start = time.time()
+    failed = []
+    requests_sent = []
+    pool = ThreadPool(max(1, min(args.workers, len(hosts))))
+    try:
+        direct = len(hosts) == 1
+        for (h, timings, connections, output, error) in pool.imap_unordered(
+                lambda h: run_one(h, args, body, direct), hosts):
+            ok = error is None and timings[-1][0] < 400
+            sys.stderr.write('=== %s:%d %s, %d connection(s) opened ===\n' % (
+                h['host'], h['port'], 'OK' if ok else 'FAILED', connections))
+            for (status, size, headers_at, elapsed) in timings:
+                sys.stderr.write('%s %d: %d bytes, headers in %.3fs, body in %.3fs\n' % (
+                    args.method, status, size, headers_at, elapsed))
+                requests_sent.append(elapsed)
+            if error:
+                sys.stderr.write('%s\n' % error)
+            if output:
+                out = getattr(sys.stdout, 'buffer', sys.stdout)
+                out.write(output)
+                out.write(b'\n')
+                out.flush()
+            if not ok:
+                failed.append(h)
+    finally:
+        pool.close()
+        pool.join()
+    wall = time.time() - start
+
+    if len(hosts) > 1 or args.repeat > 1:
+        latencies = sorted(requests_sent)
+        sys.stderr.write('=== Summary ===\n')
+        sys.stderr.write('Devices: %d, failed: %d, requests: %d, wall time %.2fs\n' % (
+            len(hosts), len(failed), len(latencies), wall))
+        if latencies:
+            sys.stderr.write('Latency: min %.3fs, avg %.3fs, p95 %.3fs, max %.3fs\n' % (
+                latencies[0], sum(latencies) / len(latencies),
+                latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                latencies[-1]))
+    sys.exit(1 if failed else 0)